@@ -1,12 +1,13 @@
 import os
+import time
 import logging
 
 import numpy as np
+import pandas as pd
 import dbdicom as db
-import miblab
-import vreg
 
 import utils.data
+from utils import kidneyseg
 
 
 EXCLUDE = []
@@ -25,7 +26,21 @@ logging.basicConfig(
 )
 
 
-def segment_site(site, batch_size=None):
+def segment_site(site, batch_size=None, threads=None):
+    """Segment the kidneys of all cases of a site.
+
+    The cases are listed first and then segmented back to back in this 
+    process, so the model weights are only loaded once. The time spent 
+    reading, loading weights, on inference and writing is appended to 
+    timing.csv in the results folder of the site.
+
+    Args:
+        site (str): site.
+        batch_size (int, optional): maximum number of cases to segment. 
+          Defaults to None (all).
+        threads (int, optional): number of torch threads. Defaults to
+          the number of cores this process may use.
+    """
 
     sitedatapath = os.path.join(datapath, site, "Patients") 
     sitemaskpath = os.path.join(maskpath, site, "Patients")
@@ -38,8 +53,11 @@ def segment_site(site, batch_size=None):
     series = db.series(sitedatapath)
     series_out_phase = [s for s in series if s[3][0][-9:]=='out_phase']
 
-    # Loop over the out-phase series
-    count = 0
+    # List existing masks once, rather than for every case
+    existing_series = db.series(sitemaskpath)
+
+    # List the cases that need segmenting
+    cases = []
     for series_op in series_out_phase:
 
         # Patient and output study
@@ -60,7 +78,7 @@ def segment_site(site, batch_size=None):
         # Skip if the kidney masks already exist
         mask_study = [sitemaskpath, patient, (study, 0)]
         mask_series = mask_study + [(f'kidney_masks', 0)]
-        if mask_series in db.series(mask_study):
+        if mask_series in existing_series:
             continue
 
         # Other source data series
@@ -69,10 +87,27 @@ def segment_site(site, batch_size=None):
         series_fi = series_op[:3] + [(sequence + '_fat', 0)]
 
         # Select model to use
-        if series_wi not in db.series(series_op[:3]):
+        if series_wi not in series:
            continue
 
+        cases.append((series_op, series_ip, series_wi, series_fi, mask_series))
+        if batch_size is not None:
+            if len(cases) >= batch_size:
+                break
+
+    # Load the model weights once for all cases
+    kidneyseg.start(threads)
+
+    # Loop over the cases
+    timings = []
+    for series_op, series_ip, series_wi, series_fi, mask_series in cases:
+
+        patient = series_op[1]
+        sequence = series_op[3][0][:-10]
+        timing = {'patient': patient, 'study': series_op[2][0]}
+
         # Read the in- and out of phase volumes
+        t = time.perf_counter()
         try:
             op = db.volume(series_op)
             ip = db.volume(series_ip)
@@ -81,6 +116,7 @@ def segment_site(site, batch_size=None):
         except Exception as e:
             logging.error(f"Patient {patient} - error reading I-O {sequence}: {e}")
             continue
+        timing['read'] = time.perf_counter() - t
 
         # Predict kidney masks
         try:
@@ -88,23 +124,23 @@ def segment_site(site, batch_size=None):
         except Exception as e:
             logging.error(f"{patient} {sequence} error building 4-channel input array: {e}")
             continue
-        # vol = vreg.volume(array, op.affine)
-        # rois = miblab.kidney_pc_dixon_unetr(vol, verbose=True)
         try:
-            vol = vreg.volume(array, op.affine)
-            rois = miblab.kidney_pc_dixon_unetr(vol, verbose=True)
+            rois, predict_timing = kidneyseg.predict(array, 'unetr', verbose=True)
         except Exception as e:
             logging.error(f"Error processing {patient} {sequence} with unetr: {e}")
             continue
+        timing.update(predict_timing)
             
         # Write in dicom as integer label arrays to save space
-        db.write_volume(rois, mask_series, ref=series_op)
-        
-        count += 1 
-        if batch_size is not None:
-            if count >= batch_size:
-                return
-            
+        t = time.perf_counter()
+        db.write_volume((rois, op.affine), mask_series, ref=series_op)
+        timing['write'] = time.perf_counter() - t
+        timings.append(timing)
+
+    # Append the timings of this batch
+    if timings != []:
+        file = os.path.join(sitemaskpath, 'timing.csv')
+        pd.DataFrame(timings).to_csv(file, mode='a', header=not os.path.exists(file), index=False)
 
 
 def all(batch_size=None):
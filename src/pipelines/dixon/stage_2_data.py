@@ -3,18 +3,13 @@ Create clean database
 """
 
 import os
-import zipfile
-import shutil
 import logging
-import tempfile
-import csv
 
-from tqdm import tqdm
 import numpy as np
-import pydicom
-import dbdicom as db
 import vreg
 
+from utils import parallel, dicomzip, manifest, data
+
 
 EXCLUDE = [
     "7128_048", # Sheffield: localizer only - check transfer
@@ -23,6 +18,7 @@ EXCLUDE = [
 
 downloadpath = os.path.join(os.getcwd(), 'build', 'dixon', 'stage_1_download')
 datapath = os.path.join(os.getcwd(), 'build', 'dixon', 'stage_2_data')
+stagingpath = os.path.join(os.getcwd(), 'build', 'dixon', 'stage_2_staging')
 os.makedirs(datapath, exist_ok=True)
 
 
@@ -34,30 +30,6 @@ logging.basicConfig(
 )
 
 
-def flatten_folder(root_folder):
-    for dirpath, dirnames, filenames in os.walk(root_folder, topdown=False):
-        for filename in filenames:
-            src_path = os.path.join(dirpath, filename)
-            dst_path = os.path.join(root_folder, filename)
-            
-            # If file with same name exists, optionally rename or skip
-            if os.path.exists(dst_path):
-                base, ext = os.path.splitext(filename)
-                counter = 1
-                while os.path.exists(dst_path):
-                    dst_path = os.path.join(root_folder, f"{base}_{counter}{ext}")
-                    counter += 1
-
-            shutil.move(src_path, dst_path)
-
-        # Remove empty subdirectories (but skip the root folder)
-        if dirpath != root_folder:
-            try:
-                os.rmdir(dirpath)
-            except OSError:
-                print(f"Could not remove {dirpath} — not empty or in use.")
-
-
 def exeter_ibeat_patient_id(folder):
     if folder=='3128-542':
         return '3128_542'
@@ -65,16 +37,79 @@ def exeter_ibeat_patient_id(folder):
     return folder[4:12].replace('-', '_')
 
 
+def exeter_setup_patient_id(folder):
+    desc = {
+        'TestPatient1': ('3128_C01', 'Visit1'),
+        'TestPatient2': ('3128_C02', 'Visit1'),
+        'TestPatient5': ('3128_C01', 'Visit2'),
+    }
+    return desc[folder]
+
+def exeter_repeatability_patient_id(folder):
+    desc = {
+        'TE37-001_V1': ('3128_C01', 'Visit3'),
+        'TE37-001_V2': ('3128_C01', 'Visit4'),
+        'TE37-001_V3': ('3128_C01', 'Visit5'),
+        'TE37-001_V4': ('3128_C01', 'Visit6'),
+        'TE37-001_V5': ('3128_C01', 'Visit7'),
+    }
+    return desc[folder]
+
 def bordeaux_ibeat_patient_id(folder):
     # iBE-2128-001_baseline
     return folder[4:12].replace('-', '_')
 
+def bordeaux_volunteers_patient_id(folder):
+    study_desc = {
+        'Bordeaux_Volunteers_Repeatability_Baseline': 'Visit3',
+        'TEST_RETEST_001': 'Visit1',
+        'TEST_RETEST_002': 'Visit2',
+        'TEST_RETEST_004_1': 'Visit4',
+    }
+    return '2128_C01', study_desc[folder]
+
 def leeds_ibeat_patient_id(folder):
     if folder[:3]=='iBE':
         return folder[4:].replace('-', '_')
     else:
         return folder[-7:-3] + '_' + folder[-3:]
 
+def leeds_setup_patient_id(folder):
+    pat_id = {
+        'Leeds_MR_VOL_006': '4128_C06',
+        'Leeds_MR_VOL_007': '4128_C07',
+        'Leeds_MR_VOL_008': '4128_C08',
+        'Leeds_MR_VOL_009': '4128_C09',
+        'Leeds_MR_VOL_012': '4128_C12',
+        'Leeds_MR_VOL_013': '4128_C13',
+        'Leeds_MR_VOL_014': '4128_C14',
+        'Leeds_MR_VOL_016': '4128_C16',
+        'Leeds_MR_VOL_019': '4128_C19',
+        'Leeds_MR_VOL_020': '4128_C20',
+    }
+    return pat_id[folder]
+
+def leeds_repeatability_patient_id(folder):
+    pat_id = {
+        'Leeds_REP_VOL_001': '4128_C21',
+        'Leeds_REP_VOL_002': '4128_C22',
+        'Leeds_REP_VOL_003': '4128_C23',
+        'Leeds_REP_VOL_004': '4128_C24',
+        'REP_VOL_004': '4128_C24',
+        'Leeds_REP_VOL_005': '4128_C25',
+        'Leeds_Rep_Vol_005': '4128_C25',
+    }
+    return pat_id[folder[:-3]], f'Visit{folder[-1]}'
+
+def bari_volunteers_patient_id(folder):
+    study_desc = {
+        'bari_volunteer1_20201222': 'Visit1',
+        'bari_volunteer1_20210109': 'Visit2',
+        'bari_volunteer1_20210123': 'Visit3',
+        'bari_volunteer1_20210130': 'Visit4',
+    }
+    return '1128_C01', study_desc[folder]
+
 def bari_ibeat_patient_id(folder):
     if folder[:3]=='iBE':
         return folder[4:].replace('-', '_')
@@ -99,6 +134,38 @@ def turku_ge_ibeat_patient_id(folder):
 
     return id, time_point
 
+def turku_ge_volunteers_patient_id(folder):
+    desc = {
+        'iBE-5128-251_V1': ('5128_C05', 'Visit1'),
+        'iBE-5128-252_V1': ('5128_C05', 'Visit2'),
+        'iBE-5128-253_V1': ('5128_C05', 'Visit3'),
+        'iBE-5128-251_V2': ('5128_C05', 'Visit4'),
+        'iBE-5128-261_V1': ('5128_C06', 'Visit1'),
+        'iBE-5128-262_V1': ('5128_C06', 'Visit2'),
+        'iBE-5128-263_V1': ('5128_C06', 'Visit3'),
+        'iBE-5128-264_V1': ('5128_C06', 'Visit4'),
+        'iBE-5128-271_V1': ('5128_C07', 'Visit1'),
+        'iBE-5128-281_V1': ('5128_C08', 'Visit1'),
+        'iBE-5128-282_V1': ('5128_C08', 'Visit2'),
+        'iBE-5128-283_V1': ('5128_C08', 'Visit3'),
+        'iBE-5128-281_V2': ('5128_C08', 'Visit4'),
+        'iBE-5128-291_V1': ('5128_C09', 'Visit1'),
+        'iBE-5128-292_V1': ('5128_C09', 'Visit2'),
+        'iBE-5128-293_V1': ('5128_C09', 'Visit3'),
+        'iBE-5128-294_V1': ('5128_C09', 'Visit4'),
+        'iBE-5128-301_V1': ('5128_C10', 'Visit1'),
+        'iBE-5128-301_V2': ('5128_C10', 'Visit2'),
+        'iBE-5128-301_V3': ('5128_C10', 'Visit3'),
+        'iBE-5128-301_V4': ('5128_C10', 'Visit4'),
+    }
+    return desc[folder]
+
+def turku_ge_setup_patient_id(folder):
+    desc = {
+        'subject_1': ('5128_C11', 'Visit1'),
+    }
+    return desc[folder]
+
 def turku_philips_ibeat_patient_id(folder):
     id = folder[:8].replace('-', '_')
     if "_followup" in id:
@@ -110,47 +177,30 @@ def turku_philips_ibeat_patient_id(folder):
 
     return id, time_point
 
-def leeds_rename_folder(folder):
-
-    # If a series is among the first 20, assume it is precontrast
-    name = os.path.basename(folder)
-    series_nr = int(name[-2:])
-    if series_nr < 20:
-        folder_name = 'Dixon_1_'
-    else:
-        folder_name = 'Dixon_post_contrast_1_'
-
-    # Add image type to the name
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
-    image_type = ds['ImageType'].value
-    props = image_type[3]
-    if props == 'IN_PHASE':
-        folder_name += 'in_phase'  
-    elif props == 'OUT_PHASE':
-        folder_name += 'out_phase'
-    elif props == 'WATER':
-        folder_name += 'water'
-    elif props == 'FAT':
-        folder_name += 'fat'
-    else:
-        folder_name += props
-    new_folder = os.path.join(os.path.dirname(folder), folder_name)
-
-    # If file with same name exists, increment the counter
-    if os.path.exists(new_folder):
-        counter = 2
-        while os.path.exists(new_folder):
-            new_folder = os.path.join(os.path.dirname(folder), folder_name.replace('_1_', f'_{counter}_'))
-            counter += 1
-    shutil.move(folder, new_folder)
-    shutil.rmtree(folder, ignore_errors=True)
-
+def turku_philips_volunteers_patient_id(folder):
+    desc = {
+        '5128-211': ('5128_C01', 'Visit1'),
+        '5128-212': ('5128_C01', 'Visit2'),
+        '5128-213': ('5128_C01', 'Visit3'),
+        '5128-214': ('5128_C01', 'Visit4'),
+        '5128-221': ('5128_C02', 'Visit1'),
+        '5128-222': ('5128_C02', 'Visit2'),
+        '5128-223': ('5128_C02', 'Visit3'),
+        '5128-224': ('5128_C02', 'Visit4'),
+        '5128-231': ('5128_C03', 'Visit1'),
+        '5128-232': ('5128_C03', 'Visit2'),
+        '5128-233': ('5128_C03', 'Visit3'),
+        '5128-234': ('5128_C03', 'Visit4'),
+        '5128-241': ('5128_C04', 'Visit1'),
+        '5128-242': ('5128_C04', 'Visit2'),
+        '5128-243': ('5128_C04', 'Visit3'),
+        '5128-244': ('5128_C04', 'Visit4'),
+    }
+    return desc[folder]
 
-def leeds_add_series_name(folder, all_series:list):
+def leeds_add_series_name(name, ds, all_series:list):
 
     # If a series is among the first 20, assume it is precontrast
-    name = os.path.basename(folder)
     series_nr = int(name[-2:])
     if series_nr < 20:
         series_name = 'Dixon_1_'
@@ -158,8 +208,6 @@ def leeds_add_series_name(folder, all_series:list):
         series_name = 'Dixon_post_contrast_1_'
 
     # Add image type to the name
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
     image_type = ds['ImageType'].value
     props = image_type[3]
     if props == 'IN_PHASE':
@@ -181,13 +229,11 @@ def leeds_add_series_name(folder, all_series:list):
         counter += 1
     all_series.append(new_series_name)
 
-def leeds_setup_add_series_name(folder, all_series:list):
+def leeds_setup_add_series_name(name, ds, all_series:list):
 
     series_name = 'Dixon_1_'
 
     # Add image type to the name
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
     image_type = ds['ImageType'].value
     props = image_type[3]
     if props == 'IN_PHASE':
@@ -199,7 +245,7 @@ def leeds_setup_add_series_name(folder, all_series:list):
     elif props == 'FAT':
         series_name += 'fat'
     else:
-        raise ValueError(f'{folder} error: ImageType {props} not rcognized')
+        raise ValueError(f'ImageType {props} not rcognized')
     
     # Add the appropriate number
     new_series_name = series_name
@@ -209,13 +255,11 @@ def leeds_setup_add_series_name(folder, all_series:list):
         counter += 1
     all_series.append(new_series_name)
 
-def leeds_repeatability_add_series_name(folder, all_series:list):
+def leeds_repeatability_add_series_name(name, ds, all_series:list):
 
     series_name = 'Dixon_1_'
 
     # Add image type to the name
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
     image_type = ds['ImageType'].value
     props = image_type[3]
     if props == 'ND':
@@ -229,7 +273,7 @@ def leeds_repeatability_add_series_name(folder, all_series:list):
     elif props == 'FAT':
         series_name += 'fat'
     else:
-        raise ValueError(f'{folder} error: ImageType {props} not rcognized')
+        raise ValueError(f'ImageType {props} not rcognized')
     
     # Add the appropriate number
     new_series_name = series_name
@@ -240,11 +284,9 @@ def leeds_repeatability_add_series_name(folder, all_series:list):
     all_series.append(new_series_name)
 
 
-def bordeaux_add_series_desc(folder, all_series:list):
+def bordeaux_add_series_desc(name, ds, all_series:list):
 
-    # Read series description from file
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
+    # Read series description from the header
     original_series_desc = ds['SeriesDescription'].value
     
     new_series_desc = {
@@ -268,11 +310,9 @@ def bordeaux_add_series_desc(folder, all_series:list):
     all_series.append(new_series_desc)
 
 
-def exeter_add_series_desc(folder, all_series:list):
+def exeter_add_series_desc(name, ds, all_series:list):
 
-    # Read series description from file
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
+    # Read series description from the header
     original_series_desc = ds['SeriesDescription'].value
     
     new_series_desc = {
@@ -296,11 +336,9 @@ def exeter_add_series_desc(folder, all_series:list):
     all_series.append(new_series_desc)
 
 
-def exeter_add_volunteer_series_desc(folder, all_series:list):
+def exeter_add_volunteer_series_desc(name, ds, all_series:list):
 
-    # Read series description from file
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
+    # Read series description from the header
     original_series_desc = ds['SeriesDescription'].value
     
     new_series_desc = {
@@ -325,11 +363,9 @@ def exeter_add_volunteer_series_desc(folder, all_series:list):
 
 
 
-def sheffield_add_series_desc(folder, all_series:list):
+def sheffield_add_series_desc(name, ds, all_series:list):
 
-    # Read series description from file
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
+    # Read series description from the header
     original_series_desc = ds['SeriesDescription'].value
     
     # For Philips decide based on EchoTime - no fat-water included
@@ -367,11 +403,9 @@ def sheffield_add_series_desc(folder, all_series:list):
         counter += 1
     all_series.append(new_series_desc)
 
-def turku_add_series_desc(folder, all_series:list):
+def turku_add_series_desc(name, ds, all_series:list):
 
-    # Read series description from file
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
+    # Read series description from the header
     original_series_desc = ds['SeriesDescription'].value
     
     # For Philips decide based on EchoTime - no fat-water included
@@ -410,11 +444,9 @@ def turku_add_series_desc(folder, all_series:list):
     all_series.append(new_series_desc)
 
 
-def turku_ge_setup_add_series_desc(folder, all_series:list):
+def turku_ge_setup_add_series_desc(name, ds, all_series:list):
 
-    # Read series description from file
-    file = os.listdir(folder)[0]
-    ds = pydicom.dcmread(os.path.join(folder, file))
+    # Read series description from the header
     original_series_desc = ds['SeriesDescription'].value
     
     # For GE translate descriptions to standard convention
@@ -439,7 +471,7 @@ def turku_ge_setup_add_series_desc(folder, all_series:list):
     all_series.append(new_series_desc)
 
 
-def bari_add_series_name(name, all_series:list):
+def bari_add_series_name(name, ds, all_series:list):
 
     # If a series is among the first 20, assume it is precontrast
     series_nr = int(name[7:])
@@ -456,7 +488,7 @@ def bari_add_series_name(name, all_series:list):
         counter += 1
     all_series.append(new_series_name)
 
-def turku_philips_add_series_name(name, all_series:list):
+def turku_philips_add_series_name(name, ds, all_series:list):
 
     # If a series is among the first 20, assume it is precontrast
     series_nr = int(name[7:])
@@ -473,7 +505,7 @@ def turku_philips_add_series_name(name, all_series:list):
         counter += 1
     all_series.append(new_series_name)
 
-def turku_philips_volunteers_add_series_name(all_series:list):
+def turku_philips_volunteers_add_series_name(name, ds, all_series:list):
 
     series_name = 'Dixon_1_'
     
@@ -486,17 +518,31 @@ def turku_philips_volunteers_add_series_name(all_series:list):
     all_series.append(new_series_name)
 
 def swap_fat_water(record, dixon, series, image_type):
-    for row in record:
-        if row[1:4] == [dixon[1], dixon[2][0], series]:
-            if row[4]=='1':
-                # Swap fat and water
-                if image_type=='fat':
-                    return dixon[:3] + [f'{series}_water']
-                if image_type=='water':
-                    return dixon[:3] + [f'{series}_fat']
+    if data.fat_water_swapped(record, dixon[1], dixon[2][0], series):
+        # Swap fat and water
+        if image_type=='fat':
+            return dixon[:3] + [f'{series}_water']
+        if image_type=='water':
+            return dixon[:3] + [f'{series}_fat']
     return dixon
 
 
+def is_built(built, all_series, source, shared=False):
+    # Note: all() is not used here as it is redefined in this module
+    for series in all_series:
+        if not manifest.is_current(built, series, source, shared):
+            return False
+    return True
+
+
+def write_series(vol, series, ref, source, shared=False):
+    # Replace the series if it is rebuilt from a changed source. The 
+    # manifest is saved with manifest.save() when the patient is done.
+    manifest.delete(series)
+    dicomzip.write_volume(vol, series, ref=ref)
+    manifest.add(manifest.file(series[0]), series, source, shared)
+
+
 def leeds_054():
 
     # Clean Leeds patient 054
@@ -505,247 +551,46 @@ def leeds_054():
     pat = os.path.join(downloadpath, "BEAt-DKD-WP4-Leeds", "Leeds_Patients", 'iBE-4128-054')
     sitedatapath = os.path.join(datapath, "Leeds", "Patients") 
     os.makedirs(sitedatapath, exist_ok=True)
+    built = manifest.read(manifest.init(sitedatapath))
+
+    dixon = {
+        4: 'Dixon_1_out_phase',
+        5: 'Dixon_1_in_phase',
+        6: 'Dixon_1_fat',
+        7: 'Dixon_1_water',
+        41: 'Dixon_post_contrast_1_out_phase',
+        42: 'Dixon_post_contrast_1_in_phase',
+        43: 'Dixon_post_contrast_1_fat',
+        44: 'Dixon_post_contrast_1_water',
+    }
 
-    with tempfile.TemporaryDirectory() as temp_folder:
-    
-        # Extract to a temporary folder
-        temp_database_1 = os.path.join(temp_folder, 'data_1')
-        os.makedirs(temp_database_1, exist_ok=True)
-        for zip_series in os.scandir(pat):
-            with zipfile.ZipFile(zip_series.path, 'r') as zip_ref:
-                zip_ref.extractall(temp_database_1)
-        flatten_folder(temp_database_1)
-
-        dixon = {
-            4: 'Dixon_1_out_phase',
-            5: 'Dixon_1_in_phase',
-            6: 'Dixon_1_fat',
-            7: 'Dixon_1_water',
-            41: 'Dixon_post_contrast_1_out_phase',
-            42: 'Dixon_post_contrast_1_in_phase',
-            43: 'Dixon_post_contrast_1_fat',
-            44: 'Dixon_post_contrast_1_water',
-        }
-        
-        # Group into series by series number in a temporary database 2
-        temp_database_2 = os.path.join(temp_folder, 'data_2')
-        for s in db.series(temp_database_1):
-            v = db.unique('SeriesNumber', s)[0]
-            new_series = [temp_database_2, '4128_054', 'Baseline', dixon[v]]
-            db.move(s, new_series)    
-
-        # Read as volume to ensure proper slice orders and write to final database.
-        for s in db.series(temp_database_2): 
-            try:
-                dixon_vol = db.volume(s)
-            except Exception as e:
-                logging.error(f"Patient 4128_054 - {s[-1][0]}: {e}")
-            else:
-                new_series = [sitedatapath] + s[1:]
-                db.write_volume(dixon_vol, new_series, ref=s)
-
-
-
-def leeds_patients():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Leeds", "Leeds_Patients")
-    sitedatapath = os.path.join(datapath, "Patients", "Leeds") 
-    os.makedirs(sitedatapath, exist_ok=True)
-    
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database..'):
-
-        # Get a standardized ID from the folder name
-        pat_id = leeds_ibeat_patient_id(os.path.basename(pat))
-
-
-        # If the dataset already exists, continue to the next
-        subdirs = [d for d in os.listdir(sitedatapath)
-           if os.path.isdir(os.path.join(sitedatapath, d))]
-        if f'Patient__{pat_id}' in subdirs: 
-            continue
-
-        # Exception with unique folder structure
-        if pat_id == '4128_054':
-            leeds_054()
-            continue
-
-        with tempfile.TemporaryDirectory() as temp_folder:
-
-            pat_series = []
-            for zip_series in os.scandir(pat):
-
-                # Get the name of the zip file without extension
-                zip_name = os.path.splitext(os.path.basename(zip_series.path))[0]
-
-                # Extract to a temporary folder and flatten
-                extract_to = os.path.join(temp_folder, zip_name)
-                with zipfile.ZipFile(zip_series.path, 'r') as zip_ref:
-                    zip_ref.extractall(extract_to)
-                flatten_folder(extract_to)
-
-                # Add new series name to the list
-                try:
-                    leeds_add_series_name(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Copy to the database using the harmonized names
-                dixon = db.series(extract_to)[0]
-                dixon_clean = [sitedatapath, pat_id, 'Baseline', pat_series[-1]]
-                # db.copy(dixon, dixon_clean)
-                try:
-                    dixon_vol = db.volume(dixon)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                else:
-                    db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def leeds_setup():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Leeds", "Leeds_setup_scans")
-    sitedatapath = os.path.join(datapath, "Controls") 
-    os.makedirs(sitedatapath, exist_ok=True)
-    
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database..'):
-
-        # Get a standardized ID from the folder name
-        pat_id = {
-            'Leeds_MR_VOL_006': '4128_C06',
-            'Leeds_MR_VOL_007': '4128_C07',
-            'Leeds_MR_VOL_008': '4128_C08',
-            'Leeds_MR_VOL_009': '4128_C09',
-            'Leeds_MR_VOL_012': '4128_C12',
-            'Leeds_MR_VOL_013': '4128_C13',
-            'Leeds_MR_VOL_014': '4128_C14',
-            'Leeds_MR_VOL_016': '4128_C16',
-            'Leeds_MR_VOL_019': '4128_C19',
-            'Leeds_MR_VOL_020': '4128_C20',
-        }
-        pat_id = pat_id[os.path.basename(pat)]
-        study = [sitedatapath, pat_id, 'Visit1']
-
-        # If the dataset already exists, continue to the next
-        subdirs = [d for d in os.listdir(sitedatapath)
-           if os.path.isdir(os.path.join(sitedatapath, d))]
-        if f'Patient__{pat_id}' in subdirs: 
-            continue
-
-        with tempfile.TemporaryDirectory() as temp_folder:
-
-            pat_series = []
-            for zip_series in os.scandir(pat):
-
-                # Get the name of the zip file without extension
-                zip_name = os.path.splitext(os.path.basename(zip_series.path))[0]
-
-                # Extract to a temporary folder and flatten
-                extract_to = os.path.join(temp_folder, zip_name)
-                with zipfile.ZipFile(zip_series.path, 'r') as zip_ref:
-                    zip_ref.extractall(extract_to)
-                flatten_folder(extract_to)
-
-                # Add new series name to the list
-                try:
-                    leeds_setup_add_series_name(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Skip exceptions
-                if pat_id=='4128_C14' and pat_series[-1] == 'Dixon_2_out_phase':
-                    continue
-                if pat_id=='4128_C20' and pat_series[-1] == 'Dixon_2_out_phase':
-                    continue
-
-                # Copy to the database using the harmonized names
-                dixon = db.series(extract_to)[0]
-                dixon_clean = study + [pat_series[-1]]
-                # db.copy(dixon, dixon_clean)
-                try:
-                    dixon_vol = db.volume(dixon)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                else:
-                    db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def leeds_repeatability():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Leeds", "Leeds_volunteer_repeatability_study")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
-    
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database..'):
-
-        # Get a standardized ID from the folder name
-        pat_id = {
-            'Leeds_REP_VOL_001': '4128_C21',
-            'Leeds_REP_VOL_002': '4128_C22',
-            'Leeds_REP_VOL_003': '4128_C23',
-            'Leeds_REP_VOL_004': '4128_C24',
-            'REP_VOL_004': '4128_C24',
-            'Leeds_REP_VOL_005': '4128_C25',
-            'Leeds_Rep_Vol_005': '4128_C25',
-        }
-        pat_id = pat_id[os.path.basename(pat)[:-3]]
-        study = [sitedatapath, pat_id, (f'Visit{os.path.basename(pat)[-1]}', 0)]
-
-        # If the study already exists, continue to the next
-        if study in db.studies([sitedatapath, pat_id]): 
-            continue
-
-        with tempfile.TemporaryDirectory() as temp_folder:
-
-            pat_series = []
-            for zip_series in os.scandir(pat):
-
-                # Get the name of the zip file without extension
-                zip_name = os.path.splitext(os.path.basename(zip_series.path))[0]
-
-                # Extract to a temporary folder and flatten
-                extract_to = os.path.join(temp_folder, zip_name)
-                with zipfile.ZipFile(zip_series.path, 'r') as zip_ref:
-                    zip_ref.extractall(extract_to)
-                flatten_folder(extract_to)
-
-                # Add new series name to the list
-                try:
-                    leeds_repeatability_add_series_name(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # # Skip exceptions
-                # if pat_id=='4128_C14' and pat_series[-1] == 'Dixon_2_out_phase':
-                #     continue
-                # if pat_id=='4128_C20' and pat_series[-1] == 'Dixon_2_out_phase':
-                #     continue
+    # All series are built from the same folder of zip files
+    if is_built(built, [[sitedatapath, '4128_054', 'Baseline', d] for d in dixon.values()], pat):
+        return
 
-                # Copy to the database using the harmonized names
-                dixon = db.series(extract_to)[0]
-                dixon_clean = study + [pat_series[-1]]
-                # db.copy(dixon, dixon_clean)
-                try:
-                    dixon_vol = db.volume(dixon)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                else:
-                    db.write_volume(dixon_vol, dixon_clean, ref=dixon)
+    # Read the images of all series into memory
+    datasets = []
+    for zip_series in os.scandir(pat):
+        if zip_series.name.endswith('.zip'):
+            datasets += dicomzip.read(zip_series.path)
+
+    # Group into series by series number
+    split = sorted(dicomzip.split_series(datasets, 'SeriesNumber'), key=lambda x: x[0])
+
+    # Read as volume to ensure proper slice orders and write to final database.
+    for v, s in split:
+        new_series = [sitedatapath, '4128_054', 'Baseline', dixon[v]]
+        try:
+            dixon_vol = dicomzip.volume(s)
+        except Exception as e:
+            logging.error(f"Patient 4128_054 - {dixon[v]}: {e}")
+        else:
+            write_series(dixon_vol, new_series, s, pat)
+    manifest.save()
 
 
 
-def bari_030(dixon_split):
+def bari_030(dixon_split, sitedatapath, zip_file):
 
     # The precontrast dixon of this subject has missing slices in the 
     # middle. In out-phase is missing 2 consecutive slices at slice 
@@ -753,7 +598,6 @@ def bari_030(dixon_split):
     # slice location 13. Solved by interpolating to recover the missing 
     # slices.
 
-    sitedatapath = os.path.join(datapath, "Patients", "Bari")
     pat_id = '1128_030'
     series_desc = 'Dixon_1'
 
@@ -771,7 +615,7 @@ def bari_030(dixon_split):
     # Interpolate missing slices - out-phase
     loc0 = 11.6357442880728 # last slice before the gap
     series = dixon_split[out_phase][1]
-    arr, crd, val = db.pixel_data(series, dims='SliceLocation', coords=True, attr=aff)
+    arr, crd, val = dicomzip.pixel_data(series, attr=aff)
     i0 = np.where(crd[0,:] == loc0)[0][0]
     # Interpolate missing slices
     pixel_data = np.zeros(arr.shape[:2] + (arr.shape[2]+2, ))
@@ -780,19 +624,19 @@ def bari_030(dixon_split):
     pixel_data[:,:,i0+2] = (2/3) * arr[:,:,i0] + (1/3) * arr[:,:,i0+1]
     pixel_data[:,:,i0+3:] = arr[:,:,i0+1:]
     # Create volume and save
-    affine = db.affine_matrix(
+    affine = dicomzip.affine_matrix(
         val['ImageOrientationPatient'][0], 
         val['ImagePositionPatient'][0], 
         val['PixelSpacing'][0], 
         val['SpacingBetweenSlices'][0])
     in_phase_vol = vreg.volume(pixel_data, affine)
     in_phase_clean = [sitedatapath, pat_id, 'Baseline', series_desc + '_out_phase']
-    db.write_volume(in_phase_vol, in_phase_clean, ref=series)
+    write_series(in_phase_vol, in_phase_clean, series, zip_file)
 
     # Interpolate missing slices - in_phase
     loc0 = 13.1357467355428 # last slice before the gap
     series = dixon_split[in_phase][1]
-    arr, crd = db.pixel_data(series, dims='SliceLocation', coords=True)
+    arr, crd = dicomzip.pixel_data(series)
     i0 = np.where(crd[0,:] == loc0)[0][0]
     # Interpolate missing slices
     pixel_data = np.zeros(arr.shape[:2] + (arr.shape[2]+1, ))
@@ -802,1381 +646,680 @@ def bari_030(dixon_split):
     # Create volume and save
     out_phase_vol = vreg.volume(pixel_data, affine)
     out_phase_clean = [sitedatapath, pat_id, 'Baseline', series_desc + '_in_phase']
-    db.write_volume(out_phase_vol, out_phase_clean, ref=series)
-
-
-def bari_volunteers():
-
-    # Define input and output folders
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Bari", "Bari_Volunteers_Repeatability")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
+    write_series(out_phase_vol, out_phase_clean, series, zip_file)
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database'):
-
-        # Get IDs from the folder name
-        pat_id = '1128_C01'
-        study_desc = {
-            'bari_volunteer1_20201222': 'Visit1',
-            'bari_volunteer1_20210109': 'Visit2',
-            'bari_volunteer1_20210123': 'Visit3',
-            'bari_volunteer1_20210130': 'Visit4',
-        }
-        study_desc = study_desc[os.path.basename(pat)]
-        study = [sitedatapath, pat_id, (study_desc, 0)]
 
-        # Find all zip series, remove those with 'OT' in the name and sort by series number
-        all_zip_series = [f for f in os.listdir(pat) if os.path.isfile(os.path.join(pat, f))]
-        all_zip_series = [s for s in all_zip_series if 'OT' not in s]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
-
-        # loop over all series
-        pat_series = []
-        for zip_series in all_zip_series:
+def exeter_interpolate_vol(series):
 
-            # Get the name of the zip file without extension
-            zip_name = zip_series[:-4]
+    # Need these values to build the affine
+    aff = ['ImageOrientationPatient', 'ImagePositionPatient', 'PixelSpacing', 'SliceThickness']
+    # Interpolate missing slices - out-phase
+    arr, crd, val = dicomzip.pixel_data(series, attr=aff)
+    i0 = np.where(crd[0,1:]-crd[0,:-1]==3)[0][0]
+    # Interpolate missing slices
+    pixel_data = np.zeros(arr.shape[:2] + (arr.shape[2]+1, ))
+    pixel_data[:,:,:i0+1] = arr[:,:,:i0+1]
+    pixel_data[:,:,i0+1] = (1/2) * arr[:,:,i0] + (1/2) * arr[:,:,i0+1]
+    pixel_data[:,:,i0+2:] = arr[:,:,i0+1:]
+    # Create volume 
+    affine = dicomzip.affine_matrix(
+        val['ImageOrientationPatient'][0], 
+        val['ImagePositionPatient'][0], 
+        val['PixelSpacing'][0], 
+        val['SliceThickness'][0])
+    return vreg.volume(pixel_data, affine)
 
-            # Get the harmonized series name 
-            try:
-                bari_add_series_name(zip_name, pat_series)
-            except Exception as e:
-                logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                continue
 
-            # Construct output series
-            out_phase_clean = study + [(pat_series[-1] + 'out_phase', 0)]
-            in_phase_clean = study + [(pat_series[-1] + 'in_phase', 0)]
+def exeter_111():
 
-            # If the series already exists, continue to the next
-            if out_phase_clean in db.series(study):
-                continue
+    # In- and opposed phase combined in the same series
+    # No fat or water maps computed
 
-            with tempfile.TemporaryDirectory() as temp_folder:
-
-                # Extract to a temporary folder and flatten it
-                os.makedirs(temp_folder, exist_ok=True)
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(pat, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Split series into in- and opposed phase
-                dixon = db.series(extract_to)[0]
-                try:
-                    dixon_split = db.split_series(dixon, 'EchoTime')
-                except Exception as e:
-                    logging.error(
-                        f"Error splitting Bari series {pat_id} "
-                        f"{os.path.basename(extract_to)}."
-                        f"The series is not included in the database.\n"
-                        f"--> Details of the error: {e}")
-                    continue
-                
-                # Check the echo times
-                if len(dixon_split) == 1:
-                    logging.error(
-                        f"Bari patient {pat_id}, series "
-                        f"{os.path.basename(extract_to)}: "
-                        f"Only one echo time found. Excluded from database.")
-                    continue    
-
-                # Out_phase is the one with the smallest TE
-                if dixon_split[0][0] < dixon_split[1][0]:
-                    out_phase = 0
-                    in_phase = 1
-                else:
-                    out_phase = 1
-                    in_phase = 0
-
-                # Write to the database using read/write volume to ensure proper slice order.
-                try:
-                    out_phase_vol = db.volume(dixon_split[out_phase][1])
-                    in_phase_vol = db.volume(dixon_split[in_phase][1])
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                else:
-                    db.write_volume(out_phase_vol, out_phase_clean, ref=dixon_split[out_phase][1])
-                    db.write_volume(in_phase_vol, in_phase_clean, ref=dixon_split[in_phase][1])
-
-
-def bari_patients():
+    visit = 'Baseline'
 
-    # Define input and output folders
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Bari", "Bari_Patients")
-    sitedatapath = os.path.join(datapath, "Patients", "Bari")
+    # Clean Leeds patient data
+    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Exeter", f"Exeter_Patients_{visit}")
+    sitedatapath = os.path.join(datapath, "Patients", "Exeter") 
     os.makedirs(sitedatapath, exist_ok=True)
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        pat_id = bari_ibeat_patient_id(os.path.basename(pat))
-
-        # Corrupted data
-        if pat_id in EXCLUDE:
-            continue
+    patient = os.path.join(sitedownloadpath, 'iBE-3128-111')
+    pat_id = '3128_111'
 
-        # Find all zip series, remove those with 'OT' in the name and sort by series number
-        all_zip_series = [f for f in os.listdir(pat) if os.path.isfile(os.path.join(pat, f))]
-        all_zip_series = [s for s in all_zip_series if 'OT' not in s]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
+    # Series that are already built
+    built = manifest.read(manifest.init(sitedatapath))
 
-        # loop over all series
-        pat_series = []
-        for zip_series in all_zip_series:
+    # Find all zip series in the experiment and sort by series number
+    # Partial downloads (.part files) are left in place to be resumed
+    all_zip_series = [f for f in os.listdir(patient) if f.endswith('.zip')]
+    all_zip_series = [f for f in all_zip_series if os.path.isfile(os.path.join(patient, f))]
+    all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-            # Get the name of the zip file without extension
-            zip_name = zip_series[:-4]
+    # Read all series of the patient
+    for zip_series in all_zip_series:
 
-            # Get the harmonized series name 
-            try:
-                bari_add_series_name(zip_name, pat_series)
-            except Exception as e:
-                logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                continue
+        # Get the name of the zip file without extension.
+        zip_name = zip_series[:-4]
+        zip_file = os.path.join(patient, zip_series)
 
-            # Construct output series
-            study = [sitedatapath, pat_id, ('Baseline', 0)]
-            out_phase_clean = study + [(pat_series[-1] + 'out_phase', 0)]
-            in_phase_clean = study + [(pat_series[-1] + 'in_phase', 0)]
+        sequence='Dixon_1_' if zip_name=='series_04' else 'Dixon_post_contrast_1_'
+        study = [sitedatapath, pat_id, ('Baseline', 0)]
+        out_phase_clean = study + [(sequence + 'out_phase', 0)]
+        in_phase_clean = study + [(sequence + 'in_phase', 0)]
 
-            # If the series already exists, continue to the next
-            if out_phase_clean in db.series(study):
+        # Skip the series if it is already built
+        if manifest.is_current(built, out_phase_clean, zip_file):
+            if manifest.is_current(built, in_phase_clean, zip_file):
                 continue
+        
+        # Read the series from the zip file
+        try:
+            dixon = dicomzip.read(zip_file)
+        except Exception as e:
+            logging.error(f"Patient {pat_id} - error reading {zip_name}: {e}")
+            continue
 
-            with tempfile.TemporaryDirectory() as temp_folder:
-
-                # Extract to a temporary folder and flatten it
-                os.makedirs(temp_folder, exist_ok=True)
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(pat, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Split series into in- and opposed phase
-                dixon = db.series(extract_to)[0]
-                try:
-                    dixon_split = db.split_series(dixon, 'EchoTime')
-                except Exception as e:
-                    logging.error(
-                        f"Error splitting Bari series {pat_id} "
-                        f"{os.path.basename(extract_to)}."
-                        f"The series is not included in the database.\n"
-                        f"--> Details of the error: {e}")
-                    continue
-                
-                # Check the echo times
-                if len(dixon_split) == 1:
-                    logging.error(
-                        f"Bari patient {pat_id}, series "
-                        f"{os.path.basename(extract_to)}: "
-                        f"Only one echo time found. Excluded from database.")
-                    continue    
-
-                # Special case
-                if (pat_id == '1128_030') and (pat_series[-1] == 'Dixon_1_'):
-                    bari_030(dixon_split)
-                    continue
-
-                # Out_phase is the one with the smallest TE
-                if dixon_split[0][0] < dixon_split[1][0]:
-                    out_phase = 0
-                    in_phase = 1
-                else:
-                    out_phase = 1
-                    in_phase = 0
-
-                # Write to the database using read/write volume to ensure proper slice order.
-                try:
-                    out_phase_vol = db.volume(dixon_split[out_phase][1])
-                    in_phase_vol = db.volume(dixon_split[in_phase][1])
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                else:
-                    db.write_volume(out_phase_vol, out_phase_clean, ref=dixon_split[out_phase][1])
-                    db.write_volume(in_phase_vol, in_phase_clean, ref=dixon_split[in_phase][1])
-
-                # # Predict fat and water
-                # # ---------------------
-                # This works but the results are poor
-                # Uncomment when the method has been improved
-
-                # try:
-                #     out_phase = db.volume(out_phase_clean)
-                #     in_phase = db.volume(in_phase_clean)
-                # except Exception as e:
-                #     logging.error(
-                #         f"Patient {pat_id}: error predicting fat-water separation. "
-                #         f"Cannot read out-phase or in-phase volumes: {e}")
-                #     continue
-                # array = np.stack((out_phase.values, in_phase.values), axis=-1)
-                # fw = miblab.kidney_dixon_fat_water(array)
-
-                # # Save fat and water
-                # fat = [sitedatapath, pat_id, 'Baseline', pat_series[-1] + 'fat']
-                # water = [sitedatapath, pat_id, 'Baseline', pat_series[-1] + 'water']
-                # ref = out_phase_clean
-                # db.write_volume((fw['fat'], out_phase.affine), fat, ref)
-                # db.write_volume((fw['water'], out_phase.affine), water, ref)
-
-
-
-
-def sheffield():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Sheffield")
-    sitedatapath = os.path.join(datapath, "Patients", "Sheffield") 
-    os.makedirs(sitedatapath, exist_ok=True)
+        # Split by TE
+        dixon_split = dicomzip.split_series(dixon, 'EchoTime')
 
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
+        # Out_phase is the one with the smallest TE
+        if dixon_split[0][0] < dixon_split[1][0]:
+            out_phase = 0
+            in_phase = 1
+        else:
+            out_phase = 1
+            in_phase = 0
+
+        # Write to the database using read/write volume to ensure proper slice order.
+        try:
+            out_phase_vol = dicomzip.volume(dixon_split[out_phase][1])
+            in_phase_vol = dicomzip.volume(dixon_split[in_phase][1])
+        except Exception as e:
+            logging.error(f"Patient {pat_id} - {sequence}: {e}")
+        else:
+            write_series(out_phase_vol, out_phase_clean, dixon_split[out_phase][1], zip_file)
+            write_series(in_phase_vol, in_phase_clean, dixon_split[in_phase][1], zip_file)
+    manifest.save()
+
+
+
+
+# Site and cohort specifications for the build engine. Each entry
+# overrides the defaults in COHORT_DEFAULTS:
+#   download: folder of the cohort in the download path. '{visit}' is
+#       replaced by the visit.
+#   database: folder of the clean database in the data path.
+#   patient_id: function returning the patient ID from a patient folder,
+#       or a tuple (patient ID, study description).
+#   study: study description. If this is None it is returned by
+#       patient_id. '{visit}' is replaced by the visit.
+#   series_desc: function (zip_name, header, all_series) appending the
+#       harmonized name of a series to all_series.
+#   split: None to write each zip file as one series, or the attribute
+#       to split it by: 'EchoTime' (out- and in-phase) or 'ImageType'
+#       (out-phase, in-phase, water and fat).
+#   ordered: classify all series of a patient first, then write them
+#       in the standard order.
+#   swap: correct fat-water swaps using the swap record.
+#   experiment: the zip files are in an experiment folder inside the
+#       patient folder.
+#   exclude_zip: ignore zip files with any of these in their name.
+#   sort: name the zip files in the order of their series number. If 
+#       this is False they are named in the order they are listed in 
+#       the patient folder, which sets the counters of the series names.
+#   special: functions building patients with a unique folder structure,
+#       for (patient ID, study).
+#   skip_series: (patient ID, series) that are not included.
+#   volume: functions building the volume of a series with missing
+#       slices, for (patient ID, study, series).
+#   reslice: (patient ID, study, sequence) acquired axially, which are
+#       resliced to coronal.
+#   write: functions writing a split series with missing slices, for
+#       (patient ID, study, sequence).
+#   split_on_xnat: (patient ID, study) whose series are split over two
+#       patient folders on XNAT. Their series may be built from either.
+
+COHORT_DEFAULTS = {
+    'study': None,
+    'split': None,
+    'ordered': False,
+    'swap': False,
+    'experiment': False,
+    'exclude_zip': [],
+    'sort': True,
+    'special': {},
+    'skip_series': [],
+    'volume': {},
+    'reslice': [],
+    'write': {},
+    'split_on_xnat': [],
+}
+
+COHORTS = {
+    'leeds_patients': {
+        'download': ["BEAt-DKD-WP4-Leeds", "Leeds_Patients"],
+        'database': ["Patients", "Leeds"],
+        'patient_id': leeds_ibeat_patient_id,
+        'study': 'Baseline',
+        'series_desc': leeds_add_series_name,
+        'sort': False,
+        'special': {('4128_054', 'Baseline'): leeds_054},
+    },
+    'leeds_setup': {
+        'download': ["BEAt-DKD-WP4-Leeds", "Leeds_setup_scans"],
+        'database': ["Controls"],
+        'patient_id': leeds_setup_patient_id,
+        'study': 'Visit1',
+        'series_desc': leeds_setup_add_series_name,
+        'sort': False,
+        'skip_series': [
+            ('4128_C14', 'Dixon_2_out_phase'),
+            ('4128_C20', 'Dixon_2_out_phase'),
+        ],
+    },
+    'leeds_repeatability': {
+        'download': ["BEAt-DKD-WP4-Leeds", "Leeds_volunteer_repeatability_study"],
+        'database': ["Controls"],
+        'patient_id': leeds_repeatability_patient_id,
+        'series_desc': leeds_repeatability_add_series_name,
+        'sort': False,
+    },
+    'bari_volunteers': {
+        'download': ["BEAt-DKD-WP4-Bari", "Bari_Volunteers_Repeatability"],
+        'database': ["Controls"],
+        'patient_id': bari_volunteers_patient_id,
+        'series_desc': bari_add_series_name,
+        'split': 'EchoTime',
+        'exclude_zip': ['OT'],
+    },
+    'bari_patients': {
+        'download': ["BEAt-DKD-WP4-Bari", "Bari_Patients"],
+        'database': ["Patients", "Bari"],
+        'patient_id': bari_ibeat_patient_id,
+        'study': 'Baseline',
+        'series_desc': bari_add_series_name,
+        'split': 'EchoTime',
+        'exclude_zip': ['OT'],
+        'write': {('1128_030', 'Baseline', 'Dixon_1_'): bari_030},
+    },
+    'sheffield': {
+        'download': ["BEAt-DKD-WP4-Sheffield"],
+        'database': ["Patients", "Sheffield"],
+        'patient_id': sheffield_ibeat_patient_id,
+        'study': 'Baseline',
+        'series_desc': sheffield_add_series_desc,
+        'ordered': True,
+        'swap': True,
+        'experiment': True,
+    },
+    'turku_ge_patients': {
+        'download': ["BEAt-DKD-WP4-Turku", "Turku_Patients_GE"],
+        'database': ["Patients", "Turku"],
+        'patient_id': turku_ge_ibeat_patient_id,
+        'series_desc': turku_add_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+    'turku_ge_volunteers': {
+        'download': ["BEAt-DKD-WP4-Turku", "Turku_Volunteers_GE_Repeatability"],
+        'database': ["Controls"],
+        'patient_id': turku_ge_volunteers_patient_id,
+        'series_desc': turku_add_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+    'turku_ge_setup': {
+        'download': ["BEAt-DKD-WP4-Turku", "Turku_GE_Setup_Tests"],
+        'database': ["Controls"],
+        'patient_id': turku_ge_setup_patient_id,
+        'series_desc': turku_ge_setup_add_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+    'turku_philips_patients': {
+        'download': ["BEAt-DKD-WP4-Turku", "Turku_Patients_Philips"],
+        'database': ["Patients", "Turku_Philips"],
+        'patient_id': turku_philips_ibeat_patient_id,
+        'study': 'Baseline',
+        'series_desc': turku_philips_add_series_name,
+        'split': 'ImageType',
+    },
+    'turku_philips_volunteers': {
+        'download': ["BEAt-DKD-WP4-Turku", "Turku_volunteer_repeatability_study"],
+        'database': ["Controls"],
+        'patient_id': turku_philips_volunteers_patient_id,
+        'series_desc': turku_philips_volunteers_add_series_name,
+        'split': 'ImageType',
+    },
+    'bordeaux_patients': {
+        'download': ["BEAt-DKD-WP4-Bordeaux", "Bordeaux_Patients_{visit}"],
+        'database': ["Patients", "Bordeaux"],
+        'patient_id': bordeaux_ibeat_patient_id,
+        'study': '{visit}',
+        'series_desc': bordeaux_add_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+    'bordeaux_volunteers': {
+        'download': ["BEAt-DKD-WP4-Bordeaux", "Bordeaux_Volunteers_Repeatability_Baseline"],
+        'database': ["Controls"],
+        'patient_id': bordeaux_volunteers_patient_id,
+        'series_desc': bordeaux_add_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+    'exeter_patients': {
+        'download': ["BEAt-DKD-WP4-Exeter", "Exeter_Patients_{visit}"],
+        'database': ["Patients", "Exeter"],
+        'patient_id': exeter_ibeat_patient_id,
+        'study': '{visit}',
+        'series_desc': exeter_add_series_desc,
+        'ordered': True,
+        'swap': True,
+        'special': {('3128_111', 'Baseline'): exeter_111},
+        'volume': {
+            ('3128_044', 'Baseline', 'Dixon_post_contrast_1_in_phase'): exeter_interpolate_vol,
+            ('3128_082', 'Baseline', 'Dixon_post_contrast_1_fat'): exeter_interpolate_vol,
+            ('3128_120', 'Baseline', 'Dixon_post_contrast_1_out_phase'): exeter_interpolate_vol,
+        },
+        'reslice': [
+            ('3128_014', 'Baseline', 'Dixon_2'),
+            ('3128_086', 'Baseline', 'Dixon_post_contrast_1'),
+            ('3128_104', 'Baseline', 'Dixon_2'),
+            ('3128_104', 'Baseline', 'Dixon_post_contrast_1'),
+        ],
+        'split_on_xnat': [
+            ('3128_039', 'Baseline'), 
+            ('3128_107', 'Baseline'), 
+            ('3128_012', 'Followup'), 
+            ('3128_031', 'Followup'), 
+            ('3128_050', 'Followup'),
+        ],
+    },
+    'exeter_setup': {
+        'download': ["BEAt-DKD-WP4-Exeter", "Exeter_setup_scans"],
+        'database': ["Controls"],
+        'patient_id': exeter_setup_patient_id,
+        'series_desc': exeter_add_volunteer_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+    'exeter_repeatability': {
+        'download': ["BEAt-DKD-WP4-Exeter", "Exeter_Volunteer"],
+        'database': ["Controls"],
+        'patient_id': exeter_repeatability_patient_id,
+        'series_desc': exeter_add_volunteer_series_desc,
+        'ordered': True,
+        'swap': True,
+    },
+}
+
+# Standard order of the series in the database
+SERIES_ORDER = [
+    f'{series}_{counter}_{image_type}'
+    for series in ['Dixon', 'Dixon_post_contrast']
+    for counter in [1,2,3] # never more than 3 repetitions
+    for image_type in ['out_phase', 'in_phase', 'fat', 'water']
+]
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
+# Image types of a series split by EchoTime or ImageType
+IMAGE_TYPES = {
+    'OP': 'out_phase',
+    'IP': 'in_phase',
+    'W': 'water',
+    'F': 'fat',
+}
 
-        # Get a standardized ID from the folder name
-        pat_id = sheffield_ibeat_patient_id(os.path.basename(patient))
 
-        # Corrupted data
-        if pat_id in EXCLUDE:
-            continue
+def split_series_desc(series_desc):
+    # For instance 'Dixon_post_contrast_1_out_phase' returns
+    # ('Dixon_post_contrast_1', 'out_phase')
+    for image_type in IMAGE_TYPES.values():
+        if series_desc.endswith(f'_{image_type}'):
+            return series_desc[:-len(image_type)-1], image_type
+    return series_desc, None
 
-        # If the dataset already exists, continue to the next
-        # This needs to check sequences not patients
-        subdirs = [
-            d for d in os.listdir(sitedatapath)
-            if os.path.isdir(os.path.join(sitedatapath, d))]
-        if f'Patient__{pat_id}' in subdirs:
-            continue
 
-        # Get the experiment directory
-        experiment = [f for f in os.listdir(patient) if os.path.isdir(os.path.join(patient, f))][0]
-        experiment_path = os.path.join(patient, experiment)
+def cohort_spec(cohort):
+    return {**COHORT_DEFAULTS, **COHORTS[cohort]}
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(experiment_path) if os.path.isfile(os.path.join(experiment_path, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-        # Note:
-        # In Sheffield XNAT the Dixon series are not saved in the proper order, which looks messy in the database.
-        # So all series for a single patient are extracted first, then they are saved to the 
-        # database in the proper order.
+def cohort_patient_id(spec, folder, visit):
+    # Get a standardized ID and study from the folder name
+    pat_id = spec['patient_id'](folder)
+    if spec['study'] is None:
+        return pat_id
+    if isinstance(pat_id, tuple):
+        pat_id = pat_id[0]
+    return pat_id, spec['study'].format(visit=visit)
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
 
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(experiment_path, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    sheffield_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-                            dixon_clean = [sitedatapath, pat_id, ('Baseline', 0), series_desc]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            # Write to database.
-                            # db.copy(dixon, dixon_clean)
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def turku_ge_patients():
+def build_cohort(cohort, workers=1, visit='Baseline'):
 
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Turku", "Turku_Patients_GE")
-    sitedatapath = os.path.join(datapath, "Patients", "Turku") 
+    # Define input and output folders
+    spec = cohort_spec(cohort)
+    download = [folder.format(visit=visit) for folder in spec['download']]
+    sitedownloadpath = os.path.join(downloadpath, *download)
+    sitedatapath = os.path.join(datapath, *spec['database'])
     os.makedirs(sitedatapath, exist_ok=True)
 
     # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
+    record = data.swap_record() if spec['swap'] else None
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        pat_id, time_point = turku_ge_ibeat_patient_id(os.path.basename(patient))
+    # Find all patients - series that are already built are skipped in the build
+    patients = []
+    for patient in [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]:
+        pat_id, study_desc = cohort_patient_id(spec, os.path.basename(patient), visit)
 
         # Corrupted data
         if pat_id in EXCLUDE:
             continue
 
-        # If the study
-        dixon_clean_study = [sitedatapath, pat_id, (time_point, 0)]
-        if dixon_clean_study in db.studies(sitedatapath):
+        # Exceptions with unique folder structure
+        if (pat_id, study_desc) in spec['special']:
+            spec['special'][(pat_id, study_desc)]()
             continue
 
-        # Get the experiment directory
-        experiment_path = os.path.join(patient)
+        patients.append(patient)
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(experiment_path) if os.path.isfile(os.path.join(experiment_path, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
+    # Loop over all patients, skipping series that are already built
+    parallel.run_patients(
+        build_patient, patients, sitedatapath,
+        os.path.join(stagingpath, download[-1]), workers,
+        cohort=cohort, visit=visit, record=record,
+        sitemanifest=manifest.init(sitedatapath),
+    )
 
-        # Note:
-        # In Sheffield XNAT the Dixon series are not saved in the proper order, which looks messy in the database.
-        # So all series for a single patient are extracted first, then they are saved to the 
-        # database in the proper order.
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
+def build_patient(patient, sitedatapath, cohort, visit, record, sitemanifest):
 
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(experiment_path, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    turku_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-
-                            dixon_clean = dixon_clean_study + [series_desc]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            # Write to database.
-                            # db.copy(dixon, dixon_clean)
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def turku_ge_volunteers():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Turku", "Turku_Volunteers_GE_Repeatability")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
-
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
-
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        desc = {
-            'iBE-5128-251_V1': ('5128_C05', 'Visit1'),
-            'iBE-5128-252_V1': ('5128_C05', 'Visit2'),
-            'iBE-5128-253_V1': ('5128_C05', 'Visit3'),
-            'iBE-5128-251_V2': ('5128_C05', 'Visit4'),
-            'iBE-5128-261_V1': ('5128_C06', 'Visit1'),
-            'iBE-5128-262_V1': ('5128_C06', 'Visit2'),
-            'iBE-5128-263_V1': ('5128_C06', 'Visit3'),
-            'iBE-5128-264_V1': ('5128_C06', 'Visit4'),
-            'iBE-5128-271_V1': ('5128_C07', 'Visit1'),
-            'iBE-5128-281_V1': ('5128_C08', 'Visit1'),
-            'iBE-5128-282_V1': ('5128_C08', 'Visit2'),
-            'iBE-5128-283_V1': ('5128_C08', 'Visit3'),
-            'iBE-5128-281_V2': ('5128_C08', 'Visit4'),
-            'iBE-5128-291_V1': ('5128_C09', 'Visit1'),
-            'iBE-5128-292_V1': ('5128_C09', 'Visit2'),
-            'iBE-5128-293_V1': ('5128_C09', 'Visit3'),
-            'iBE-5128-294_V1': ('5128_C09', 'Visit4'),
-            'iBE-5128-301_V1': ('5128_C10', 'Visit1'),
-            'iBE-5128-301_V2': ('5128_C10', 'Visit2'),
-            'iBE-5128-301_V3': ('5128_C10', 'Visit3'),
-            'iBE-5128-301_V4': ('5128_C10', 'Visit4'),
-        }
-        desc = desc[os.path.basename(patient)]
-        pat_id = desc[0]
-        study = [sitedatapath, pat_id, (desc[1], 0)]
+    # Series that are already built
+    built = manifest.read(sitemanifest)
 
-        # If the study exists, skip
-        if study in db.studies(sitedatapath):
-            continue
+    # Get a standardized ID from the folder name
+    spec = cohort_spec(cohort)
+    pat_id, study_desc = cohort_patient_id(spec, os.path.basename(patient), visit)
+    study = [sitedatapath, pat_id, (study_desc, 0)]
 
-        # Get the experiment directory
-        experiment_path = os.path.join(patient)
+    # Get the experiment directory
+    experiment_path = patient
+    if spec['experiment']:
+        experiment = [f for f in os.listdir(patient) if os.path.isdir(os.path.join(patient, f))][0]
+        experiment_path = os.path.join(patient, experiment)
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(experiment_path) if os.path.isfile(os.path.join(experiment_path, f))]
+    # Find all zip series in the experiment and sort by series number
+    # Partial downloads (.part files) are left in place to be resumed
+    all_zip_series = [f for f in os.listdir(experiment_path) if not f.endswith('.part')]
+    all_zip_series = [f for f in all_zip_series if os.path.isfile(os.path.join(experiment_path, f))]
+    all_zip_series = [f for f in all_zip_series if not any(x in f for x in spec['exclude_zip'])]
+    if spec['sort']:
+        all_zip_series = [f for f in all_zip_series if f.endswith('.zip')]
         all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
-
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(experiment_path, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    turku_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-
-                            dixon_clean = study + [series_desc]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            # Write to database.
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def turku_ge_setup():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Turku", "Turku_GE_Setup_Tests")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
-
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
-
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        desc = {
-            'subject_1': ('5128_C11', 'Visit1'),
-        }
-        desc = desc[os.path.basename(patient)]
-        pat_id = desc[0]
-        study = [sitedatapath, pat_id, (desc[1], 0)]
-
-        # If the study
-        if study in db.studies(sitedatapath):
+    # Classify all series of the patient
+    pat_series = []
+    tmp_series = {} # keep the zip file of each series
+
+    for zip_series in all_zip_series:
+
+        # Get the name of the zip file without extension.
+        zip_name = os.path.splitext(zip_series)[0]
+
+        # Read the header only - the images are read when the series is written
+        zip_file = os.path.join(experiment_path, zip_series)
+        try:
+            header = dicomzip.read_header(zip_file)
+        except Exception as e:
+            logging.error(f"Patient {pat_id} - error reading {zip_name}: {e}")
+            header = None
+
+        # Add new series to the list. Some sites are named from the zip 
+        # name only, so a zip that cannot be read still takes its name 
+        # and the counters of the later series do not change.
+        try:
+            spec['series_desc'](zip_name, header, pat_series)
+        except Exception as e:
+            if header is not None:
+                logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
+            continue
+        if header is None:
             continue
 
-        # Get the experiment directory
-        experiment_path = os.path.join(patient)
-
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(experiment_path) if os.path.isfile(os.path.join(experiment_path, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
+        # Skip exceptions
+        if (pat_id, pat_series[-1]) in spec['skip_series']:
+            continue
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
+        # Save in dictionary
+        tmp_series[pat_series[-1]] = zip_file
 
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(experiment_path, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    turku_ge_setup_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-
-                            dixon_clean = study + [series_desc]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            # Write to database.
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-                                
-def turku_philips_patients():
+    # In some XNAT projects the Dixon series are not saved in the proper
+    # order, which looks messy in the database. These are written in
+    # the standard order.
+    if spec['ordered']:
+        all_series = [s for s in SERIES_ORDER if s in tmp_series]
+    else:
+        all_series = list(tmp_series)
+
+    # Write the series to the database, and record them in the manifest
+    # once all are written
+    try:
+        for series_desc in all_series:
+            if spec['split'] is None:
+                build_series(spec, study, series_desc, tmp_series[series_desc], record, built)
+            else:
+                build_split_series(spec, study, series_desc, tmp_series[series_desc], built)
+    finally:
+        manifest.save()
 
-    # Define input and output folders
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Turku","Turku_Patients_Philips")
-    sitedatapath = os.path.join(datapath, "Patients", "Turku_Philips")
-    os.makedirs(sitedatapath, exist_ok=True)
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database'):
+def build_series(spec, study, series_desc, zip_file, record, built):
 
-        # Get a standardized ID from the folder name
-        pat_id, time_point = turku_philips_ibeat_patient_id(os.path.basename(pat))
+    pat_id, study_desc = study[1], study[2][0]
+    sequence, image_type = split_series_desc(series_desc)
 
-        # Corrupted data
-        if pat_id in EXCLUDE:
-            continue
+    # Copy to the database using the harmonized names
+    dixon_clean = study + [(series_desc, 0)]
 
-        # Find all zip series and sort by series number
-        all_zip_series = [f for f in os.listdir(pat) if os.path.isfile(os.path.join(pat, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
+    # Perform fat-water swap if needed
+    if record is not None:
+        dixon_clean = swap_fat_water(record, dixon_clean, sequence, image_type)
 
-        # loop over all series
-        pat_series = []
-        for zip_series in all_zip_series:
+    # Skip the series if it is already built
+    shared = (pat_id, study_desc) in spec['split_on_xnat']
+    if manifest.is_current(built, dixon_clean, zip_file, shared):
+        return
 
-            # Get the name of the zip file without extension
-            zip_name = zip_series[:-4]
+    # Special cases with missing slices are interpolated
+    volume = spec['volume'].get((pat_id, study_desc, series_desc), dicomzip.volume)
+    try:
+        dixon = dicomzip.read(zip_file)
+        dixon_vol = volume(dixon)
+    except Exception as e:
+        logging.error(f"Patient {pat_id} - {series_desc}: {e}")
+        return
 
-            # Get the harmonized series name 
-            try:
-                turku_philips_add_series_name(zip_name, pat_series)
-            except Exception as e:
-                logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                continue
+    # Reconstruct axial ones
+    if (pat_id, study_desc, sequence) in spec['reslice']:
+        dixon_vol = dixon_vol.reslice(orient='coronal', spacing=1.5)
 
-            # Construct output series
-            study = [sitedatapath, pat_id, ('Baseline', 0)]
-            dixon_clean = {
-                'OP': study + [(pat_series[-1] + 'out_phase', 0)],
-                'IP': study + [(pat_series[-1] + 'in_phase', 0)],
-                'W': study + [(pat_series[-1] + 'water', 0)],
-                'F': study + [(pat_series[-1] + 'fat', 0)],
-            }
-
-            # If the series already exists, continue to the next
-            if dixon_clean['OP'] in db.series(study):
-                continue
+    write_series(dixon_vol, dixon_clean, dixon, zip_file, shared)
 
-            with tempfile.TemporaryDirectory() as temp_folder:
-
-                # Extract to a temporary folder and flatten it
-                os.makedirs(temp_folder, exist_ok=True)
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(pat, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Split series into in- and opposed phase
-                dixon = db.series(extract_to)[0]
-                try:
-                    dixon_split = db.split_series(dixon, 'ImageType', key=lambda x:x[2])
-                except Exception as e:
-                    logging.error(
-                        f"Error splitting Turku series {pat_id} "
-                        f"{os.path.basename(extract_to)}."
-                        f"The series is not included in the database.\n"
-                        f"--> Details of the error: {e}")
-                    continue
-                
-                # Check the image types
-                if len(dixon_split) == 1:
-                    logging.error(
-                        f"Turku patient {pat_id}, series "
-                        f"{os.path.basename(extract_to)}: "
-                        f"Only one image type found. Excluded from database.")
-                    continue    
-
-                # Write to the database using read/write volume to ensure proper slice order.
-                for split_series in dixon_split:
-                    try:
-                        vol = db.volume(split_series[1])
-                    except Exception as e:
-                        logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                    db.write_volume(vol, dixon_clean[split_series[0]], ref=split_series[1])
-
-
-def turku_philips_volunteers():
 
-    # Define input and output folders
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Turku", "Turku_volunteer_repeatability_study")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
+def split_dixon(spec, dixon):
+    # Split a series by EchoTime or by image type
+    if spec['split'] == 'EchoTime':
+        return dicomzip.split_series(dixon, 'EchoTime')
+    return dicomzip.split_series(dixon, 'ImageType', key=lambda x:x[2])
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for pat in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        desc = {
-            '5128-211': ('5128_C01', 'Visit1'),
-            '5128-212': ('5128_C01', 'Visit2'),
-            '5128-213': ('5128_C01', 'Visit3'),
-            '5128-214': ('5128_C01', 'Visit4'),
-            '5128-221': ('5128_C02', 'Visit1'),
-            '5128-222': ('5128_C02', 'Visit2'),
-            '5128-223': ('5128_C02', 'Visit3'),
-            '5128-224': ('5128_C02', 'Visit4'),
-            '5128-231': ('5128_C03', 'Visit1'),
-            '5128-232': ('5128_C03', 'Visit2'),
-            '5128-233': ('5128_C03', 'Visit3'),
-            '5128-234': ('5128_C03', 'Visit4'),
-            '5128-241': ('5128_C04', 'Visit1'),
-            '5128-242': ('5128_C04', 'Visit2'),
-            '5128-243': ('5128_C04', 'Visit3'),
-            '5128-244': ('5128_C04', 'Visit4'),
-        }
-        desc = desc[os.path.basename(pat)]
-        pat_id = desc[0]
-        study = [sitedatapath, pat_id, (desc[1], 0)]
 
-        # Find all zip series and sort by series number
-        all_zip_series = [f for f in os.listdir(pat) if os.path.isfile(os.path.join(pat, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
+def image_types(spec, dixon_split):
+    # Label a split series with the image types in IMAGE_TYPES. 
+    # Out_phase is the one with the smallest TE.
+    if spec['split'] == 'EchoTime':
+        dixon_split = sorted(dixon_split, key=lambda x: x[0])
+        return [(t, s) for t, (_, s) in zip(['OP', 'IP'], dixon_split)]
+    return dixon_split
 
-        # loop over all series
-        pat_series = []
-        for zip_series in all_zip_series:
 
-            # Get the name of the zip file without extension
-            zip_name = zip_series[:-4]
+def build_split_series(spec, study, sequence, zip_file, built):
 
-            # Get the harmonized series name 
-            try:
-                turku_philips_volunteers_add_series_name(pat_series)
-            except Exception as e:
-                logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                continue
+    pat_id, study_desc = study[1], study[2][0]
+    zip_name = os.path.basename(zip_file)[:-4]
 
-            # Construct output series
-            dixon_clean = {
-                'OP': study + [(pat_series[-1] + 'out_phase', 0)],
-                'IP': study + [(pat_series[-1] + 'in_phase', 0)],
-                'W': study + [(pat_series[-1] + 'water', 0)],
-                'F': study + [(pat_series[-1] + 'fat', 0)],
-            }
+    # Construct output series
+    if spec['split'] == 'EchoTime':
+        types = ['OP', 'IP']
+    else:
+        types = list(IMAGE_TYPES)
+    dixon_clean = {t: study + [(sequence + IMAGE_TYPES[t], 0)] for t in types}
 
-            # If the series already exists, continue to the next
-            if dixon_clean['OP'] in db.series(study):
-                continue
+    # If the series is already built, continue to the next
+    if is_built(built, dixon_clean.values(), zip_file):
+        return
 
-            with tempfile.TemporaryDirectory() as temp_folder:
-
-                # Extract to a temporary folder and flatten it
-                os.makedirs(temp_folder, exist_ok=True)
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(pat, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Split series into in- and opposed phase
-                dixon = db.series(extract_to)[0]
-                try:
-                    dixon_split = db.split_series(dixon, 'ImageType', key=lambda x:x[2])
-                except Exception as e:
-                    logging.error(
-                        f"Error splitting Turku series {pat_id} "
-                        f"{os.path.basename(extract_to)}."
-                        f"The series is not included in the database.\n"
-                        f"--> Details of the error: {e}")
-                    continue
-                
-                # Check the image types
-                if len(dixon_split) == 1:
-                    logging.error(
-                        f"Turku patient {pat_id}, series "
-                        f"{os.path.basename(extract_to)}: "
-                        f"Only one image type found. Excluded from database.")
-                    continue    
-
-                # Write to the database using read/write volume to ensure proper slice order.
-                for split_series in dixon_split:
-                    try:
-                        vol = db.volume(split_series[1])
-                    except Exception as e:
-                        logging.error(f"Patient {pat_id} - {pat_series[-1]}: {e}")
-                    db.write_volume(vol, dixon_clean[split_series[0]], ref=split_series[1])
-                    
-
-def bordeaux_patients(visit='Baseline'):
+    # Some zip files do not have all image types. Only the types in
+    # the zip file need to be built, which only needs the headers.
+    try:
+        contained = image_types(spec, split_dixon(spec, dicomzip.read_headers(zip_file)))
+    except Exception as e:
+        logging.error(f"Patient {pat_id} - error reading {zip_name}: {e}")
+        return
+    contained = {t: dixon_clean[t] for t, _ in contained if t in dixon_clean}
+    if contained != {} and is_built(built, contained.values(), zip_file):
+        return
 
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Bordeaux", f"Bordeaux_Patients_{visit}")
-    sitedatapath = os.path.join(datapath, "Patients", "Bordeaux") 
-    os.makedirs(sitedatapath, exist_ok=True)
+    # Read the series from the zip file
+    try:
+        dixon = dicomzip.read(zip_file)
+    except Exception as e:
+        logging.error(f"Patient {pat_id} - error reading {zip_name}: {e}")
+        return
 
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
+    # Split series into image types
+    try:
+        dixon_split = split_dixon(spec, dixon)
+    except Exception as e:
+        logging.error(
+            f"Error splitting series {pat_id} "
+            f"{zip_name}."
+            f"The series is not included in the database.\n"
+            f"--> Details of the error: {e}")
+        return
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
+    # Check the image types
+    if len(dixon_split) == 1:
+        logging.error(
+            f"Patient {pat_id}, series "
+            f"{zip_name}: "
+            f"Only one {spec['split']} found. Excluded from database.")
+        return
 
-        # Get a standardized ID from the folder name
-        pat_id = bordeaux_ibeat_patient_id(os.path.basename(patient))
+    # Special case with missing slices
+    if (pat_id, study_desc, sequence) in spec['write']:
+        spec['write'][(pat_id, study_desc, sequence)](dixon_split, study[0], zip_file)
+        return
 
-        # Corrupted data
-        if pat_id in EXCLUDE:
+    # Write to the database using read/write volume to ensure proper 
+    # slice order. Each image type is written separately, so one that
+    # cannot be read does not prevent the others from being written.
+    for t, s in image_types(spec, dixon_split):
+        if t not in dixon_clean:
+            logging.error(f"Patient {pat_id} - {sequence}: unknown image type {t}.")
             continue
-
-        # If the study already exists, continue to the next
-        dixon_clean_study = [sitedatapath, pat_id, (visit, 0)]
-        if dixon_clean_study in db.studies([sitedatapath, pat_id]):
+        if manifest.is_current(built, dixon_clean[t], zip_file):
             continue
-
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(patient) if os.path.isfile(os.path.join(patient, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
-
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
-
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(patient, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    bordeaux_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-                            dixon_clean = dixon_clean_study + [series_desc]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def bordeaux_volunteers():
-
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Bordeaux", f"Bordeaux_Volunteers_Repeatability_Baseline")
-    sitedatapath = os.path.join(datapath, "Controls") 
-    os.makedirs(sitedatapath, exist_ok=True)
-
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
-
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        pat_id = '2128_C01'
-        study_desc = {
-            'Bordeaux_Volunteers_Repeatability_Baseline': 'Visit3',
-            'TEST_RETEST_001': 'Visit1',
-            'TEST_RETEST_002': 'Visit2',
-            'TEST_RETEST_004_1': 'Visit4',
-        }
-        study_desc = study_desc[os.path.basename(patient)]
-
-        # If the study already exists, continue to the next
-        dixon_clean_study = [sitedatapath, pat_id, (study_desc, 0)]
-        if dixon_clean_study in db.studies([sitedatapath, pat_id]):
+        try:
+            vol = dicomzip.volume(s)
+        except Exception as e:
+            logging.error(f"Patient {pat_id} - {sequence}{IMAGE_TYPES[t]}: {e}")
             continue
+        write_series(vol, dixon_clean[t], s, zip_file)
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(patient) if os.path.isfile(os.path.join(patient, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
-
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
-
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(patient, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    bordeaux_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-                            dixon_clean = dixon_clean_study + [series_desc]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def exeter_interpolate_vol(series):
-
-    # Need these values to build the affine
-    aff = ['ImageOrientationPatient', 'ImagePositionPatient', 'PixelSpacing', 'SliceThickness']
-    # Interpolate missing slices - out-phase
-    arr, crd, val = db.pixel_data(series, dims='SliceLocation', coords=True, attr=aff)
-    i0 = np.where(crd[0,1:]-crd[0,:-1]==3)[0][0]
-    # Interpolate missing slices
-    pixel_data = np.zeros(arr.shape[:2] + (arr.shape[2]+1, ))
-    pixel_data[:,:,:i0+1] = arr[:,:,:i0+1]
-    pixel_data[:,:,i0+1] = (1/2) * arr[:,:,i0] + (1/2) * arr[:,:,i0+1]
-    pixel_data[:,:,i0+2:] = arr[:,:,i0+1:]
-    # Create volume 
-    affine = db.affine_matrix(
-        val['ImageOrientationPatient'][0], 
-        val['ImagePositionPatient'][0], 
-        val['PixelSpacing'][0], 
-        val['SliceThickness'][0])
-    return vreg.volume(pixel_data, affine)
-
+    # # Predict fat and water
+    # # ---------------------
+    # This works but the results are poor
+    # Uncomment when the method has been improved
 
-def exeter_111():
+    # try:
+    #     out_phase = db.volume(out_phase_clean)
+    #     in_phase = db.volume(in_phase_clean)
+    # except Exception as e:
+    #     logging.error(
+    #         f"Patient {pat_id}: error predicting fat-water separation. "
+    #         f"Cannot read out-phase or in-phase volumes: {e}")
+    #     return
+    # array = np.stack((out_phase.values, in_phase.values), axis=-1)
+    # fw = miblab.kidney_dixon_fat_water(array)
 
-    # In- and opposed phase combined in the same series
-    # No fat or water maps computed
-
-    visit = 'Baseline'
+    # # Save fat and water
+    # fat = [sitedatapath, pat_id, 'Baseline', pat_series[-1] + 'fat']
+    # water = [sitedatapath, pat_id, 'Baseline', pat_series[-1] + 'water']
+    # ref = out_phase_clean
+    # db.write_volume((fw['fat'], out_phase.affine), fat, ref)
+    # db.write_volume((fw['water'], out_phase.affine), water, ref)
 
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Exeter", f"Exeter_Patients_{visit}")
-    sitedatapath = os.path.join(datapath, "Patients", "Exeter") 
-    os.makedirs(sitedatapath, exist_ok=True)
 
-    patient = os.path.join(sitedownloadpath, 'iBE-3128-111')
-    pat_id = '3128_111'
+def leeds_patients(workers=1):
+    build_cohort('leeds_patients', workers)
 
-    # If the study already exists, continue to the next
-    dixon_clean_study = [sitedatapath, pat_id, (visit, 0)]
-    if dixon_clean_study in db.studies([sitedatapath, pat_id]):
-        return
-    
-    # Find all zip series in the experiment and sort by series number
-    all_zip_series = [f for f in os.listdir(patient) if os.path.isfile(os.path.join(patient, f))]
-    all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-    # Extract all series of the patient
-    with tempfile.TemporaryDirectory() as temp_folder:
-
-        for zip_series in all_zip_series:
-
-            # Get the name of the zip file without extension.
-            zip_name = zip_series[:-4]
-            
-            # Extract to a temporary folder and flatten it
-            try:
-                extract_to = os.path.join(temp_folder, zip_name)
-                with zipfile.ZipFile(os.path.join(patient, zip_series), 'r') as zip_ref:
-                    zip_ref.extractall(extract_to)
-            except Exception as e:
-                logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                continue
-            flatten_folder(extract_to)
+def leeds_setup(workers=1):
+    build_cohort('leeds_setup', workers)
 
-            # Read the series and split by TE
-            dixon = db.series(extract_to)[0]
-            dixon_split = db.split_series(dixon, 'EchoTime')
 
-            # Out_phase is the one with the smallest TE
-            if dixon_split[0][0] < dixon_split[1][0]:
-                out_phase = 0
-                in_phase = 1
-            else:
-                out_phase = 1
-                in_phase = 0
-
-            sequence='Dixon_1_' if zip_name=='series_04' else 'Dixon_post_contrast_1_'
-            study = [sitedatapath, pat_id, ('Baseline', 0)]
-            out_phase_clean = study + [(sequence + 'out_phase', 0)]
-            in_phase_clean = study + [(sequence + 'in_phase', 0)]
-
-            # Write to the database using read/write volume to ensure proper slice order.
-            try:
-                out_phase_vol = db.volume(dixon_split[out_phase][1])
-                in_phase_vol = db.volume(dixon_split[in_phase][1])
-            except Exception as e:
-                logging.error(f"Patient {pat_id} - {sequence}: {e}")
-            else:
-                db.write_volume(out_phase_vol, out_phase_clean, ref=dixon_split[out_phase][1])
-                db.write_volume(in_phase_vol, in_phase_clean, ref=dixon_split[in_phase][1])
+def leeds_repeatability(workers=1):
+    build_cohort('leeds_repeatability', workers)
 
 
+def bari_volunteers(workers=1):
+    build_cohort('bari_volunteers', workers)
 
-def exeter_patients(visit='Baseline'):
 
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Exeter", f"Exeter_Patients_{visit}")
-    sitedatapath = os.path.join(datapath, "Patients", "Exeter") 
-    os.makedirs(sitedatapath, exist_ok=True)
+def bari_patients(workers=1):
+    build_cohort('bari_patients', workers)
 
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
 
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
+def sheffield(workers=1):
+    build_cohort('sheffield', workers)
 
-        # Get a standardized ID from the folder name
-        pat_id = exeter_ibeat_patient_id(os.path.basename(patient))
 
-        # Corrupted data
-        if pat_id in EXCLUDE:
-            continue
+def turku_ge_patients(workers=1):
+    build_cohort('turku_ge_patients', workers)
 
-        if (visit, pat_id) == ('Baseline', '3128_111'):
-            exeter_111()
-            continue
 
-        # split over two folders - needs checking at series level (see below)
-        split_on_xnat = [('Baseline', '3128_039'), ('Baseline', '3128_107'), ('Followup', '3128_012'), ('Followup', '3128_031'), ('Followup', '3128_050')]
-        # If the study already exists, continue to the next
-        dixon_clean_study = [sitedatapath, pat_id, (visit, 0)]
-        if (visit, pat_id) not in  split_on_xnat: 
-            if dixon_clean_study in db.studies([sitedatapath, pat_id]):
-                continue
+def turku_ge_volunteers(workers=1):
+    build_cohort('turku_ge_volunteers', workers)
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(patient) if os.path.isfile(os.path.join(patient, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
+def turku_ge_setup(workers=1):
+    build_cohort('turku_ge_setup', workers)
 
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(patient, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    exeter_add_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-                            dixon_clean = dixon_clean_study + [(series_desc, 0)]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            # Exception for some cases - needs checking at series level
-                            if (visit, pat_id) in split_on_xnat: 
-                                if dixon_clean in db.series(dixon_clean_study):
-                                    continue
-                            try:
-                                # Special case with one missing slice - interpolate the gap
-                                if (visit=='Baseline') and (pat_id == '3128_044') and (series == 'Dixon_post_contrast') and (image_type=='in_phase'):
-                                    dixon_vol = exeter_interpolate_vol(dixon)
-                                elif (visit=='Baseline') and (pat_id == '3128_082') and (series == 'Dixon_post_contrast') and (image_type=='fat'):
-                                    dixon_vol = exeter_interpolate_vol(dixon)
-                                elif (visit=='Baseline') and (pat_id == '3128_120') and (series == 'Dixon_post_contrast') and (image_type=='out_phase'):
-                                    dixon_vol = exeter_interpolate_vol(dixon)
-                                else:
-                                    dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                # Reconstruct axial ones
-                                if (visit=='Baseline') and (pat_id == '3128_014') and (series == 'Dixon') and (counter==2):
-                                    dixon_vol = dixon_vol.reslice(orient='coronal', spacing=1.5)
-                                elif (visit=='Baseline') and (pat_id == '3128_086') and (series == 'Dixon_post_contrast') and (counter==1):
-                                    dixon_vol = dixon_vol.reslice(orient='coronal', spacing=1.5)
-                                elif (visit=='Baseline') and (pat_id == '3128_104') and (series == 'Dixon') and (counter==2):
-                                    dixon_vol = dixon_vol.reslice(orient='coronal', spacing=1.5)
-                                elif (visit=='Baseline') and (pat_id == '3128_104') and (series == 'Dixon_post_contrast') and (counter==1):
-                                    dixon_vol = dixon_vol.reslice(orient='coronal', spacing=1.5)
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def exeter_setup():
 
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Exeter", f"Exeter_setup_scans")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
+def turku_philips_patients(workers=1):
+    build_cohort('turku_philips_patients', workers)
 
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
-
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        desc = {
-            'TestPatient1': ('3128_C01', 'Visit1'),
-            'TestPatient2': ('3128_C02', 'Visit1'),
-            'TestPatient5': ('3128_C01', 'Visit2'),
-        }
-        pat_id, visit = desc[os.path.basename(patient)]
 
-        # If the study already exists, continue to the next
-        dixon_clean_study = [sitedatapath, pat_id, (visit, 0)]
-        if dixon_clean_study in db.studies([sitedatapath, pat_id]):
-            continue
+def turku_philips_volunteers(workers=1):
+    build_cohort('turku_philips_volunteers', workers)
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(patient) if os.path.isfile(os.path.join(patient, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
+def bordeaux_patients(visit='Baseline', workers=1):
+    build_cohort('bordeaux_patients', workers, visit)
 
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(patient, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    exeter_add_volunteer_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-                            dixon_clean = dixon_clean_study + [(series_desc, 0)]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
-
-
-def exeter_repeatability():
 
-    # Clean Leeds patient data
-    sitedownloadpath = os.path.join(downloadpath, "BEAt-DKD-WP4-Exeter", f"Exeter_Volunteer")
-    sitedatapath = os.path.join(datapath, "Controls")
-    os.makedirs(sitedatapath, exist_ok=True)
+def bordeaux_volunteers(workers=1):
+    build_cohort('bordeaux_volunteers', workers)
 
-    # Read fat-water swap record to avoid repeated reading at the end
-    record = os.path.join(os.getcwd(), 'src', 'data', 'fat_water_swap_record.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
-
-    # Loop over all patients
-    patients = [f.path for f in os.scandir(sitedownloadpath) if f.is_dir()]
-    for patient in tqdm(patients, desc='Building clean database'):
-
-        # Get a standardized ID from the folder name
-        desc = {
-            'TE37-001_V1': ('3128_C01', 'Visit3'),
-            'TE37-001_V2': ('3128_C01', 'Visit4'),
-            'TE37-001_V3': ('3128_C01', 'Visit5'),
-            'TE37-001_V4': ('3128_C01', 'Visit6'),
-            'TE37-001_V5': ('3128_C01', 'Visit7'),
-        }
-        desc = desc[os.path.basename(patient)]
-        pat_id = desc[0]
-        visit = desc[1]
 
-        # If the study already exists, continue to the next
-        dixon_clean_study = [sitedatapath, pat_id, (visit, 0)]
-        if dixon_clean_study in db.studies([sitedatapath, pat_id]):
-            continue
+def exeter_patients(visit='Baseline', workers=1):
+    build_cohort('exeter_patients', workers, visit)
 
-        # Find all zip series in the experiment and sort by series number
-        all_zip_series = [f for f in os.listdir(patient) if os.path.isfile(os.path.join(patient, f))]
-        all_zip_series = sorted(all_zip_series, key=lambda x: int(x[7:-4]))
 
-        # Extract all series of the patient
-        with tempfile.TemporaryDirectory() as temp_folder:
+def exeter_setup(workers=1):
+    build_cohort('exeter_setup', workers)
 
-            pat_series = []
-            tmp_series_folder = {} # keep a list of folders for each series
-    
-            for zip_series in all_zip_series:
-
-                # Get the name of the zip file without extension.
-                zip_name = zip_series[:-4]
-
-                # Extract to a temporary folder and flatten it
-                try:
-                    extract_to = os.path.join(temp_folder, zip_name)
-                    with zipfile.ZipFile(os.path.join(patient, zip_series), 'r') as zip_ref:
-                        zip_ref.extractall(extract_to)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error extracting {zip_name}: {e}")
-                    continue
-                flatten_folder(extract_to)
-
-                # Add new series to the list 
-                try:
-                    exeter_add_volunteer_series_desc(extract_to, pat_series)
-                except Exception as e:
-                    logging.error(f"Patient {pat_id} - error renaming {zip_name}: {e}")
-                    continue
-
-                # Save in dictionary
-                tmp_series_folder[pat_series[-1]] = extract_to
-
-
-            # Write the series to the database in the proper order
-            for series in ['Dixon', 'Dixon_post_contrast']:
-                for counter in [1,2,3]: # never more than 3 repetitions
-                    for image_type in ['out_phase', 'in_phase', 'fat', 'water']:
-                        series_desc = f'{series}_{counter}_{image_type}'
-                        if series_desc in tmp_series_folder:
-                            extract_to = tmp_series_folder[series_desc]
-                            # Copy to the database using the harmonized names
-                            dixon = db.series(extract_to)[0]
-                            dixon_clean = dixon_clean_study + [(series_desc, 0)]
-                            # Perform fat-water swap if needed
-                            dixon_clean = swap_fat_water(record, dixon_clean, f'{series}_{counter}', image_type)
-                            try:
-                                dixon_vol = db.volume(dixon)
-                            except Exception as e:
-                                logging.error(f"Patient {pat_id} - {series_desc}: {e}")
-                            else:
-                                db.write_volume(dixon_vol, dixon_clean, ref=dixon)
 
+def exeter_repeatability(workers=1):
+    build_cohort('exeter_repeatability', workers)
 
 
 def all():
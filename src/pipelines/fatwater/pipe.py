@@ -15,9 +15,7 @@ def run():
    # # for site in all_sites:
    # #    stage_0_restore.dixons('Patients', site)
 
-   # stage_1_waterdom.compute('Controls')
-   # for site in all_sites:
-   #    stage_1_waterdom.compute('Patients', site)
+   # stage_1_waterdom.compute_all()
    
    #stage_2_trainingdata.generate()
 
@@ -3,19 +3,104 @@ Compute water-dominance masks from data that have fat and water maps
 """
 
 import os
+import json
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from tqdm import tqdm
 import numpy as np
 import dbdicom as db
 
-
-
-def compute(group, site=None):
+from utils import dicomzip, manifest
+
+
+# Sites of each group
+SITES = {
+    'Controls': [None],
+    'Patients': ['Bordeaux', 'Bari', 'Leeds', 'Sheffield', 'Turku', 'Exeter'],
+}
+
+# Labels of the masks. Masks that were written with other labels are
+# only computed again with recompute=True.
+LABELS = {'air': 0, 'water_dominant': 1, 'fat_dominant': 2}
+
+# Voxels with a total signal (water + fat) below this fraction of the
+# mean total signal are considered air
+FOREGROUND = 0.2
+
+
+def water_dominance(water:np.ndarray, fat:np.ndarray, threshold=FOREGROUND,
+                    chunk_size=16) -> np.ndarray:
+    """Label water- and fat-dominant voxels.
+
+    The arrays are processed a slab of slices at a time, so no
+    temporary arrays of the full volume are created.
+
+    Args:
+        water (np.ndarray): water map.
+        fat (np.ndarray): fat map with the same shape.
+        threshold (float, optional): fraction of the mean total signal
+          below which fat-dominant voxels are considered air.
+          Defaults to FOREGROUND.
+        chunk_size (int, optional): number of slices processed at once.
+          Defaults to 16.
+
+    Returns:
+        np.ndarray: uint8 label array (0=Air, 1=Water dominant,
+        2=Fat dominant).
+    """
+    nz = water.shape[-1]
+
+    # Mean total signal, summed one slab at a time
+    total = 0
+    for k in range(0, nz, chunk_size):
+        total += np.sum(water[..., k:k+chunk_size], dtype=np.float64)
+        total += np.sum(fat[..., k:k+chunk_size], dtype=np.float64)
+    level = threshold * total / water.size
+
+    label_array = np.zeros(water.shape, dtype=np.uint8)
+    for k in range(0, nz, chunk_size):
+        wi = water[..., k:k+chunk_size]
+        fi = fat[..., k:k+chunk_size]
+        water_dominant = wi > fi
+        foreground = (wi + fi) > level
+        label_array[..., k:k+chunk_size] = np.where(water_dominant, 1, 2 * foreground)
+    return label_array
+
+
+def compute(group, site=None, workers=1, recompute=False):
+    """Compute the water-dominant masks of one site.
+
+    Args:
+        group (str): 'Controls' or 'Patients'.
+        site (str, optional): site, for patients. Defaults to None.
+        workers (int, optional): number of worker processes. If this
+          is None, all available cores are used. Defaults to 1.
+        recompute (bool, optional): delete and compute again the masks
+          that were written with other labels than LABELS. If this is
+          False they are kept, and logged. Defaults to False.
+    """
+    _compute([(group, site)], workers, recompute)
+
+
+def compute_all(workers=None, recompute=False):
+    """Compute the water-dominant masks of all sites in one pool.
+
+    Args:
+        workers (int, optional): number of worker processes. If this
+          is None, all available cores are used. Defaults to None.
+        recompute (bool, optional): delete and compute again the masks
+          that were written with other labels than LABELS. If this is
+          False they are kept, and logged. Defaults to False.
+    """
+    _compute([(group, site) for group in SITES for site in SITES[group]], workers, recompute)
+
+
+def _compute(sites, workers, recompute=False):
 
     # Define global paths
-    datapath = os.path.join(os.getcwd(), 'build', 'dixon', 'stage_2_data') 
-    waterdompath = os.path.join(os.getcwd(), 'build', 'fatwater', 'stage_1_waterdom') 
+    datapath = os.path.join(os.getcwd(), 'build', 'dixon', 'stage_2_data')
+    waterdompath = os.path.join(os.getcwd(), 'build', 'fatwater', 'stage_1_waterdom')
     os.makedirs(waterdompath, exist_ok=True)
 
     # Set up logging
@@ -25,54 +110,118 @@ def compute(group, site=None):
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
 
-    # Define site paths
-    if group == 'Controls':
-        sitedatapath = os.path.join(datapath, group) 
-        sitewaterdompath = os.path.join(waterdompath, group)
-    else:
-        sitedatapath = os.path.join(datapath, group, site)
-        sitewaterdompath = os.path.join(waterdompath, group, site)
-    os.makedirs(sitewaterdompath, exist_ok=True)
-
-    # Get all water series
-    series = db.series(sitedatapath)
-    series_water = [s for s in series if s[3][0][-5:]=='water']
-
-    # Loop over the fat series
-    existing_series = db.series(sitewaterdompath)
-    for series_wi in tqdm(series_water, desc='Computing water-dominant masks'):
-
-        # Patient and output study
-        patient = series_wi[1]
-        study = series_wi[2][0]
-        series_wi_desc = series_wi[3][0]
-        sequence = series_wi_desc[:-6] # remove '_water' suffix
-
-        # Skip if the water dominant map already already exists
-        waterdom_series = [sitewaterdompath, patient, (study, 0), (f'{sequence}_water_dominant', 0)]
-        if waterdom_series in existing_series:
-            continue
-
-        # Get corresponding fat series
-        series_fi = series_wi[:3] + [(sequence + '_fat', 0)]
-
-        # Read the fat and water volumes
-        try:
-            wi = db.volume(series_wi)
-            fi = db.volume(series_fi)
-        except Exception as e:
-            logging.error(f"Patient {patient} - error reading F-W {sequence}: {e}")
-            continue
-
-        # Compute water-dominant mask
-        try:
-            # Build label array (0=Air, 1=Water dominant, 2=Fat dominant)
-            label_array = np.zeros(wi.values.shape, dtype=np.int16)
-            label_array[wi.values > fi.values] = 1
-            #label_array[fat_dominant & foreground] = 2
-        except Exception as e:
-            logging.error(f"Error computing water-dominant mask for {patient} {sequence}: {e}")
-            continue
-        
-        db.write_volume((label_array, wi.affine), waterdom_series, ref=series_wi)
-
+    # Labels of the masks of each site
+    labels_file = os.path.join(waterdompath, 'labels.json')
+    labels = {}
+    if os.path.exists(labels_file):
+        with open(labels_file, 'r') as f:
+            labels = json.load(f)
+
+    # List the masks that need computing for all sites
+    jobs = []
+    for group, site in sites:
+
+        # Define site paths
+        if group == 'Controls':
+            sitedatapath = os.path.join(datapath, group)
+            sitewaterdompath = os.path.join(waterdompath, group)
+        else:
+            sitedatapath = os.path.join(datapath, group, site)
+            sitewaterdompath = os.path.join(waterdompath, group, site)
+
+        os.makedirs(sitewaterdompath, exist_ok=True)
+        existing_series = db.series(sitewaterdompath)
+
+        # Masks written with other labels, such as the earlier masks
+        # without fat-dominant voxels, are only deleted and computed
+        # again if this is asked for.
+        key = os.path.relpath(sitewaterdompath, waterdompath).replace(os.sep, '/')
+        if labels.get(key) != LABELS:
+            if existing_series == []:
+                labels[key] = LABELS
+                _save_labels(labels_file, labels)
+            elif recompute:
+                for series in existing_series:
+                    logging.info(f"Deleting {key} {series[1]} {series[2][0]} {series[3][0]} (labels {labels.get(key)}) to compute it with labels {LABELS}")
+                    manifest.delete(series)
+                existing_series = []
+                labels[key] = LABELS
+                _save_labels(labels_file, labels)
+            else:
+                logging.warning(
+                    f"{len(existing_series)} masks of {key} were written with labels "
+                    f"{labels.get(key)} rather than {LABELS}. These are kept - "
+                    f"compute with recompute=True to replace them."
+                )
+
+        # Get all water series. The files are listed here, so the
+        # workers never open a database: this rewrites its index, and
+        # workers doing so at the same time overwrite each other's index.
+        dbdata = db.open(sitedatapath)
+        series_water = [s for s in dbdata.series() if s[3][0][-5:]=='water']
+
+        # Loop over the water series
+        for series_wi in series_water:
+
+            # Patient and output study
+            patient = series_wi[1]
+            study = series_wi[2][0]
+            series_wi_desc = series_wi[3][0]
+            sequence = series_wi_desc[:-6] # remove '_water' suffix
+
+            # Skip if the water dominant map already already exists
+            waterdom_series = [sitewaterdompath, patient, (study, 0), (f'{sequence}_water_dominant', 0)]
+            if waterdom_series in existing_series:
+                continue
+
+            # Get corresponding fat series
+            series_fi = series_wi[:3] + [(sequence + '_fat', 0)]
+            try:
+                files = (dbdata.files(series_wi), dbdata.files(series_fi))
+            except Exception as e:
+                logging.error(f"Patient {patient} - error reading F-W {sequence}: {e}")
+                continue
+            jobs.append((series_wi, waterdom_series) + files)
+
+        dbdata.close()
+
+    # Compute the masks. Only the main process writes to the databases.
+    if workers is None:
+        workers = os.cpu_count()
+    desc = 'Computing water-dominant masks'
+    if workers <= 1:
+        for job in tqdm(jobs, desc=desc):
+            _write(job, _mask, job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_mask, job): job for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            _write(futures[future], future.result)
+
+
+def _mask(job):
+    # Read the fat and water volumes and compute the water-dominant mask
+    _, _, files_wi, files_fi = job
+    wi = dicomzip.volume(dicomzip.read_files(files_wi))
+    fi = dicomzip.volume(dicomzip.read_files(files_fi))
+    return water_dominance(wi.values, fi.values), wi.affine
+
+
+def _write(job, result, *args):
+    series_wi, waterdom_series, _, _ = job
+    patient = series_wi[1]
+    sequence = series_wi[3][0][:-6]
+    try:
+        label_array, affine = result(*args)
+    except Exception as e:
+        logging.error(f"Error computing water-dominant mask for {patient} {sequence}: {e}")
+        return
+    # dbdicom only stores int16 and uint16 arrays without rescaling
+    db.write_volume((label_array.astype(np.int16), affine), waterdom_series, ref=series_wi)
+
+
+def _save_labels(file, labels):
+    tmp = f'{file}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(labels, f, indent=1)
+    os.replace(tmp, file)
@@ -4,12 +4,19 @@ Compute water-dominance masks from data that have fat and water maps
 
 import os
 import logging
-import json
 
 from tqdm import tqdm
 import dbdicom as db
+from dbdicom import register
 
-def build_json(num_training):
+from utils import nifti, nnunet
+
+
+# Settings of the foreground crop, see nifti.foreground_box()
+CROP = {'threshold': 0.2, 'margin': 4}
+
+
+def build_json():
 
     trainingdatapath = os.path.join(os.getcwd(), 'build', 'fatwater', 'stage_2_trainingdata', 'nnUNet_raw')
     database = os.path.join(trainingdatapath, "Dataset011_iBEAtFatWater")
@@ -22,17 +29,30 @@ def build_json(num_training):
         }, 
         "labels": { 
             "background": 0,
-            "water_dominant": 1
+            "water_dominant": 1,
+            "fat_dominant": 2
         }, 
-        "numTraining": num_training, 
         "file_ending": ".nii.gz"
     }
-    json_file = os.path.join(database, 'dataset.json')
-    with open(json_file, 'w') as f:
-        json.dump(json_data, f, indent=2)
 
+    # The number of training cases is taken from the manifest
+    nnunet.build_json(database, json_data)
+
+
+def generate(workers=1, compresslevel=1, crop=False):
+    """Export the training data to the nnU-Net raw dataset.
 
-def generate():
+    Args:
+        workers (int, optional): number of worker processes. If this
+          is None, all available cores are used. Defaults to 1.
+        compresslevel (int, optional): gzip compression level.
+          Defaults to 1.
+        crop (bool, optional): crop the images and labels to the body
+          in the out-phase image. The crop offsets are recorded in
+          the manifest so predictions can be padded back with
+          nnunet.uncrop(). Cases exported with a different setting
+          are exported again. Defaults to False.
+    """
 
     # Data and results paths
     datapath = os.path.join(os.getcwd(), 'build', 'dixon', 'stage_2_data') 
@@ -54,53 +74,84 @@ def generate():
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
 
-    # Get water series
-    series = db.series(datapath)
-    series_water = [s for s in series if s[3][0][-5:]=='water']
-
-    # Loop over the fat series
-    num_training = 0
-    for series_wi in tqdm(series_water, desc='Writing training data'):
-
-        # Patient and output study
-        patient = series_wi[1]
-        study = series_wi[2][0]
-        series_wi_desc = series_wi[3][0]
-        sequence = series_wi_desc[:-6] # remove '_water' suffix
-
-        # Get out_phase/in_phase series and water dominant mask
-        series_op = series_wi[:3] + [(f'{sequence}_out_phase', 0)]
-        series_ip = series_wi[:3] + [(f'{sequence}_in_phase', 0)]
-        series_mask = [waterdompath, patient, (study, 0), (f'{sequence}_water_dominant', 0)]
-
-        # Define the file names of the niftis
-        case_id = f"{patient}_{study}_{sequence}"
-        file_op = os.path.join(images_tr, f"{case_id}_0000.nii.gz")
-        file_ip = os.path.join(images_tr, f"{case_id}_0001.nii.gz")
-        file_mask = os.path.join(labels_tr, f"{case_id}.nii.gz")
-
-        # Continue if the case has already been written
-        if os.path.exists(file_mask):
+    # The manifest records the source series of each case
+    exported_cases = nnunet.init(database)
+
+    # Site databases, e.g. Controls or Patients/Leeds
+    sites = ['Controls']
+    if os.path.isdir(os.path.join(waterdompath, 'Patients')):
+        sites += [f'Patients/{s}' for s in sorted(os.listdir(os.path.join(waterdompath, 'Patients')))]
+
+    # List the files of all cases that are new or have changed. There 
+    # is a case for each water dominant mask, so only the (small) 
+    # databases of masks need listing.
+    cases = {}
+    sources = {}
+    for site in sites:
+        sitedatapath = os.path.join(datapath, *site.split('/'))
+        sitewaterdompath = os.path.join(waterdompath, *site.split('/'))
+        if not os.path.isdir(sitewaterdompath):
             continue
-
-        # Save the inphase/outphase volumes, and the corresponding mask, as niftis
-        try:
-            db.to_nifti(series_op, file_op, verbose=0)
-        except Exception as e:
-            logging.error(f"Case{case_id}, out_phase: {e}\n")
-            continue
-        try:
-            db.to_nifti(series_ip, file_ip, verbose=0)
-        except Exception as e:
-            logging.error(f"Case{case_id}, in_phase: {e}\n")
-            continue
-        try:
-            db.to_nifti(series_mask, file_mask, verbose=0) 
-        except Exception as e:
-            logging.error(f"Case{case_id}, water_dominant: {e}\n")
-            continue
-        num_training += 1
-
-    build_json(num_training)
+        dbdata = db.open(sitedatapath)
+        dbmasks = db.open(sitewaterdompath)
+
+        for series_mask in tqdm(dbmasks.series(), desc=f'Listing training data ({site})'):
+
+            # Patient and output study
+            patient = series_mask[1]
+            study = series_mask[2][0]
+            sequence = series_mask[3][0][:-15] # remove '_water_dominant' suffix
+
+            # Get out_phase/in_phase series
+            series_op = [sitedatapath, patient, (study, 0), (f'{sequence}_out_phase', 0)]
+            series_ip = [sitedatapath, patient, (study, 0), (f'{sequence}_in_phase', 0)]
+
+            # Define the file names of the niftis
+            case_id = f"{patient}_{study}_{sequence}"
+            file_op = os.path.join(images_tr, f"{case_id}_0000.nii.gz")
+            file_ip = os.path.join(images_tr, f"{case_id}_0001.nii.gz")
+            file_mask = os.path.join(labels_tr, f"{case_id}.nii.gz")
+
+            # Continue if the case has already been written from the same series
+            try:
+                series = {
+                    'out_phase': register.series_uid(dbdata.register, series_op),
+                    'in_phase': register.series_uid(dbdata.register, series_ip),
+                    'water_dominant': register.series_uid(dbmasks.register, series_mask),
+                }
+            except Exception as e:
+                logging.error(f"Case{case_id}: {e}\n")
+                continue
+            if nnunet.is_current(exported_cases, case_id, series, database, cropped=crop):
+                continue
+
+            # Save the inphase/outphase volumes, and the corresponding mask, as niftis
+            cases[case_id] = [
+                ('out_phase', dbdata.files(series_op), file_op),
+                ('in_phase', dbdata.files(series_ip), file_ip),
+                ('water_dominant', dbmasks.files(series_mask), file_mask),
+            ]
+            sources[case_id] = site
+
+        dbdata.close()
+        dbmasks.close()
+
+    exported = nifti.export(cases, workers, compresslevel, desc='Writing training data',
+                             crop=CROP if crop else None)
+
+    # Record the new cases in the manifest
+    entries = {}
+    for case_id, files in exported.items():
+        entries[case_id] = {
+            'site': sources[case_id],
+            'series': {name: f['SeriesInstanceUID'] for name, f in files.items()},
+            'files': {
+                os.path.relpath(f['file'], database).replace(os.sep, '/'): f['sha256'] 
+                for f in files.values()
+            },
+            'crop': files['out_phase'].get('crop'),
+        }
+    nnunet.update(database, entries)
+    build_json()
 
 
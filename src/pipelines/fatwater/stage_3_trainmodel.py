@@ -1,6 +1,8 @@
 import os
 import subprocess
 
+from utils import nnunet_jobs
+
 
 path = os.path.join(os.getcwd(), 'build', 'fatwater', 'stage_2_trainingdata')
 trainingdatapath = os.path.join(path, 'nnUNet_raw')
@@ -9,7 +11,27 @@ preprocpath = os.path.join(path, 'nnUNet_preprocessed')
 resultspath = os.path.join(path, 'nnUNet_results')
 
 
-def train(cont=False):
+def train(cont=False, folds=(0, 1, 2, 3, 4), device=None, trainer='nnUNetTrainer', **kwargs):
+    """Train all folds, as many at once as the hardware allows.
+
+    Logs and timings of each fold are saved in the logs folder of the
+    results.
+
+    Args:
+        cont (bool, optional): continue from the latest checkpoints,
+          skipping folds that have finished. Defaults to False.
+        folds (tuple, optional): folds to train. Defaults to all five.
+        device (str, optional): 'cpu' or 'cuda'. Defaults to 'cuda' if
+          a GPU is available, and 'cpu' otherwise.
+        trainer (str, optional): nnU-Net trainer class. For a quick 
+          smoke test on the CPU use e.g. 'nnUNetTrainer_1epoch'. 
+          Defaults to 'nnUNetTrainer'.
+        kwargs: hardware limits passed to nnunet_jobs.plan(), e.g. 
+          cpus or memory.
+
+    Returns:
+        list: timing of each fold that was run.
+    """
 
     # Ensure folders exist
     os.makedirs(preprocpath, exist_ok=True)
@@ -17,39 +39,26 @@ def train(cont=False):
 
     # Define environment variables
     # https://github.com/MIC-DKFZ/nnUNet/blob/master/documentation/installation_instructions.md
-    os.environ["nnUNet_raw"] = trainingdatapath
-    os.environ["nnUNet_preprocessed"] = preprocpath
-    os.environ["nnUNet_results"] = resultspath
-    os.environ['nnUNet_n_proc_DA'] = '2' # depends on hardware
+    env = {
+        "nnUNet_raw": trainingdatapath,
+        "nnUNet_preprocessed": preprocpath,
+        "nnUNet_results": resultspath,
+    }
+    if device is None:
+        device = 'cuda' if nnunet_jobs.available_gpus() > 0 else 'cpu'
 
     # https://github.com/MIC-DKFZ/nnUNet/blob/master/documentation/how_to_use_nnunet.md
-    for FOLD in [0, 1, 2, 3, 4]:
-        cmd = [
-            "nnUNetv2_train",
-            "011",
-            "3d_fullres",
-            str(FOLD),
-            "--npz",
-        ]
-        if cont:
-            cmd.append("--c")
-
-        process = subprocess.Popen(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.STDOUT, 
-            text=True, 
-            encoding="utf-8",   # <-- force UTF-8 decoding
-            errors="replace"    # <-- avoids crash if weird bytes appear
-        )
-
-        # Stream logs in real-time
-        for line in process.stdout:
-            print(line, end="")
-
-        process.wait()  # wait for completion
-
-train()
+    return nnunet_jobs.train_folds(
+        "011", 
+        "3d_fullres", 
+        folds, 
+        os.path.join(resultspath, 'logs'), 
+        env=env, 
+        cont=cont, 
+        device=device, 
+        trainer=trainer, 
+        **kwargs,
+    )
 
 
 
@@ -64,7 +73,12 @@ def preprocess():
     os.environ["nnUNet_raw"] = trainingdatapath
     os.environ["nnUNet_preprocessed"] = preprocpath
     os.environ["nnUNet_results"] = resultspath
-    os.environ['nnUNet_n_proc_DA'] = '10' # depends on hardware
+
+    # One preprocessing process per core, as far as memory allows
+    processes = min(
+        nnunet_jobs.available_cpus(), 
+        nnunet_jobs.available_memory() // nnunet_jobs.MEMORY_PER_WORKER,
+    )
 
     # https://github.com/MIC-DKFZ/nnUNet/blob/master/documentation/how_to_use_nnunet.md
 
@@ -74,6 +88,8 @@ def preprocess():
         "011",
         "-c", 
         "3d_fullres",
+        "-np",
+        str(max(1, processes)),
         "--verify_dataset_integrity",
     ]
 
@@ -0,0 +1,140 @@
+"""Store biomarkers in a Parquet table with one row per value, partitioned by site"""
+
+import os
+import time
+import uuid
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# Columns of the table, and their types
+SCHEMA = pa.schema([
+    ('site', pa.string()),
+    ('patient', pa.string()),
+    ('study', pa.string()),
+    ('roi', pa.string()),
+    ('parameter', pa.string()),
+    ('value', pa.float64()),
+    ('unit', pa.string()),
+    ('description', pa.string()),
+    ('dtype', pa.string()),
+])
+
+
+def rows(features:dict, site, patient, study) -> pd.DataFrame:
+    """Convert features to rows of the biomarker table.
+
+    Args:
+        features (dict): features as returned by the functions in
+          utils.radiomics, with keys roi-feature and values
+          [value, description, unit, dtype].
+        site (str): site.
+        patient (str): patient ID.
+        study (str): study description.
+
+    Returns:
+        pd.DataFrame: one row per feature. Values that are not numbers
+        are stored as missing values, and logged.
+    """
+    parameter = list(features.keys())
+    values = list(features.values())
+    raw = pd.Series([v[0] for v in values], dtype=object)
+    value = pd.to_numeric(raw, errors='coerce')
+    invalid = [f'{p}={v!r}' for p, v, x in zip(parameter, raw, value.isna() & raw.notna()) if x]
+    if invalid != []:
+        logging.warning(f"Non-numeric values of {site} {patient} {study} stored as missing: {', '.join(invalid)}")
+    table = pd.DataFrame({
+        'site': site,
+        'patient': patient,
+        'study': study,
+        'roi': [p.split('-')[0] for p in parameter],
+        'parameter': parameter,
+        'value': value.to_numpy(dtype=np.float64),
+        'unit': [v[2] for v in values],
+        'description': [v[1] for v in values],
+        'dtype': [v[3] for v in values],
+    }, columns=SCHEMA.names)
+    return table
+
+
+def append(path, table:pd.DataFrame):
+    """Append rows to the biomarker table.
+
+    Each batch is written as a new file in the folder of its site, so
+    appending never rewrites existing data.
+
+    Args:
+        path (str): folder of the biomarker table.
+        table (pd.DataFrame): rows as returned by rows().
+    """
+    for site, batch in table.groupby('site', sort=False):
+        sitepath = os.path.join(path, f'site={site}')
+        os.makedirs(sitepath, exist_ok=True)
+        batch = pa.Table.from_pandas(batch[SCHEMA.names], schema=SCHEMA, preserve_index=False)
+        # The site is stored in the folder name
+        batch = batch.drop_columns(['site'])
+        # Files are named in the order they are written, so later batches
+        # are read last. Write to a temporary file first so readers never
+        # see a partial file. Its name starts with a dot so readers skip it.
+        name = f'part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet'
+        file = os.path.join(sitepath, name)
+        tmp = os.path.join(sitepath, f'.{name}.tmp')
+        pq.write_table(batch, tmp)
+        os.replace(tmp, file)
+
+
+def read(path, columns=None, **filters) -> pd.DataFrame:
+    """Read the biomarker table.
+
+    Filters are applied while reading, so only the matching files and
+    rows are loaded.
+
+    Args:
+        path (str): folder of the biomarker table.
+        columns (list, optional): columns to read. Defaults to all.
+        filters: values of columns to select, e.g. site='Leeds' or
+          roi=['kidney_left', 'kidney_right'].
+
+    Returns:
+        pd.DataFrame: selected rows of the table, with the rows of each
+        site in the order they were appended.
+    """
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=SCHEMA.names if columns is None else columns)
+    conditions = []
+    for col, val in filters.items():
+        if isinstance(val, (list, tuple, set)):
+            conditions.append((col, 'in', list(val)))
+        else:
+            conditions.append((col, '==', val))
+    # The schema is given so that a folder without any data files
+    # reads as an empty table with all columns.
+    table = pq.read_table(
+        path,
+        schema=SCHEMA,
+        columns=columns,
+        filters=conditions if conditions else None,
+        partitioning=ds.partitioning(pa.schema([('site', pa.string())]), flavor='hive'),
+    )
+    return table.to_pandas()
+
+
+def wide(table:pd.DataFrame, index=('site', 'patient', 'study')) -> pd.DataFrame:
+    """Pivot the biomarker table to one row per study and one column per parameter.
+
+    Args:
+        table (pd.DataFrame): rows as returned by read().
+        index (tuple, optional): columns identifying a row of the
+          result. Defaults to ('site', 'patient', 'study').
+
+    Returns:
+        pd.DataFrame: wide table. If a parameter is repeated for the
+        same index, the last value is used.
+    """
+    table = table.drop_duplicates(subset=list(index) + ['parameter'], keep='last')
+    return table.pivot(index=list(index), columns='parameter', values='value')
@@ -4,19 +4,73 @@ import os
 import csv
 
 
+# Records that have been read, with the mtime of the file at the time
+_records = {}
+
+
+def _record(file, ncols):
+    # Read a csv file in src/data into a dictionary indexed by the
+    # patient, study (and series) columns. The result is cached until
+    # the file is modified.
+    path = os.path.join(os.getcwd(), 'src', 'data', file)
+    mtime = os.path.getmtime(path)
+    if path in _records:
+        if _records[path][0] == mtime:
+            return _records[path][1]
+    index = {}
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader) # skip header
+        for row in reader:
+            # If a row is repeated the first one is used
+            index.setdefault(tuple(row[1:1+ncols]), row)
+    _records[path] = (mtime, index)
+    return index
+
+
 def dixon_record():
-    record = os.path.join(os.getcwd(), 'src', 'data', 'dixon_data.csv')
-    with open(record, 'r') as file:
-        reader = csv.reader(file)
-        record = [row for row in reader]
-    return record
+    """Dixon record, indexed by (patient, study)."""
+    return _record('dixon_data.csv', 2)
 
 
 def dixon_series_desc(record, patient, study):
-    for row in record:
-        if row[1] == patient:
-            if row[2]==study:
-                return row[5]
-    raise ValueError(
-        f'Patient {patient}, study {study}: not found in src/data/dixon_data.csv'
-    )
\ No newline at end of file
+    """Selected dixon sequence of a study.
+
+    Args:
+        record (dict): dixon record as returned by dixon_record().
+        patient (str): patient ID.
+        study (str): study description.
+
+    Returns:
+        str: description of the selected sequence.
+    """
+    try:
+        return record[(patient, study)][5]
+    except KeyError:
+        raise ValueError(
+            f'Patient {patient}, study {study}: not found in src/data/dixon_data.csv'
+        )
+
+
+def swap_record():
+    """Fat-water swap record, indexed by (patient, study, series)."""
+    return _record('fat_water_swap_record.csv', 3)
+
+
+def fat_water_swapped(record, patient, study, series) -> bool:
+    """Check if fat and water are swapped in a dixon series.
+
+    Args:
+        record (dict): swap record as returned by swap_record().
+        patient (str): patient ID.
+        study (str): study description.
+        series (str): sequence, e.g. 'Dixon_post_contrast_1'.
+
+    Returns:
+        bool: True if fat and water are swapped. Series that are not in
+        the record are assumed not to be swapped.
+    """
+    row = record.get((patient, study, series))
+    if row is None:
+        return False
+    return row[4] == '1'
@@ -0,0 +1,307 @@
+"""Read DICOM series straight from zip files without extracting them"""
+
+import os
+import io
+import zipfile
+import tempfile
+
+import numpy as np
+import pydicom
+import vreg
+import dbdicom as db
+import dbdicom.dataset as dbdataset
+from dbdicom.dataset import get_values
+
+
+def read(zip_file):
+    """Read all DICOM images in a zip file into memory.
+
+    Args:
+        zip_file (str): path to the zip file.
+
+    Returns:
+        list: pydicom datasets, one per image. Files that are not
+        DICOM images are ignored.
+    """
+    series = []
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir():
+                continue
+            try:
+                ds = pydicom.dcmread(io.BytesIO(zip_ref.read(member)), force=True)
+            except Exception:
+                continue
+            if _is_image(ds):
+                series.append(ds)
+    if series == []:
+        raise ValueError(f"No DICOM images found in {zip_file}.")
+    return series
+
+
+def read_headers(zip_file):
+    """Read the headers of all DICOM images in a zip file.
+
+    Only the headers are decompressed, so this is much cheaper than
+    read() when only the attributes of the images are needed.
+
+    Args:
+        zip_file (str): path to the zip file.
+
+    Returns:
+        list: pydicom datasets without the pixel data, one per image.
+    """
+    headers = []
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir():
+                continue
+            with zip_ref.open(member) as file:
+                try:
+                    ds = pydicom.dcmread(file, stop_before_pixels=True, force=True)
+                except Exception:
+                    continue
+            if _is_image(ds):
+                headers.append(ds)
+    if headers == []:
+        raise ValueError(f"No DICOM images found in {zip_file}.")
+    return headers
+
+
+def read_header(zip_file):
+    """Read the header of the first DICOM image in a zip file.
+
+    Only the header of a single member is decompressed, so this is
+    cheap enough to decide what to do with a series before reading
+    it with read().
+
+    Args:
+        zip_file (str): path to the zip file.
+
+    Returns:
+        pydicom.Dataset: header without the pixel data.
+    """
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir():
+                continue
+            with zip_ref.open(member) as file:
+                try:
+                    ds = pydicom.dcmread(file, stop_before_pixels=True, force=True)
+                except Exception:
+                    continue
+            if _is_image(ds):
+                return ds
+    raise ValueError(f"No DICOM images found in {zip_file}.")
+
+
+def read_files(files:list) -> list:
+    """Read DICOM files on disk into memory.
+
+    With the files of a series listed by dbdicom.files(), this reads 
+    the series without opening its database. Opening a database 
+    rewrites its index, so this is the safe way to read series of the 
+    same database in parallel processes.
+
+    Args:
+        files (list): paths to DICOM files.
+
+    Returns:
+        list: pydicom datasets, one per file.
+    """
+    return [pydicom.dcmread(file) for file in files]
+
+
+def _is_image(ds):
+    # Same selection as a dbdicom folder scan: images only
+    if not isinstance(ds, pydicom.dataset.FileDataset):
+        return False
+    if 'TransferSyntaxUID' not in ds.file_meta:
+        return False
+    return 'Rows' in ds
+
+
+def split_series(series:list, attr:str, key=None) -> list:
+    """Split an in-memory series by the value of a DICOM attribute.
+
+    Args:
+        series (list): pydicom datasets to split.
+        attr (str): DICOM attribute to split the series by.
+        key (function, optional): split by key(attr). Defaults to None.
+
+    Returns:
+        list: list of two-element tuples, where the first element is the
+        value and the second element is the list of datasets with
+        that value.
+    """
+    values = []
+    split = []
+    for ds in series:
+        v = get_values(ds, [attr])[0]
+        if key is not None:
+            v = key(v)
+        if v in values:
+            split[values.index(v)].append(ds)
+        else:
+            values.append(v)
+            split.append([ds])
+    return list(zip(values, split))
+
+
+def volume(series:list) -> vreg.Volume3D:
+    """Build a 3D volume from an in-memory series.
+
+    Slices are sorted and the affine is built in the same way as
+    dbdicom.volume() does for a series on disk.
+
+    Args:
+        series (list): pydicom datasets with one slice each.
+
+    Returns:
+        vreg.Volume3D:
+    """
+    volumes = [dbdataset.volume(ds) for ds in series]
+    locs = [get_values(ds, ['SliceLocation'])[0] for ds in series]
+
+    # Check that all orientations are the same
+    volumes = _check_slice_cosines(volumes, locs)
+
+    # Sort the slices by slice location
+    if len(set(locs)) != len(locs):
+        raise ValueError(
+            "Cannot build a single volume. Not all slices have a "
+            "different slice location."
+        )
+    inds = np.argsort(locs, kind='stable')
+    vols = np.empty(len(volumes), dtype=object)
+    vols[:] = volumes
+    vols = vols[inds]
+
+    # Infer spacing between slices from slice locations
+    _infer_slice_spacing(vols)
+
+    # Join 2D volumes into a 3D volume
+    return vreg.join(vols)
+
+
+# The slice sorting below follows dbdicom.volume() (dbdicom 0.3.21),
+# whose helpers are not part of the public API of the pinned dbdicom.
+
+def _check_slice_cosines(vols, locs):
+    # If the slice locations do not match the slice positions, the 
+    # vendor may define the slice vector as minus the cross product of 
+    # the row and column vectors.
+    if None in locs:
+        return vols
+    if _count_correct_slice_locations(vols, locs) == len(vols):
+        return vols
+    for v in vols:
+        v.affine[:3, 2] *= -1
+    if _count_correct_slice_locations(vols, locs) == len(vols):
+        return vols
+    # Otherwise flip back and use the default right-handed slice order
+    for v in vols:
+        v.affine[:3, 2] *= -1
+    return vols
+
+
+def _count_correct_slice_locations(vols, locs):
+    slice_cosine_0 = vols[0].affine[:3, 2]
+    cnt = 0
+    for i, v in enumerate(vols):
+        slice_cosine = v.affine[:3, 2]
+        if not np.array_equal(slice_cosine_0, slice_cosine):
+            raise ValueError(
+                "Cannot read volume: not all slices have the same orientation. "
+                "Split the series by ImageOrientationPatient and try again."
+            )
+        slice_loc = np.dot(v.affine[:3, 3], slice_cosine)
+        # precision 10-2 mm
+        if np.around(locs[i] - slice_loc, 2) == 0:
+            cnt += 1
+    return cnt
+
+
+def _infer_slice_spacing(vols):
+    # In case spacing between slices is not (correctly) encoded in 
+    # DICOM it is inferred from the slice positions.
+    if len(vols) == 1:
+        return
+    mat = vols[0].affine[:3, :3]
+    normal = mat[:, 2] / np.linalg.norm(mat[:, 2])
+    slice_loc = np.sort([np.dot(v.affine[:3, 3], normal) for v in vols])
+    # Round to 10 micrometer and check if unique
+    distances = np.unique(np.around(slice_loc[1:] - slice_loc[:-1], 2))
+    if len(distances) > 1:
+        raise ValueError(
+            'Cannot build a volume - spacings between slices are not unique.'
+        )
+    for v in vols:
+        v.affine[:3, 2] = normal * abs(distances[0])
+
+
+def pixel_data(series:list, attr:list=None) -> tuple:
+    """Pixel array of an in-memory series, sorted by slice location.
+
+    Unlike volume() this does not require the slices to be equally
+    spaced, so it can be used to repair series with missing slices.
+
+    Args:
+        series (list): pydicom datasets with one slice each.
+        attr (list, optional): DICOM attributes to return for each
+          slice. Defaults to None.
+
+    Returns:
+        tuple: 3D array, slice locations as an array of shape (1, n)
+        and, if attr is provided, a dictionary with a list of
+        values for each attribute.
+    """
+    locs = [get_values(ds, ['SliceLocation'])[0] for ds in series]
+    inds = np.argsort(locs)
+    arr = np.stack([dbdataset.pixel_data(series[i]) for i in inds], axis=-1)
+    crd = np.array(locs)[inds].reshape((1, -1))
+    if attr is None:
+        return arr, crd
+    val = {a: [get_values(series[i], [a])[0] for i in inds] for a in attr}
+    return arr, crd, val
+
+
+def affine_matrix(image_orientation, image_position, pixel_spacing, slice_spacing):
+    """Affine matrix of a slice from its DICOM header values.
+
+    Args:
+        image_orientation (list): ImageOrientationPatient
+        image_position (list): ImagePositionPatient
+        pixel_spacing (list): PixelSpacing
+        slice_spacing (float): distance between slices
+
+    Returns:
+        np.ndarray: 4x4 affine matrix
+    """
+    row_cosine = np.array(image_orientation[:3])
+    column_cosine = np.array(image_orientation[3:])
+    slice_cosine = np.cross(row_cosine, column_cosine)
+    affine = np.identity(4, dtype=np.float32)
+    affine[:3, 0] = row_cosine * pixel_spacing[1]
+    affine[:3, 1] = column_cosine * pixel_spacing[0]
+    affine[:3, 2] = slice_cosine * slice_spacing
+    affine[:3, 3] = image_position
+    return affine
+
+
+def write_volume(vol:vreg.Volume3D, series:list, ref:list):
+    """Write a volume to a DICOM database using an in-memory reference series.
+
+    This is dbdicom.write_volume() for a reference series that was read
+    with read(). Only the header of the first reference dataset is
+    needed, so that one file is written to a scratch folder to serve as
+    reference.
+
+    Args:
+        vol (vreg.Volume3D): Volume to write to the series.
+        series (list): DICOM series to write to.
+        ref (list): pydicom datasets of the reference series.
+    """
+    with tempfile.TemporaryDirectory() as temp_folder:
+        pydicom.dcmwrite(os.path.join(temp_folder, 'ref.dcm'), ref[0])
+        db.write_volume(vol, series, ref=db.series(temp_folder)[0])
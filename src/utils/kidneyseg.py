@@ -0,0 +1,111 @@
+"""Segment kidneys on Dixon data with the miblab models, keeping them warm between cases"""
+
+import os
+import time
+
+import numpy as np
+import torch
+import miblab
+
+
+# Models of miblab.kidney_pc_dixon()
+MODELS = ['nnunet', 'unetr']
+
+# Weights that have been loaded in this process, by file and device
+_weights = {}
+
+# Time spent reading weights from disk in this process, in seconds
+_load_time = 0.0
+
+# Number of torch threads of this process, once started
+_threads = None
+
+_torch_load = torch.load
+
+
+def start(threads=None):
+    """Prepare this process for segmenting a batch of cases.
+
+    Pins the number of torch CPU threads. Calling this again only 
+    changes the number of threads.
+
+    Args:
+        threads (int, optional): number of torch threads. Defaults to
+          the number of cores this process may use.
+    """
+    global _threads
+    if threads is None:
+        threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    _threads = threads
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError:
+        # Can only be set once, before any parallel work
+        pass
+
+
+def predict(array:np.ndarray, model='nnunet', verbose=False) -> tuple:
+    """Segment the kidneys of one case.
+
+    Weights are kept in memory after the first time they are loaded. 
+    The miblab models build their network for every case, but after 
+    the first case this no longer reads and deserialises the weights, 
+    so the time of each case is mostly inference. For this torch.load 
+    is replaced by a cached version, only while the model runs.
+
+    Args:
+        array (np.ndarray): 4D array with the out-phase, in-phase,
+          water and fat images stacked along the last axis.
+        model (str, optional): 'nnunet' or 'unetr'. Defaults to 'nnunet'.
+        verbose (bool, optional): passed to the model. Defaults to False.
+
+    Returns:
+        tuple: an int16 label array with the shape of the images, with
+        1 for the left kidney and 2 for the right kidney, and a
+        dictionary with the time spent loading weights ('load') and on
+        inference ('inference'), in seconds.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown model {model}. Use one of {MODELS}.")
+    if _threads is None:
+        start()
+    # The models may change the number of threads
+    torch.set_num_threads(_threads)
+    load_time = _load_time
+    t = time.perf_counter()
+    torch.load = _cached_load
+    try:
+        rois = miblab.kidney_pc_dixon(array, model=model, verbose=verbose)
+    finally:
+        torch.load = _torch_load
+    load = _load_time - load_time
+    timing = {
+        'load': load,
+        'inference': time.perf_counter() - t - load,
+    }
+    return _labels(rois), timing
+
+
+def _labels(rois):
+    # The models return a dictionary of binary masks. Combine them in
+    # one label array so both models write the same series.
+    left = np.asarray(rois['kidney_left']) != 0
+    right = np.asarray(rois['kidney_right']) != 0
+    return left.astype(np.int16) + 2 * right.astype(np.int16)
+
+
+def _cached_load(f, *args, **kwargs):
+    # torch.load() with a cache for weight files. The networks copy
+    # the weights into their own parameters, so the cached objects are
+    # never modified.
+    global _load_time
+    if not isinstance(f, (str, os.PathLike)) or not os.path.isfile(f):
+        return _torch_load(f, *args, **kwargs)
+    file = os.path.abspath(f)
+    key = (file, os.path.getmtime(file), repr(args), repr(sorted(kwargs.items())))
+    if key not in _weights:
+        t = time.perf_counter()
+        _weights[key] = _torch_load(f, *args, **kwargs)
+        _load_time += time.perf_counter() - t
+    return _weights[key]
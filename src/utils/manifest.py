@@ -0,0 +1,261 @@
+"""Record which source files each series of a DICOM database was built from"""
+
+import os
+import json
+import hashlib
+
+import dbdicom as db
+
+
+# Hashes of the sources in this process, by file, size and mtime
+_hashes = {}
+
+# Entries added in this process and not saved yet, by manifest file
+_pending = {}
+
+# Manifests checked for paths relative to the working directory
+_converted = set()
+
+
+def file(database):
+    """Path to the manifest of a DICOM database."""
+    return os.path.join(database, 'manifest.json')
+
+
+def key(series:list) -> str:
+    """Manifest key of a series, as patient/study/series."""
+    names = [e if isinstance(e, str) else e[0] for e in series[1:]]
+    return '/'.join(names)
+
+
+def init(database) -> str:
+    """Create the manifest of a database if it does not exist yet.
+
+    The series already in the database are included without a source.
+    They are considered up to date, so a database that was built
+    before the manifest existed is not rebuilt from scratch.
+
+    Source paths are stored relative to the database. Manifests that 
+    stored them relative to the working directory are converted.
+
+    Args:
+        database (str): path to the DICOM database.
+
+    Returns:
+        str: path to the manifest file.
+    """
+    manifest_file = file(database)
+    if not os.path.exists(manifest_file):
+        built = {}
+        if os.path.isdir(database):
+            built = {key(s): None for s in db.series(database)}
+        _save(manifest_file, built)
+    elif manifest_file not in _converted:
+        _convert(manifest_file, database)
+    _converted.add(manifest_file)
+    return manifest_file
+
+
+def read(manifest_file) -> dict:
+    """Read a manifest.
+
+    Args:
+        manifest_file (str): path to the manifest file.
+
+    Returns:
+        dict: one entry per series with the source path, size, mtime
+        and sha256 at the time the series was built. The path is 
+        relative to the database, see source_path().
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    return _load(manifest_file)
+
+
+def source_path(entry:dict, database) -> str:
+    """Path of the source of a manifest entry.
+
+    Args:
+        entry (dict): manifest entry.
+        database (str): path to the DICOM database of the manifest.
+
+    Returns:
+        str: path to the zip file or folder.
+    """
+    return os.path.normpath(os.path.join(database, entry['path']))
+
+
+def rebase(entry:dict, database, new_database) -> dict:
+    """Manifest entry of a series copied to another database.
+
+    Args:
+        entry (dict): manifest entry, or None.
+        database (str): path to the DICOM database of the entry.
+        new_database (str): path to the DICOM database it is copied to.
+
+    Returns:
+        dict: copy of the entry with the path relative to new_database.
+    """
+    if entry is None:
+        return None
+    return {**entry, 'path': _relpath(source_path(entry, database), new_database)}
+
+
+def is_current(built:dict, series:list, source, shared=False) -> bool:
+    """Check if a series is up to date with its source.
+
+    Args:
+        built (dict): manifest as returned by read().
+        series (list): series to check.
+        source (str): zip file or folder the series is built from.
+        shared (bool, optional): the series may also be built from 
+          another source, e.g. for a patient who was split over two 
+          folders on XNAT. If it was, it is current as long as that 
+          source still exists. Defaults to False.
+
+    Returns:
+        bool: False if the series needs (re)building.
+    """
+    entry = built.get(key(series))
+    if entry is None:
+        # Missing, or included from a database without manifest
+        return key(series) in built
+    database = series[0]
+    if entry['path'] != _relpath(source, database):
+        if shared:
+            return os.path.exists(source_path(entry, database))
+        # The source was renamed or replaced
+        return False
+    size, mtime = _stat(source)
+    if (size, mtime) == (entry['size'], entry['mtime']):
+        return True
+    # Only hash if the file was touched
+    return _hash(source) == entry['sha256']
+
+
+def add(manifest_file, series:list, source, shared=False):
+    """Record that a series was built from a source.
+
+    The entry is kept in memory until save() is called, so that the 
+    manifest is written once for all series of a patient rather than 
+    once for every series.
+
+    Args:
+        manifest_file (str): path to the manifest file.
+        series (list): series that was built.
+        source (str): zip file or folder the series was built from.
+        shared (bool, optional): the series may also be built from
+          another source, see is_current(). Defaults to False.
+    """
+    size, mtime = _stat(source)
+    entry = {
+        'path': _relpath(source, os.path.dirname(manifest_file)),
+        'size': size,
+        'mtime': mtime,
+        'sha256': _hash(source),
+    }
+    if shared:
+        entry['shared'] = True
+    _pending.setdefault(manifest_file, {})[key(series)] = entry
+
+
+def save():
+    """Save the entries added with add() since the last save."""
+    while _pending:
+        manifest_file, entries = _pending.popitem()
+        update(manifest_file, entries)
+
+
+def update(manifest_file, entries:dict):
+    """Add entries to a manifest, overwriting existing ones."""
+    built = read(manifest_file)
+    built.update(entries)
+    _save(manifest_file, built)
+
+
+def delete(series:list):
+    """Delete a series from its database so it can be rebuilt.
+
+    dbdicom keeps series, studies and patients without files in its
+    register. A series written with the same name is then added to a
+    second series rather than replacing it, and an empty patient 
+    cannot be created again. These are removed from the register.
+
+    Args:
+        series (list): series to delete.
+    """
+    dbd = db.open(series[0])
+    if key(series) in [key(s) for s in dbd.series(series[:3])]:
+        dbd.delete(series)
+        for patient in dbd.register[:]:
+            for study in patient['studies'][:]:
+                study['series'] = [s for s in study['series'] if s['instances'] != {}]
+                if study['series'] == []:
+                    patient['studies'].remove(study)
+            if patient['studies'] == []:
+                dbd.register.remove(patient)
+    dbd.close()
+
+
+def _load(manifest_file):
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def _save(manifest_file, built):
+    # Write to a temporary file first so readers never see a partial file
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    tmp = f'{manifest_file}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(built, f, indent=1)
+    os.replace(tmp, manifest_file)
+
+
+def _relpath(source, database):
+    return os.path.relpath(os.path.abspath(source), os.path.abspath(database))
+
+
+def _convert(manifest_file, database):
+    # Paths used to be stored relative to the working directory, which
+    # was the folder containing 'build'. These are made relative to the
+    # database if they do not resolve from there.
+    built = _load(manifest_file)
+    changed = False
+    for entry in built.values():
+        if entry is None or os.path.exists(source_path(entry, database)):
+            continue
+        if os.path.exists(entry['path']):
+            entry['path'] = _relpath(entry['path'], database)
+            changed = True
+    if changed:
+        _save(manifest_file, built)
+
+
+def _files(source):
+    if os.path.isdir(source):
+        # Partial downloads are not part of the source
+        return sorted(f.path for f in os.scandir(source) if f.is_file() and not f.name.endswith('.part'))
+    return [source]
+
+
+def _stat(source):
+    stats = [os.stat(f) for f in _files(source)]
+    if stats == []:
+        # Empty folder
+        return 0, 0.0
+    return sum(s.st_size for s in stats), max(s.st_mtime for s in stats)
+
+
+def _hash(source):
+    # A source with several series, such as a zip file with out-phase,
+    # in-phase, water and fat images, is only hashed once.
+    files = _files(source)
+    stamp = tuple((f, os.stat(f).st_size, os.stat(f).st_mtime) for f in files)
+    if stamp not in _hashes:
+        sha = hashlib.sha256()
+        for f in files:
+            with open(f, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    sha.update(chunk)
+        _hashes[stamp] = sha.hexdigest()
+    return _hashes[stamp]
@@ -0,0 +1,182 @@
+"""Export DICOM series to NIfTI files on a pool of worker processes"""
+
+import os
+import gzip
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+import pydicom
+from tqdm import tqdm
+import vreg
+
+from utils import dicomzip
+
+
+def write(vol:vreg.Volume3D, file, compresslevel=1):
+    """Write a volume to a NIfTI file.
+
+    The file is the same as vreg.write_nifti() writes. It is written to
+    a temporary file first and then renamed, so an interrupted write
+    never leaves a partial file.
+
+    Args:
+        vol (vreg.Volume3D): volume to write.
+        file (str): path to the .nii or .nii.gz file.
+        compresslevel (int, optional): gzip compression level for
+          .nii.gz files, from 1 (fastest) to 9 (smallest). Defaults to 1.
+
+    Returns:
+        str: sha256 of the file.
+    """
+    # vreg uses LPS coordinates, NIfTI uses RAS
+    affine = np.diag([-1, -1, 1, 1]) @ vol.affine
+    data = nib.Nifti1Image(vol.values, affine).to_bytes()
+    if file.endswith('.gz'):
+        data = gzip.compress(data, compresslevel=compresslevel)
+    tmp = f'{file}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, file)
+    return hashlib.sha256(data).hexdigest()
+
+
+def foreground_box(values:np.ndarray, threshold=0.2, margin=4, min_fraction=0.02) -> tuple:
+    """Find the box containing the body in an image.
+
+    Voxels brighter than a fraction of the mean intensity are
+    foreground. Planes where only a few voxels are foreground, such as
+    noise or artefacts in the air, are ignored.
+
+    Args:
+        values (np.ndarray): 3D image, e.g. an out-phase Dixon.
+        threshold (float, optional): fraction of the mean intensity
+          below which voxels are air. Defaults to 0.2.
+        margin (int, optional): number of voxels added around the
+          foreground on each side. Defaults to 4.
+        min_fraction (float, optional): minimum fraction of foreground
+          voxels for a plane to be included. Defaults to 0.02.
+
+    Returns:
+        tuple: slices of the box, one per axis. The full image if there
+        is no foreground.
+    """
+    foreground = values > threshold * np.mean(values, dtype=np.float64)
+    box = []
+    for axis in range(values.ndim):
+        other = tuple(a for a in range(values.ndim) if a != axis)
+        count = np.count_nonzero(foreground, axis=other)
+        planes = np.flatnonzero(count > min_fraction * values.size / values.shape[axis])
+        if planes.size == 0:
+            return tuple(slice(0, n) for n in values.shape)
+        start = max(int(planes[0]) - margin, 0)
+        stop = min(int(planes[-1]) + 1 + margin, values.shape[axis])
+        box.append(slice(start, stop))
+    return tuple(box)
+
+
+def crop(vol:vreg.Volume3D, box:tuple) -> vreg.Volume3D:
+    """Crop a volume to a box, keeping its position in space.
+
+    Args:
+        vol (vreg.Volume3D): volume to crop.
+        box (tuple): slices, one per axis, as returned by
+          foreground_box().
+
+    Returns:
+        vreg.Volume3D: cropped volume.
+    """
+    offset = [b.start for b in box]
+    affine = vol.affine.copy()
+    affine[:3, 3] += affine[:3, :3] @ offset
+    return vreg.volume(vol.values[box], affine)
+
+
+def export(cases:dict, workers=1, compresslevel=1, desc='Exporting to NIfTI',
+           crop=None):
+    """Export cases of DICOM series to NIfTI.
+
+    The files of a case are written in the order they are listed, each
+    one atomically. If the last file of a case exists, all others do
+    too.
+
+    If crop is provided, all series of a case are cropped to the 
+    foreground of the first series, so they stay aligned voxel by
+    voxel. The series must have the same geometry.
+
+    Args:
+        cases (dict): for each case ID, a list of (name, dicom_files,
+          nifti_file) tuples. The DICOM files of each series can be
+          listed with dbdicom.files() or DataBaseDicom.files().
+        workers (int, optional): number of worker processes. If this
+          is None, all available cores are used. Defaults to 1.
+        compresslevel (int, optional): gzip compression level.
+          Defaults to 1.
+        desc (str, optional): description for the progress bar.
+        crop (dict, optional): keyword arguments of foreground_box(),
+          e.g. {'threshold': 0.2, 'margin': 4}. Defaults to None
+          (no cropping).
+
+    Returns:
+        dict: for each case that was exported, a dictionary with the 
+        nifti file, its sha256 and the SeriesInstanceUID of the source 
+        for each name. If the case was cropped, each also has the crop
+        offset and the shape of the source series under 'crop'.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    exported = {}
+    if workers <= 1:
+        for case_id, series in tqdm(cases.items(), desc=desc):
+            try:
+                exported[case_id] = _export_case(series, compresslevel, crop)
+            except Exception as e:
+                logging.error(f"Case{case_id}, {e}\n")
+        return exported
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_export_case, series, compresslevel, crop): case_id
+            for case_id, series in cases.items()
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            case_id = futures[future]
+            try:
+                exported[case_id] = future.result()
+            except Exception as e:
+                logging.error(f"Case{case_id}, {e}\n")
+    return exported
+
+
+def _export_case(series, compresslevel, crop_args=None):
+    # Read the DICOM files directly rather than through dbdicom, which
+    # rewrites the index of the database every time it is opened.
+    exported = {}
+    box = None
+    for name, dicom_files, nifti_file in series:
+        try:
+            datasets = [pydicom.dcmread(f) for f in dicom_files]
+            vol = dicomzip.volume(datasets)
+            if crop_args is not None:
+                # The first series defines the box for all others
+                if box is None:
+                    shape = vol.shape
+                    box = foreground_box(vol.values, **crop_args)
+                elif vol.shape != shape:
+                    raise ValueError(f"Shape {vol.shape} does not match {shape}.")
+                vol = crop(vol, box)
+            exported[name] = {
+                'file': nifti_file,
+                'sha256': write(vol, nifti_file, compresslevel),
+                'SeriesInstanceUID': datasets[0].SeriesInstanceUID,
+            }
+            if box is not None:
+                exported[name]['crop'] = {
+                    'offset': [b.start for b in box],
+                    'shape': list(shape),
+                }
+        except Exception as e:
+            raise RuntimeError(f"{name}: {e}")
+    return exported
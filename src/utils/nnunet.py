@@ -0,0 +1,197 @@
+"""Record the cases of an nnU-Net raw dataset and the series they were exported from"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def file(dataset):
+    """Path to the manifest of an nnU-Net raw dataset."""
+    return os.path.join(dataset, 'manifest.json')
+
+
+def init(dataset, file_ending='.nii.gz') -> dict:
+    """Read the manifest of a dataset, creating it if it does not exist.
+
+    Cases that are already in labelsTr are included without source
+    series. They are considered up to date, so a dataset that was
+    exported before the manifest existed is not exported again.
+
+    Args:
+        dataset (str): path to the dataset folder.
+        file_ending (str, optional): file ending of the images and
+          labels. Defaults to '.nii.gz'.
+
+    Returns:
+        dict: the manifest, as returned by read().
+    """
+    if os.path.exists(file(dataset)):
+        return read(dataset)
+    cases = {}
+    labels_tr = os.path.join(dataset, 'labelsTr')
+    images_tr = os.path.join(dataset, 'imagesTr')
+    if os.path.isdir(labels_tr):
+        images = sorted(os.listdir(images_tr)) if os.path.isdir(images_tr) else []
+        for label in sorted(os.listdir(labels_tr)):
+            if not label.endswith(file_ending):
+                continue
+            case_id = label[:-len(file_ending)]
+            files = [f'imagesTr/{f}' for f in images if f.startswith(f'{case_id}_')]
+            files.append(f'labelsTr/{label}')
+            cases[case_id] = {'site': None, 'series': None, 'files': {f: None for f in files}}
+    _save(dataset, cases)
+    return cases
+
+
+def read(dataset) -> dict:
+    """Read the manifest of a dataset.
+
+    Args:
+        dataset (str): path to the dataset folder.
+
+    Returns:
+        dict: one entry per case with the site, the SeriesInstanceUID
+        of each source series and the sha256 of each file, by path
+        relative to the dataset folder. Cropped cases also have the
+        crop offset and the shape of the source series.
+    """
+    if not os.path.exists(file(dataset)):
+        return {}
+    with open(file(dataset), 'r') as f:
+        return json.load(f)
+
+
+def is_current(cases:dict, case_id, series:dict, dataset, cropped=None) -> bool:
+    """Check if a case is up to date with its source series.
+
+    Args:
+        cases (dict): manifest as returned by read().
+        case_id (str): case to check.
+        series (dict): SeriesInstanceUID of each source series.
+        dataset (str): path to the dataset folder.
+        cropped (bool, optional): if this is provided, the case must
+          have been exported with (True) or without (False) cropping.
+          Defaults to None.
+
+    Returns:
+        bool: False if the case needs (re)exporting.
+    """
+    entry = cases.get(case_id)
+    if entry is None:
+        return False
+    if cropped is not None and cropped != (entry.get('crop') is not None):
+        return False
+    for f in entry['files']:
+        if not os.path.exists(os.path.join(dataset, f)):
+            return False
+    # Included from a dataset without manifest
+    if entry['series'] is None:
+        return True
+    return entry['series'] == series
+
+
+def uncrop(values:np.ndarray, crop:dict, fill=0) -> np.ndarray:
+    """Pad a cropped array, such as a prediction, back to its source.
+
+    Args:
+        values (np.ndarray): array with the geometry of the exported
+          case.
+        crop (dict): crop of the case, as recorded in the manifest,
+          with the offset and the shape of the source series.
+        fill (optional): value outside of the crop. Defaults to 0.
+
+    Returns:
+        np.ndarray: array with the shape of the source series.
+    """
+    array = np.full(crop['shape'], fill, dtype=values.dtype)
+    box = tuple(slice(o, o + n) for o, n in zip(crop['offset'], values.shape))
+    array[box] = values
+    return array
+
+
+def update(dataset, entries:dict):
+    """Add cases to the manifest, overwriting existing ones."""
+    cases = read(dataset)
+    cases.update(entries)
+    _save(dataset, cases)
+
+
+def remove(dataset, case_ids=None, site=None):
+    """Remove cases from a dataset, deleting their files.
+
+    Args:
+        dataset (str): path to the dataset folder.
+        case_ids (list, optional): cases to remove. Defaults to None.
+        site (str, optional): remove all cases of this site.
+          Defaults to None.
+    """
+    cases = read(dataset)
+    remove_ids = set() if case_ids is None else set(case_ids)
+    if site is not None:
+        remove_ids |= {c for c, entry in cases.items() if entry['site'] == site}
+    for case_id in remove_ids:
+        entry = cases.pop(case_id, None)
+        if entry is None:
+            continue
+        for f in entry['files']:
+            path = os.path.join(dataset, f)
+            if os.path.exists(path):
+                os.remove(path)
+    _save(dataset, cases)
+
+
+def verify(dataset) -> list:
+    """Check the files of all cases against their recorded sha256.
+
+    Args:
+        dataset (str): path to the dataset folder.
+
+    Returns:
+        list: IDs of the cases with missing or modified files. Files
+        without a recorded sha256 are only checked for existence.
+    """
+    invalid = []
+    for case_id, entry in read(dataset).items():
+        for f, sha256 in entry['files'].items():
+            path = os.path.join(dataset, f)
+            if not os.path.exists(path):
+                invalid.append(case_id)
+                break
+            if sha256 is not None and _hash(path) != sha256:
+                invalid.append(case_id)
+                break
+    return invalid
+
+
+def build_json(dataset, json_data:dict):
+    """Write dataset.json with the number of cases in the manifest.
+
+    Args:
+        dataset (str): path to the dataset folder.
+        json_data (dict): contents of dataset.json, except numTraining.
+    """
+    json_data = dict(json_data, numTraining=len(read(dataset)))
+    json_file = os.path.join(dataset, 'dataset.json')
+    tmp = f'{json_file}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(json_data, f, indent=2)
+    os.replace(tmp, json_file)
+
+
+def _save(dataset, cases):
+    # Write to a temporary file first so readers never see a partial file
+    os.makedirs(dataset, exist_ok=True)
+    tmp = f'{file(dataset)}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cases, f, indent=1, sort_keys=True)
+    os.replace(tmp, file(dataset))
+
+
+def _hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
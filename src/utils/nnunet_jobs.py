@@ -0,0 +1,343 @@
+"""Run nnU-Net training folds as jobs sized to the available hardware"""
+
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# Rough memory use of a 3d_fullres training process, without its data
+# augmentation workers, and of each data augmentation worker, in bytes
+MEMORY_PER_FOLD = 6 * 2**30
+MEMORY_PER_WORKER = 2**30
+
+# Minimum number of cores for a fold on the CPU. Folds on the CPU only
+# run concurrently if each gets at least this many.
+CORES_PER_CPU_FOLD = 4
+
+# Lines of the nnU-Net log that start and time an epoch
+EPOCH = re.compile(r'Epoch (\d+)\s*$')
+EPOCH_TIME = re.compile(r'Epoch time: ([\d.]+) s')
+
+# Serialises console output of concurrent folds
+_print_lock = threading.Lock()
+
+
+def available_cpus() -> int:
+    """Number of cores this process may use.
+
+    Takes into account the CPU affinity of the process and the CPU
+    quota of its cgroup, if any, so the result is also correct in
+    containers.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count()
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def available_memory() -> int:
+    """Memory available to this process in bytes.
+
+    This is the available memory of the host, limited by the memory
+    limit of the cgroup of the process, if any.
+    """
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if memory is None:
+        memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            with open('/sys/fs/cgroup/memory.current') as f:
+                used = int(f.read())
+            memory = min(memory, int(limit) - used)
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+def available_gpus() -> int:
+    """Number of CUDA devices, or 0 if torch is not installed."""
+    try:
+        import torch
+    except ImportError:
+        return 0
+    return torch.cuda.device_count()
+
+
+def plan(nfolds, device='cpu', cpus=None, memory=None, gpus=None,
+         memory_per_fold=MEMORY_PER_FOLD, memory_per_worker=MEMORY_PER_WORKER) -> dict:
+    """Decide how many folds to run at once and how to share the hardware.
+
+    On a GPU each fold gets its own device, and all its cores except
+    one run data augmentation. On the CPU folds only run concurrently
+    if each gets at least CORES_PER_CPU_FOLD cores, and half of the
+    cores of each fold run data augmentation.
+
+    Args:
+        nfolds (int): number of folds to train.
+        device (str, optional): 'cpu' or 'cuda'. Defaults to 'cpu'.
+        cpus (int, optional): number of cores. Defaults to
+          available_cpus().
+        memory (int, optional): memory in bytes. Defaults to
+          available_memory().
+        gpus (int, optional): number of GPUs. Defaults to
+          available_gpus().
+        memory_per_fold (int, optional): memory of a training process
+          in bytes. Defaults to MEMORY_PER_FOLD.
+        memory_per_worker (int, optional): memory of a data
+          augmentation worker in bytes. Defaults to MEMORY_PER_WORKER.
+
+    Returns:
+        dict: number of concurrent folds ('concurrent'), cores of each
+        fold ('cores'), and data augmentation workers of each fold
+        ('n_proc_DA').
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    if memory is None:
+        memory = available_memory()
+    if gpus is None:
+        gpus = available_gpus() if device == 'cuda' else 0
+
+    # Folds that fit in memory with at least one augmentation worker
+    concurrent = min(nfolds, memory // (memory_per_fold + memory_per_worker))
+    if device == 'cuda':
+        concurrent = min(concurrent, gpus, cpus // 2)
+    else:
+        concurrent = min(concurrent, cpus // CORES_PER_CPU_FOLD)
+    concurrent = max(1, concurrent)
+
+    cores = max(1, cpus // concurrent)
+    if device == 'cuda':
+        n_proc_DA = cores - 1
+    else:
+        n_proc_DA = cores // 2
+    # Workers that fit in the memory left by each fold
+    memory_left = memory // concurrent - memory_per_fold
+    n_proc_DA = max(1, min(n_proc_DA, memory_left // memory_per_worker))
+    return {'concurrent': concurrent, 'cores': cores, 'n_proc_DA': n_proc_DA}
+
+
+def train_folds(dataset, configuration, folds, logpath, env=None, cont=False,
+                device='cpu', trainer='nnUNetTrainer', plans='nnUNetPlans', 
+                **kwargs) -> list:
+    """Train nnU-Net folds, concurrently if the hardware allows.
+
+    The output of each fold is written to fold_<fold>.log in logpath.
+    The timing of each run of a fold is added to fold_<fold>.json: 
+    start and end time, wall-clock time, exit code, and the time of 
+    every epoch. 
+    
+    With cont=True, nnU-Net continues each fold from its latest 
+    checkpoint, the logs are appended to, and folds that have 
+    finished are skipped.
+
+    Args:
+        dataset (str): dataset ID or name, e.g. '011'.
+        configuration (str): nnU-Net configuration, e.g. '3d_fullres'.
+        folds (list): folds to train.
+        logpath (str): folder for the logs and timings.
+        env (dict, optional): environment variables for nnU-Net, e.g.
+          nnUNet_raw. Defaults to None.
+        cont (bool, optional): continue from the latest checkpoints.
+          Defaults to False.
+        device (str, optional): 'cpu' or 'cuda'. Defaults to 'cpu'.
+        trainer (str, optional): nnU-Net trainer class, e.g.
+          'nnUNetTrainer_5epochs' for smoke tests. Defaults to 
+          'nnUNetTrainer'.
+        plans (str, optional): nnU-Net plans identifier. Defaults to
+          'nnUNetPlans'.
+        kwargs: arguments of plan(), to override the detected hardware.
+
+    Returns:
+        list: timing of each fold that was run.
+    """
+    os.makedirs(logpath, exist_ok=True)
+    folds = list(folds)
+    if cont:
+        results = (env or os.environ).get('nnUNet_results')
+        folds = [f for f in folds if not _finished(results, dataset, configuration, f, trainer, plans)]
+    if folds == []:
+        return []
+    resources = plan(len(folds), device, **kwargs)
+
+    # Give each concurrent fold its own cores and GPU. The plan may be 
+    # for more cores than this process may use, if cpus is given, so 
+    # the cores of each fold are limited to its share of the real ones.
+    # With fewer real cores than folds, the folds share them in turn.
+    if hasattr(os, 'sched_getaffinity'):
+        allcores = sorted(os.sched_getaffinity(0))
+    else:
+        allcores = None
+    slots = []
+    for i in range(resources['concurrent']):
+        slot = {'gpu': i if device == 'cuda' else None, 'cores': None}
+        if allcores is not None and resources['concurrent'] > 1:
+            ncores = max(1, min(resources['cores'], len(allcores) // resources['concurrent']))
+            slot['cores'] = [allcores[(i*ncores + j) % len(allcores)] for j in range(ncores)]
+        slots.append(slot)
+    free_slots = list(slots)
+    slot_lock = threading.Lock()
+
+    def run(fold):
+        with slot_lock:
+            slot = free_slots.pop()
+        try:
+            return _train_fold(
+                dataset, configuration, fold, logpath, env, cont, device,
+                trainer, plans, resources['n_proc_DA'], slot)
+        finally:
+            with slot_lock:
+                free_slots.append(slot)
+
+    # Each thread only waits on its nnU-Net process
+    timings = {}
+    with ThreadPoolExecutor(max_workers=resources['concurrent']) as executor:
+        futures = {executor.submit(run, fold): fold for fold in folds}
+        for future in as_completed(futures):
+            fold = futures[future]
+            try:
+                timings[fold] = future.result()
+            except Exception as e:
+                logging.error(f"Error training fold {fold}: {e}")
+    return [timings[fold] for fold in folds if fold in timings]
+
+
+def _train_fold(dataset, configuration, fold, logpath, env, cont, device,
+                trainer, plans, n_proc_DA, slot):
+
+    cmd = [
+        "nnUNetv2_train",
+        str(dataset),
+        configuration,
+        str(fold),
+        "--npz",
+        "-device", device,
+        "-tr", trainer,
+        "-p", plans,
+    ]
+    if cont:
+        cmd.append("--c")
+
+    fold_env = dict(os.environ)
+    if env is not None:
+        fold_env.update(env)
+    fold_env['nnUNet_n_proc_DA'] = str(n_proc_DA)
+    if slot['gpu'] is not None:
+        # Number the GPUs by bus as nvidia-smi does, rather than fastest
+        # first, so each fold is on the GPU that is monitored for it
+        fold_env['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
+        fold_env['CUDA_VISIBLE_DEVICES'] = str(slot['gpu'])
+    launch = cmd
+    if slot['cores'] is not None:
+        fold_env['OMP_NUM_THREADS'] = str(len(slot['cores']))
+        # Keep the training threads and augmentation workers of the
+        # fold on its own cores. taskset sets this before nnU-Net
+        # starts, so all its threads and workers inherit it. Setting it
+        # in the child before exec (preexec_fn) is not safe when folds
+        # are started from threads.
+        if shutil.which('taskset') is not None:
+            launch = ['taskset', '-c', ','.join(str(c) for c in slot['cores'])] + cmd
+        else:
+            logging.warning(f"Fold {fold}: taskset not found - CPU affinity is not set")
+
+    timing = {
+        'fold': fold,
+        'cmd': cmd,
+        'device': device,
+        'n_proc_DA': n_proc_DA,
+        'cores': slot['cores'],
+        'start': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'epochs': [],
+    }
+    epoch, epoch_start = None, None
+    start = time.perf_counter()
+    logfile = os.path.join(logpath, f'fold_{fold}.log')
+    with open(logfile, 'a' if cont else 'w', encoding='utf-8') as log:
+        process = subprocess.Popen(
+            launch,
+            env=fold_env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",   # <-- force UTF-8 decoding
+            errors="replace"    # <-- avoids crash if weird bytes appear
+        )
+
+        # Stream logs in real-time
+        for line in process.stdout:
+            log.write(line)
+            log.flush()
+            with _print_lock:
+                print(f"[fold {fold}] {line}", end="")
+            match = EPOCH.search(line)
+            if match:
+                epoch, epoch_start = int(match.group(1)), time.perf_counter()
+                continue
+            match = EPOCH_TIME.search(line)
+            if match and epoch is not None:
+                timing['epochs'].append({
+                    'epoch': epoch,
+                    'time': float(match.group(1)),
+                    'wall_time': round(time.perf_counter() - epoch_start, 3),
+                })
+
+        process.wait()  # wait for completion
+
+    timing['end'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    timing['wall_time'] = round(time.perf_counter() - start, 3)
+    timing['returncode'] = process.returncode
+    _save_timing(os.path.join(logpath, f'fold_{fold}.json'), timing, cont)
+    if process.returncode != 0:
+        logging.error(f"Fold {fold} exited with code {process.returncode}, see {logfile}")
+    return timing
+
+
+def _finished(results, dataset, configuration, fold, trainer, plans):
+    # A fold has finished if nnU-Net has saved its final checkpoint
+    if results is None:
+        return False
+    dataset = str(dataset)
+    if dataset.isdigit():
+        dataset = f'Dataset{int(dataset):03d}_*'
+    checkpoint = os.path.join(
+        results, dataset, f'{trainer}__{plans}__{configuration}', 
+        f'fold_{fold}', 'checkpoint_final.pth')
+    return glob.glob(checkpoint) != []
+
+
+def _save_timing(file, timing, cont):
+    # Keep the timings of earlier runs of a continued fold
+    runs = []
+    if cont and os.path.exists(file):
+        with open(file, 'r') as f:
+            runs = json.load(f)
+    runs.append(timing)
+    tmp = f'{file}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(runs, f, indent=1)
+    os.replace(tmp, file)
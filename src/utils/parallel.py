@@ -0,0 +1,127 @@
+"""Run per-patient database builds on a pool of worker processes"""
+
+import os
+import shutil
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+import dbdicom as db
+
+from utils import manifest
+
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def run_patients(build, patients, sitedatapath, stagingpath, workers=1,
+                 desc='Building clean database', **kwargs):
+    """Run a patient build function over a list of patients.
+
+    With a single worker the patients are built one after the other
+    straight into the site database. With more workers each patient is
+    built by a separate process in its own staging database, which is
+    then copied into the site database by the main process. Only the
+    main process ever writes to the site database, so its index is
+    never written by two processes at once.
+
+    Args:
+        build (function): module-level function with signature
+            build(patient, sitedatapath, **kwargs), which writes all
+            series of a patient to the database at sitedatapath.
+        patients (list): list of patient folders to build.
+        sitedatapath (str): path to the site database.
+        stagingpath (str): folder for the staging databases of the
+            workers. This should not be inside the site database.
+        workers (int, optional): number of worker processes. If this
+            is None, all available cores are used. Defaults to 1.
+        desc (str, optional): description for the progress bar.
+        kwargs: additional keyword arguments for build. These must be
+            picklable when workers > 1.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1:
+        for patient in tqdm(patients, desc=desc):
+            build(patient, sitedatapath, **kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for patient in patients:
+            patientstagingpath = os.path.join(stagingpath, os.path.basename(patient))
+            future = executor.submit(_build_staged, build, patient, patientstagingpath, kwargs)
+            futures[future] = patientstagingpath
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            patientstagingpath = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                # Discard partial results so the patient is rebuilt next time
+                logging.error(f"Error building {os.path.basename(patientstagingpath)}: {e}")
+            else:
+                _merge(patientstagingpath, sitedatapath)
+            shutil.rmtree(patientstagingpath, ignore_errors=True)
+
+
+def _build_staged(build, patient, patientstagingpath, kwargs):
+
+    # Remove leftovers from an interrupted run
+    shutil.rmtree(patientstagingpath, ignore_errors=True)
+    os.makedirs(patientstagingpath)
+
+    # Send the log of this patient to the staging area
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(os.path.join(patientstagingpath, 'error.log'))
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+    try:
+        build(patient, os.path.join(patientstagingpath, 'database'), **kwargs)
+    finally:
+        root.removeHandler(handler)
+        handler.close()
+
+
+def _merge(patientstagingpath, sitedatapath):
+
+    # Copy the series in the order they were written. dbdicom lists
+    # series by SeriesNumber, so any ordering imposed by the build
+    # function is preserved in the site database.
+    # The staging manifest records the source of each series, so the
+    # site manifest is only written here, by the main process.
+    database = os.path.join(patientstagingpath, 'database')
+    if os.path.exists(database):
+        staged = manifest.read(manifest.file(database))
+        site_manifest = manifest.init(sitedatapath)
+        built = manifest.read(site_manifest)
+        merged = {}
+        for series in db.series(database):
+            site_series = [sitedatapath] + series[1:]
+            # Source paths are relative to the database of the manifest
+            entry = manifest.rebase(staged.get(manifest.key(series)), database, sitedatapath)
+            if entry is not None:
+                source = manifest.source_path(entry, sitedatapath)
+                if manifest.is_current(built, site_series, source, entry.get('shared', False)):
+                    logging.info(f"Series {series[1:]} is already built in {sitedatapath} - not merged.")
+                    continue
+            manifest.delete(site_series)
+            db.copy(series, site_series)
+            merged[manifest.key(series)] = entry
+        manifest.update(site_manifest, merged)
+
+    # Append the staging log to the log files of the main process
+    log = os.path.join(patientstagingpath, 'error.log')
+    if os.path.exists(log):
+        with open(log, 'r') as file:
+            messages = file.read()
+        if messages != '':
+            for handler in logging.getLogger().handlers:
+                if isinstance(handler, logging.FileHandler):
+                    handler.flush()
+                    with open(handler.baseFilename, 'a') as file:
+                        file.write(messages)
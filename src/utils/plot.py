@@ -1,13 +1,8 @@
-import os
-import shutil
-
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import imageio.v2 as imageio  # Use v2 interface for compatibility
-from moviepy import VideoFileClip
 
 
 
@@ -28,60 +23,67 @@ def get_distinct_colors(rois, colormap='jet'):
     return colors
 
 
-def movie_overlay(img, rois, file):
+def window(img):
+    # Upper limit of the grayscale window
+    return np.mean(img) + 2 * np.std(img)
 
-    # Define RGBA colors (R, G, B, Alpha) — alpha controls transparency
-    colors = get_distinct_colors(rois, colormap='tab20')
 
-    # Directory to store temporary frames
-    tmp = os.path.join(os.getcwd(), 'tmp')
-    os.makedirs(tmp, exist_ok=True)
-    filenames = []
+def blend(img, masks, colors, vmax):
+    """Blend masks over a grayscale image.
 
-    # Generate and save a sequence of plots
-    for i in tqdm(range(img.shape[2]), desc='Building animation..'):
+    Masks are layered in order, as they would be when plotted on top of
+    each other.
 
-        # Set up figure
-        fig, ax = plt.subplots(
-            figsize=(5, 5),
-            dpi=300,
-        )
+    Args:
+        img (np.ndarray): grayscale image of any shape.
+        masks (list): boolean arrays with the same shape as img.
+        colors (list): RGBA color for each mask.
+        vmax (float): image value shown as white.
 
-        # Display the background image
-        ax.imshow(img[:,:,i].T, cmap='gray', interpolation='none', vmin=0, vmax=np.mean(img) + 2 * np.std(img))
+    Returns:
+        np.ndarray: uint8 RGB array with an additional last dimension.
+    """
+    if vmax > 0:
+        gray = np.clip(img.astype(np.float32) / vmax, 0, 1)
+    else:
+        gray = np.zeros(img.shape, dtype=np.float32)
+    rgb = np.repeat(gray[..., np.newaxis], 3, axis=-1)
+    for mask, color in zip(masks, colors):
+        alpha = color[3]
+        rgb[mask] = alpha * np.clip(color[:3], 0, 1) + (1-alpha) * rgb[mask]
+    return np.round(255 * rgb).astype(np.uint8)
 
-        # Overlay each mask
-        for mask, color in zip([m.astype(bool) for m in rois.values()], colors):
-            rgba = np.zeros((img.shape[0], img.shape[1], 4), dtype=float)
-            for c in range(4):  # RGBA
-                rgba[..., c] = mask[:,:,i] * color[c]
-            ax.imshow(rgba.transpose((1,0,2)), interpolation='none')
 
-        # Save eachg image to a tmp file
-        fname = os.path.join(tmp, f'frame_{i}.png')
-        fig.savefig(fname)
-        filenames.append(fname)
-        plt.close(fig)
+def zoom(arr, factor):
+    # Nearest neighbour upsampling of the first two dimensions
+    return np.repeat(np.repeat(arr, factor, axis=0), factor, axis=1)
 
-    # Create GIF
-    print('Creating movie')
-    gif = os.path.join(tmp, 'movie.gif')
-    with imageio.get_writer(gif, mode="I", duration=0.2) as writer:
-        for fname in filenames:
-            image = imageio.imread(fname)
-            writer.append_data(image)
 
-    # Load gif
-    clip = VideoFileClip(gif)
+def movie_overlay(img, rois, file, fps=5, size=1500):
 
-    # Save as MP4
-    clip.write_videofile(file, codec='libx264')
+    # Define RGBA colors (R, G, B, Alpha) — alpha controls transparency
+    colors = get_distinct_colors(rois, colormap='tab20')
 
-    # Clean up temporary files
-    shutil.rmtree(tmp)
+    # Get all masks as boolean arrays
+    masks = [m.astype(bool) for m in rois.values()]
+
+    # Window the background image once for all slices
+    vmax = window(img)
+
+    # Scale up so the largest side of a frame is about size pixels
+    factor = max(int(np.round(size / max(img.shape[:2]))), 1)
 
+    # Render each slice and send it straight to the encoder. H.264
+    # needs even frame sizes, so frames are padded by a pixel if needed.
+    with imageio.get_writer(file, fps=fps, codec='libx264', macro_block_size=2) as writer:
+        for i in tqdm(range(img.shape[2]), desc='Building animation..'):
+            frame = blend(img[:,:,i], [m[:,:,i] for m in masks], colors, vmax)
+            frame = zoom(frame.transpose((1,0,2)), factor)
+            pad = [(0, frame.shape[0] % 2), (0, frame.shape[1] % 2), (0, 0)]
+            writer.append_data(np.pad(frame, pad))
 
-def mosaic_overlay(img, rois, file, colormap='tab20', aspect_ratio=16/9, margin=[15,5,2]):
+
+def mosaic_overlay(img, rois, file, colormap='tab20', aspect_ratio=16/9, margin=[15,5,2], tile_size=300):
 
     # Define RGBA colors (R, G, B, Alpha) — alpha controls transparency
     colors = get_distinct_colors(rois, colormap=colormap)
@@ -90,39 +92,22 @@ def mosaic_overlay(img, rois, file, colormap='tab20', aspect_ratio=16/9, margin=
     masks = [m.astype(bool) for m in rois.values()]
 
     # Build a single combined mask
-    all_masks = masks[0]
-    for i in range(1, len(masks)):
-        all_masks = np.logical_or(all_masks, masks[i])
-    if np.sum(all_masks)==0:
+    all_masks = np.logical_or.reduce(masks)
+    if not np.any(all_masks):
         raise ValueError('Empty masks')
     
-    # Find corners of cropped mask
-    for x0 in range(all_masks.shape[0]):
-        if np.sum(all_masks[x0,:,:]) > 0:
-            break
-    for x1 in range(all_masks.shape[0]-1, -1, -1):
-        if np.sum(all_masks[x1,:,:]) > 0:
-            break
-    for y0 in range(all_masks.shape[1]):
-        if np.sum(all_masks[:,y0,:]) > 0:
-            break
-    for y1 in range(all_masks.shape[1]-1, -1, -1):
-        if np.sum(all_masks[:,y1,:]) > 0:
-            break
-    for z0 in range(all_masks.shape[2]):
-        if np.sum(all_masks[:,:,z0]) > 0:
-            break
-    for z1 in range(all_masks.shape[2]-1, -1, -1):
-        if np.sum(all_masks[:,:,z1]) > 0:
-            break
+    # Find corners of cropped mask from its projections on each axis
+    x = np.flatnonzero(np.any(all_masks, axis=(1,2)))
+    y = np.flatnonzero(np.any(all_masks, axis=(0,2)))
+    z = np.flatnonzero(np.any(all_masks, axis=(0,1)))
 
     # Add in the margins       
-    x0 = x0-margin[0] if x0-margin[0]>=0 else 0
-    y0 = y0-margin[1] if y0-margin[1]>=0 else 0
-    z0 = z0-margin[2] if z0-margin[2]>=0 else 0
-    x1 = x1+margin[0] if x1+margin[0]<all_masks.shape[0] else all_masks.shape[0]-1
-    y1 = y1+margin[1] if y1+margin[1]<all_masks.shape[1] else all_masks.shape[1]-1
-    z1 = z1+margin[2] if z1+margin[2]<all_masks.shape[2] else all_masks.shape[2]-1
+    x0 = max(x[0]-margin[0], 0)
+    y0 = max(y[0]-margin[1], 0)
+    z0 = max(z[0]-margin[2], 0)
+    x1 = min(x[-1]+margin[0], all_masks.shape[0]-1)
+    y1 = min(y[-1]+margin[1], all_masks.shape[1]-1)
+    z1 = min(z[-1]+margin[2], all_masks.shape[2]-1)
 
     # Determine number of rows and columns
     # c*r = n -> c=n/r
@@ -130,50 +115,20 @@ def mosaic_overlay(img, rois, file, colormap='tab20', aspect_ratio=16/9, margin=
     width = x1-x0+1
     height = y1-y0+1
     n_mosaics = z1-z0+1
-    nrows = int(np.round(np.sqrt((width*n_mosaics)/(aspect_ratio*height))))
+    nrows = max(int(np.round(np.sqrt((width*n_mosaics)/(aspect_ratio*height)))), 1)
     ncols = int(np.ceil(n_mosaics/nrows))
 
-    # Set up figure 
-    fig, ax = plt.subplots(
-        nrows=nrows, 
-        ncols=ncols, 
-        gridspec_kw = {'wspace':0, 'hspace':0}, 
-        figsize=(ncols*width/max([width,height]), nrows*height/max([width,height])),
-        dpi=300,
-    )
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Build figure
-    i = 0
-    for row in tqdm(ax, desc='Building png'):
-        for col in row:
-
-            col.set_xticklabels([])
-            col.set_yticklabels([])
-            col.set_aspect('equal')
-            col.axis("off")
-
-            # Display the background image
-            if z0+i < img.shape[2]:
-                col.imshow(
-                    img[x0:x1+1, y0:y1+1, z0+i].T, 
-                    cmap='gray', 
-                    interpolation='none', 
-                    vmin=0, 
-                    vmax=np.mean(img) + 2 * np.std(img),
-                )
-
-            # Overlay each mask
-            if z0+i <= z1:
-                for mask, color in zip(masks, colors):
-                    rgba = np.zeros((x1+1-x0, y1+1-y0, 4), dtype=float)
-                    for c in range(4):  # RGBA
-                        rgba[..., c] = mask[x0:x1+1, y0:y1+1, z0+i] * color[c]
-                    col.imshow(rgba.transpose((1,0,2)), interpolation='none')
-
-            i += 1
-
-    # fig.suptitle('Mask overlay', fontsize=14)
-    fig.savefig(file, bbox_inches='tight', pad_inches=0)
-    #plt.savefig(file)
-    plt.close()
\ No newline at end of file
+    # Blend the masks over the cropped image, windowed once for all slices
+    crop = (slice(x0, x1+1), slice(y0, y1+1), slice(z0, z1+1))
+    rgb = blend(img[crop], [m[crop] for m in masks], colors, window(img))
+
+    # Tile the slices on a white canvas, with rows of the image along y
+    tiles = rgb.transpose((2,1,0,3))
+    canvas = np.full((nrows*height, ncols*width, 4), 255, dtype=np.uint8)
+    for i in range(n_mosaics):
+        r, c = divmod(i, ncols)
+        canvas[r*height:(r+1)*height, c*width:(c+1)*width, :3] = tiles[i]
+
+    # Scale up so the largest side of a tile is about tile_size pixels
+    factor = max(int(np.round(tile_size / max(width, height))), 1)
+    imageio.imwrite(file, zoom(canvas, factor))
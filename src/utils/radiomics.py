@@ -1,14 +1,40 @@
 import os
+import json
+import hashlib
 import logging
-import tempfile
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 import scipy.ndimage as ndi
-from scipy.interpolate import interpn
+from scipy.spatial import ConvexHull
 import skimage
+from tqdm import tqdm
 import vreg
+import dbdicom as db
+import SimpleITK as sitk
 from radiomics import featureextractor
 
+from utils import dicomzip
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+
+def _bounding_box(array:np.ndarray):
+    # Slices of the smallest box containing all nonzero values, or None
+    box = []
+    for axis in range(array.ndim):
+        other = tuple(a for a in range(array.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(array, axis=other))
+        if nonzero.size == 0:
+            return None
+        box.append(slice(nonzero[0], nonzero[-1] + 1))
+    return tuple(box)
+
 
 def largest_cluster(array:np.ndarray)->np.ndarray:
     """Given a mask array, return a new mask array containing only the largest cluster.
@@ -19,28 +45,57 @@ def largest_cluster(array:np.ndarray)->np.ndarray:
     Returns:
         np.ndarray: mask array with only a single connect cluster of pixels.
     """
-    # Label all features in the array
-    label_img, cnt = ndi.label(array)
-    # Find the label of the largest feature
-    labels = range(1,cnt+1)
-    size = [np.count_nonzero(label_img==l) for l in labels]
-    max_label = labels[size.index(np.amax(size))]
+    mask = np.zeros(array.shape, dtype=bool)
+    # Only label the region that contains the mask
+    box = _bounding_box(array)
+    if box is None:
+        return mask
+    label_img, _ = ndi.label(array[box])
+    # Count the size of all features at once, ignoring the background
+    size = np.bincount(label_img.ravel())
+    size[0] = 0
     # Return a mask corresponding to the largest feature
-    return label_img==max_label
+    mask[box] = label_img == np.argmax(size)
+    return mask
 
 
-def largest_cluster_label(array:np.ndarray)->np.ndarray:
+def largest_cluster_label(array:np.ndarray, dtype=np.int16)->np.ndarray:
     """Given a label image, return a new label image with only the 
     largest cluster for each label.
+
+    All labels are processed in a single pass: clusters are connected 
+    regions with the same label value, with the same connectivity as 
+    largest_cluster().
+
+    Args:
+        array (np.ndarray): label image with integer values, 0 for background.
+        dtype (optional): data type of the result. Use np.uint8 for 
+          label images with values up to 255. Defaults to np.int16.
+
+    Returns:
+        np.ndarray: label image with a single cluster for each label.
     """
-    output_array = np.zeros(array.shape, dtype=np.int16)
-    for label_value in np.unique(array):
-        if label_value == 0:
-            continue
-        mask = np.zeros(array.shape)
-        mask[array==label_value] = 1
-        mask = largest_cluster(mask)
-        output_array[mask] = label_value
+    output_array = np.zeros(array.shape, dtype=dtype)
+    # Only label the region that contains the labels
+    box = _bounding_box(array)
+    if box is None:
+        return output_array
+    labels = array[box]
+    # Label the clusters of all label values at once
+    clusters = skimage.measure.label(labels, background=0, connectivity=1)
+    size = np.bincount(clusters.ravel())
+    size[0] = 0
+    # Label value of each cluster
+    value = np.zeros(size.size, dtype=labels.dtype)
+    value[clusters.ravel()] = labels.ravel()
+    # Find the largest cluster for each value. Sort by value, then size,
+    # and in case of a tie the first cluster comes last.
+    order = np.lexsort((-np.arange(size.size), size, value))
+    last = np.append(value[order][1:] != value[order][:-1], True)
+    keep = np.zeros(size.size, dtype=bool)
+    keep[order[last]] = True
+    keep[0] = False
+    output_array[box] = np.where(keep[clusters], labels, 0)
     return output_array
 
 
@@ -82,15 +137,95 @@ biomarker_units = {
 }
 
 
-def interpolate3d_isotropic(array, spacing, isotropic_spacing=None):
+def _grid_weights(x, xi):
+    # Indices of the neighbours of each xi in x, and the weight of the 
+    # upper neighbour. Computed in float64 on the 1D grids.
+    i = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, x.size-1)
+    i1 = np.minimum(i + 1, x.size - 1)
+    dx = x[i1] - x[i]
+    w = np.divide(xi - x[i], dx, out=np.zeros(xi.size), where=dx > 0)
+    return i, i1, w
+
+
+def _interpolate_axis(array, i, i1, w, axis, order):
+    # 1D interpolation along one axis
+    if order == 0:
+        # Nearest neighbour, rounding half down
+        return np.take(array, np.where(w <= 0.5, i, i1), axis=axis)
+    shape = [1] * array.ndim
+    shape[axis] = w.size
+    w = w.astype(np.float32).reshape(shape)
+    return (1 - w) * np.take(array, i, axis=axis) + w * np.take(array, i1, axis=axis)
+
+
+def _interpn_weights(x, xi):
+    # Indices of the lower neighbour of each xi in x, and its distance 
+    # to it as a fraction of the grid step, as in scipy's interpn
+    i = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, max(x.size - 2, 0))
+    i1 = np.minimum(i + 1, x.size - 1)
+    dx = x[i1] - x[i]
+    d = np.divide(xi - x[i], dx, out=np.zeros(xi.size), where=dx > 0)
+    return i, i1, d
+
+
+def _interpolate_trilinear(array, wx, wy, wz):
+    # Trilinear interpolation in float64 with the same arithmetic as 
+    # scipy's interpn: the 8 corners are added in the same order, with 
+    # the same products of weights, so the result is bit-identical.
+    value = 0
+    for ix, dx in ((wx[0], 1 - wx[2]), (wx[1], wx[2])):
+        for iy, dy in ((wy[0], 1 - wy[2]), (wy[1], wy[2])):
+            for iz, dz in ((wz[0], 1 - wz[2]), (wz[1], wz[2])):
+                weight = dx[:, None, None] * dy[None, :, None] * dz[None, None, :]
+                value = value + array[np.ix_(ix, iy, iz)] * weight
+    return value
+
+
+def interpolate3d_isotropic(array, spacing, isotropic_spacing=None, box=None, shape=None, 
+                            order=1, mask=False, chunk_size=2**24):
+    """Interpolate a 3D array to isotropic voxels.
+
+    Linear interpolation is separable, so the array is interpolated 
+    along one axis at a time. This is done in float32 for one slab of 
+    output slices at a time, so the memory needed on top of the result 
+    is limited by the chunk size.
+
+    Masks are interpolated in float64 with the same arithmetic as 
+    scipy's interpn, so voxels that interpolate to values near 0.5 
+    are rounded in the same way.
 
+    Args:
+        array (np.ndarray): 3D array.
+        spacing (list): voxel dimensions.
+        isotropic_spacing (float, optional): voxel size of the result. 
+          Defaults to the smallest of the voxel dimensions.
+        box (tuple, optional): if array is a crop of a larger array, 
+          the slices of the crop. The array is then interpolated on the 
+          same grid as the larger array would be. Defaults to None.
+        shape (tuple, optional): shape of the larger array. Required 
+          if box is provided.
+        order (int, optional): 1 for linear, 0 for nearest neighbour 
+          interpolation. Defaults to 1.
+        mask (bool, optional): if True, the array is a mask and the 
+          result is returned as a uint8 mask with the interpolated 
+          values rounded to 0 or 1, exactly as rounding the result of 
+          interpn. Defaults to False.
+        chunk_size (int, optional): maximum number of output voxels 
+          computed at once. Defaults to 2**24.
+
+    Returns:
+        tuple: interpolated array and isotropic voxel size.
+    """
     if isotropic_spacing is None:
         isotropic_spacing = np.amin(spacing)
 
+    if shape is None:
+        shape = array.shape
+
     # Get x, y, z coordinates for array
-    nx = array.shape[0]
-    ny = array.shape[1]
-    nz = array.shape[2]
+    nx = shape[0]
+    ny = shape[1]
+    nz = shape[2]
     Lx = (nx-1)*spacing[0]
     Ly = (ny-1)*spacing[1]
     Lz = (nz-1)*spacing[2]
@@ -109,10 +244,95 @@ def interpolate3d_isotropic(array, spacing, isotropic_spacing=None):
     yi = np.linspace(0, Lyi, nyi.astype(int))
     zi = np.linspace(0, Lzi, nzi.astype(int))
 
-    # Interpolate to isotropic
-    ri = np.meshgrid(xi,yi,zi, indexing='ij')
-    array = interpn((x,y,z), array, np.stack(ri, axis=-1))
-    return array, isotropic_spacing
+    # Restrict both grids to the crop
+    if box is not None:
+        x, y, z = x[box[0]], y[box[1]], z[box[2]]
+        xi = xi[(xi >= x[0]) & (xi <= x[-1])]
+        yi = yi[(yi >= y[0]) & (yi <= y[-1])]
+        zi = zi[(zi >= z[0]) & (zi <= z[-1])]
+
+    # Neighbours and weights along each axis
+    weights = _interpn_weights if (mask and order == 1) else _grid_weights
+    wx = weights(x, xi)
+    wy = weights(y, yi)
+    iz, iz1, w = weights(z, zi)
+
+    # Interpolate to isotropic, one slab of output slices at a time
+    output = np.empty((xi.size, yi.size, zi.size), dtype=np.uint8 if mask else np.float32)
+    nslices = max(1, chunk_size // max(1, xi.size * yi.size))
+    for k in range(0, zi.size, nslices):
+        k1 = min(k + nslices, zi.size)
+        z0, z1 = iz[k], iz1[k1-1] + 1
+        wz = (iz[k:k1]-z0, iz1[k:k1]-z0, w[k:k1])
+        if mask and order == 1:
+            slab = _interpolate_trilinear(array[:, :, z0:z1].astype(np.float64), wx, wy, wz)
+        else:
+            slab = array[:, :, z0:z1].astype(np.float32)
+            slab = _interpolate_axis(slab, *wx, 0, order)
+            slab = _interpolate_axis(slab, *wy, 1, order)
+            slab = _interpolate_axis(slab, *wz, 2, order)
+        if mask:
+            # Same as rounding values in [0, 1], where 0.5 rounds to 0
+            slab = slab > 0.5
+        output[:, :, k:k1] = slab
+    return output, isotropic_spacing
+
+
+def max_diameter(points:np.ndarray, chunk_size=1024)->float:
+    """Maximum distance between any two points of a point cloud.
+
+    The furthest points are always vertices of the convex hull, so 
+    only these are compared. Distances are computed for a chunk of 
+    vertices at a time, so memory scales with the size of the hull.
+
+    Args:
+        points (np.ndarray): array of shape (n, 3).
+        chunk_size (int, optional): number of hull vertices compared 
+          at once. Defaults to 1024.
+
+    Returns:
+        float: maximum distance, in the units of the points.
+    """
+    hull = points[ConvexHull(points).vertices].astype(np.float64)
+    dmax = 0
+    for i in range(0, len(hull), chunk_size):
+        chunk = hull[i:i+chunk_size]
+        d = np.sum((chunk[:, np.newaxis, :] - hull[np.newaxis, :, :])**2, axis=-1)
+        dmax = np.maximum(dmax, np.amax(d))
+    return float(np.sqrt(dmax))
+
+
+def _padded_crop(arr, box, fill=0):
+    # Crop of the array around the bounding box of an ROI. Returns the
+    # crop, its slices in the padded array and the padded shape.
+
+    # Add zeropadding at the boundary slices for masks that extend to the edge
+    # Motivation: this could have some effect if surfaces are extracted - could create issues
+    # if the values extend right up to the boundary of the slab.
+    shape = list(arr.shape)
+    shape[-1] = shape[-1] + 2*4
+    offset = [0, 0, 4]
+
+    # Only the bounding box of the ROI in the padded array is computed.
+    # The margin covers the reach of the smoothing kernel (4 voxels) 
+    # plus a layer of zeros, so all results are the same as for the 
+    # full array.
+    margin = 5
+    box = tuple(
+        slice(np.clip(b.start + o - margin, 0, n), np.clip(b.stop + o + margin, 0, n)) 
+        for b, o, n in zip(box, offset, shape)
+    )
+    src = tuple(
+        slice(np.clip(b.start - o, 0, n), np.clip(b.stop - o, 0, n)) 
+        for b, o, n in zip(box, offset, arr.shape)
+    )
+    dst = tuple(
+        slice(s.start - b.start + o, s.stop - b.start + o) 
+        for s, b, o in zip(src, box, offset)
+    )
+    array = np.full([b.stop - b.start for b in box], fill, dtype=arr.dtype)
+    array[dst] = arr[src]
+    return array, box, shape
 
 
 def volume_features(vol, roi):
@@ -124,21 +344,53 @@ def volume_features(vol, roi):
     # sure the results are meaningful even if non-binary arrays are provided.
     max = np.amax(arr)
     min = np.amin(arr)
-    arr -= min
-    arr /= max-min
+    box = _bounding_box(arr > min)
+    if box is None:
+        raise ValueError(f"Region of interest {roi} is empty.")
+    array, box, shape = _padded_crop(arr, box, fill=min)
+    array = (array - min) / (max - min)
 
-    # Add zeropadding at the boundary slices for masks that extend to the edge
-    # Motivation: this could have some effect if surfaces are extracted - could create issues
-    # if the values extend right up to the boundary of the slab.
-    shape = list(arr.shape)
-    shape[-1] = shape[-1] + 2*4
-    array = np.zeros(shape)
-    array[:,:,4:-4] = arr
+    return _shape_features(array, box, shape, vol.spacing, roi)
+
+
+def label_volume_features(vol, labels:dict):
+    """Shape features of all regions in a label volume.
+
+    The bounding boxes of all labels are found in a single pass, and 
+    each region is then processed inside its own box on the same 
+    isotropic grid. The results are the same as calling 
+    volume_features() on a mask of each region.
+
+    Args:
+        vol (vreg.Volume3D): label volume with integer values.
+        labels (dict): name of the region for each label value, 
+          e.g. {1: 'kidney_left', 2: 'kidney_right'}.
+
+    Returns:
+        dict: features of all regions, in the format of volume_features().
+    """
+    arr = vol.values
+    if not np.issubdtype(arr.dtype, np.integer):
+        arr = np.round(arr).astype(np.int32)
+    boxes = ndi.find_objects(arr, max_label=np.amax(list(labels)))
+    data = {}
+    for label, roi in labels.items():
+        if boxes[label-1] is None:
+            logging.error(f"Region of interest {roi} is empty.")
+            continue
+        array, box, shape = _padded_crop(arr, boxes[label-1])
+        array = (array == label).astype(np.float64)
+        data.update(_shape_features(array, box, shape, vol.spacing, roi))
+    return data
+
+
+def _shape_features(array, box, shape, spacing, roi):
+    # Features of a mask with values in [0, 1], cropped from a padded 
+    # array of the given shape.
 
     # Get voxel dimensions from the affine
     # We are assuming here the voxel dimensions are in mm.
     # If not the units provided with the return values are incorrect.
-    spacing = vol.spacing
     voxel_volume = spacing[0]*spacing[1]*spacing[2]
     nr_of_voxels = np.count_nonzero(array > 0.5)
     volume = nr_of_voxels * voxel_volume
@@ -153,14 +405,16 @@ def volume_features(vol, roi):
         # If a mask has too few points, smoothing can reduce the max to below 0.5. Use the midpoint in that case
         # Note this may work in general but 0.5 has been used for previous data collection so keep that as default
         smooth_array = ndi.gaussian_filter(array, 1.0)
-        verts, faces, _, _ = skimage.measure.marching_cubes(smooth_array, spacing=spacing, level=np.mean(smooth_array), step_size=1.0)
+        # The smoothed array is zero outside of the box, so take the mean over the full padded array
+        level = np.sum(smooth_array) / np.prod(shape)
+        verts, faces, _, _ = skimage.measure.marching_cubes(smooth_array, spacing=spacing, level=level, step_size=1.0)
     surface_area = skimage.measure.mesh_surface_area(verts, faces)
 
     # Interpolate to isotropic for non-isotropic voxels
     # Motivation: this is required by the region_props function
     spacing = np.array(spacing)
     if np.amin(spacing) != np.amax(spacing):
-        array, isotropic_spacing = interpolate3d_isotropic(array, spacing)
+        array, isotropic_spacing = interpolate3d_isotropic(array, spacing, box=box, shape=shape, mask=True)
         isotropic_voxel_volume = isotropic_spacing**3
     else:
         isotropic_spacing = np.mean(spacing)
@@ -264,24 +518,64 @@ def volume_features(vol, roi):
         data[f'{roi}-shape_ski-volume_qc'] = [region_props_3D['area']*isotropic_voxel_volume/1000, f'Volume QC ({roi})', 'mL', 'float']
     except Exception as e:
         logging.error(f"Error computing Volume QC ({roi}): {e}")
-    # Taking this out for now - computation uses > 32GB of memory for large masks
-    # data[f'{roi}_ski_longest_caliper_diameter'] = [region_props_3D['feret_diameter_max']*isotropic_spacing/10, f'Longest caliper diameter ({roi})', 'cm', 'float']
+    try:
+        # Computed on the surface rather than with region_props, which uses > 32GB of memory for large masks
+        data[f'{roi}-shape_ski-longest_caliper_diameter'] = [max_diameter(verts)/10, f'Longest caliper diameter ({roi})', 'cm', 'float']
+    except Exception as e:
+        logging.error(f"Error computing Longest caliper diameter ({roi}): {e}")
 
     return data
 
 
+def _extractor(classes, **settings):
+    # Extractor with only the given feature classes enabled
+    settings = tuple(sorted(
+        (k, tuple(v) if isinstance(v, list) else v) for k, v in settings.items()
+    ))
+    return _configured_extractor(tuple(classes), settings)
+
+
+@functools.lru_cache(maxsize=8)
+def _configured_extractor(classes, settings):
+    # An extractor is configured on the first call and reused after 
+    # that. Only the most recently used ones are kept, as resampled 
+    # voxel sizes can differ for every ROI.
+    settings = {k: list(v) if isinstance(v, tuple) else v for k, v in settings}
+    extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
+    extractor.disableAllFeatures()
+    for cl in classes:
+        extractor.enableFeatureClassByName(cl)
+    return extractor
+
+
+def sitk_image(vol:vreg.Volume3D) -> sitk.Image:
+    """Convert a volume to a SimpleITK image in memory.
+
+    The image is the same as SimpleITK would read from a NIfTI file 
+    written with vreg.write_nifti(). Both vreg and SimpleITK use LPS 
+    coordinates, so the affine is used as is.
+
+    Args:
+        vol (vreg.Volume3D): volume to convert.
+
+    Returns:
+        sitk.Image: image with the same geometry as the volume.
+    """
+    affine = np.asarray(vol.affine, dtype=np.float64)
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    # SimpleITK arrays are indexed as (z, y, x)
+    image = sitk.GetImageFromArray(np.ascontiguousarray(vol.values.transpose(2, 1, 0)))
+    image.SetSpacing(spacing.tolist())
+    image.SetOrigin(affine[:3, 3].tolist())
+    image.SetDirection((affine[:3, :3] / spacing).flatten().tolist())
+    return image
+
+
 def shape_features(roi_vol, roi):
 
-    with tempfile.TemporaryDirectory() as tmp:
-        roi_file = os.path.join(tmp, 'roi.nii.gz')
-        img_file = os.path.join(tmp, 'img.nii.gz') # dummy
-        vreg.write_nifti(roi_vol, roi_file)
-        vreg.write_nifti(roi_vol, img_file)
-        # All features for water
-        extractor = featureextractor.RadiomicsFeatureExtractor()
-        extractor.disableAllFeatures()
-        extractor.enableFeatureClassByName('shape')
-        result = extractor.execute(img_file, roi_file)
+    # The ROI is also used as (dummy) image
+    roi_img = sitk_image(roi_vol)
+    result = _extractor(['shape']).execute(roi_img, roi_img)
         
     # Format return value
     rval = {}
@@ -293,34 +587,71 @@ def shape_features(roi_vol, roi):
     return rval
 
 
-def texture_features(roi_vol, img_vol, roi, img):
-
-    with tempfile.TemporaryDirectory() as tmp:
-        roi_file = os.path.join(tmp, 'roi.nii.gz')
-        img_file = os.path.join(tmp, 'img.nii.gz')
-        print('radiomics texture ', roi)
-        # Downsample large ROIs to avoid memory over
-        # TODO: Not enough for large regions - still RAM issue
-        roi_vol_box = roi_vol
-        img_vol_box = img_vol
-        # roi_vol_box = roi_vol.crop(mask=roi_vol) # some edits in vreg. Check
-        # img_vol_box = img_vol.crop(mask=roi_vol)
-        # roi_vol_box = roi_vol_box.resample(5.0)
-        # img_vol_box = img_vol_box.resample(5.0)
-        vreg.write_nifti(roi_vol_box, roi_file)
-        vreg.write_nifti(img_vol_box, img_file)
-        # All features for water
-        extractor = featureextractor.RadiomicsFeatureExtractor()
-        extractor.disableAllFeatures()
-        # TODO: try without first order
-        # classes = ['firstorder', 'glcm', 'glrlm', 'glszm', 'gldm', 'ngtdm'] # glcm seems to fail a lot
-        classes = ['firstorder', 'glrlm', 'glszm', 'gldm', 'ngtdm']
-        for cl in classes:
-            extractor.enableFeatureClassByName(cl)
-        # extractor.enableImageTypeByName('Wavelet')
-        # extractor.enableImageTypeByName('LoG', {'sigma': [1.0, 1.0, 1.0]}) 
-        # extractor.enableImageTypeByName('Gradient')
-        result = extractor.execute(img_file, roi_file)
+def _crop(vol:vreg.Volume3D, box) -> vreg.Volume3D:
+    # Crop a volume to a box, keeping its position in space
+    affine = np.array(vol.affine, dtype=np.float64)
+    corner = [b.start for b in box]
+    affine[:3, 3] = affine[:3, :3] @ corner + affine[:3, 3]
+    return vreg.volume(vol.values[box], affine)
+
+
+def texture_features(roi_vol, img_vol, roi, img, spacing=None, max_voxels=None, glcm=False):
+    """Texture features of an image inside a region of interest.
+
+    Image and ROI are cropped to the bounding box of the ROI first. If 
+    a spacing is provided, or the box has more voxels than the budget 
+    allows, pyradiomics resamples them to a coarser voxel size. The 
+    voxel size that was used is returned as the feature 
+    texture_resolution.
+
+    Args:
+        roi_vol (vreg.Volume3D): mask of the ROI.
+        img_vol (vreg.Volume3D): image on the same grid as the mask.
+        roi (str): name of the ROI.
+        img (str): name of the image.
+        spacing (float, optional): isotropic voxel size in mm to 
+          resample to. Defaults to None (native voxel size).
+        max_voxels (int, optional): maximum number of voxels in the 
+          bounding box of the ROI. Larger boxes are resampled to 
+          larger voxels, e.g. 2**21 to compute large ROIs in bounded 
+          memory. Defaults to None (no limit).
+        glcm (bool, optional): include GLCM features. Defaults to False.
+
+    Returns:
+        dict: features in the format of volume_features().
+    """
+    # Crop image and ROI to the bounding box of the ROI
+    box = _bounding_box(roi_vol.values > 0)
+    if box is None:
+        raise ValueError(f"Region of interest {roi} is empty.")
+    box = tuple(
+        slice(max(b.start - 2, 0), min(b.stop + 2, n)) 
+        for b, n in zip(box, roi_vol.shape)
+    )
+    roi_vol_box = _crop(roi_vol, box)
+    img_vol_box = _crop(img_vol, box)
+
+    # Voxel size: native, unless another spacing is requested or the 
+    # ROI is too large to compute in bounded memory
+    native = np.linalg.norm(np.asarray(roi_vol.affine)[:3, :3], axis=0)
+    voxel = native if spacing is None else np.full(3, float(spacing))
+    nr_of_voxels = np.prod(np.array(roi_vol_box.shape) * native / voxel)
+    if max_voxels is not None and nr_of_voxels > max_voxels:
+        voxel = voxel * (nr_of_voxels / max_voxels) ** (1/3)
+        voxel = np.ceil(voxel * 100) / 100
+        logging.info(f"Texture ({roi}, {img}): resampled to {voxel} mm to stay within {max_voxels} voxels")
+    settings = {}
+    if spacing is not None or not np.array_equal(voxel, native):
+        settings['resampledPixelSpacing'] = voxel.tolist()
+
+    classes = ['firstorder', 'glrlm', 'glszm', 'gldm', 'ngtdm']
+    if glcm:
+        # glcm seems to fail a lot on large regions
+        classes.append('glcm')
+    # extractor.enableImageTypeByName('Wavelet')
+    # extractor.enableImageTypeByName('LoG', {'sigma': [1.0, 1.0, 1.0]}) 
+    # extractor.enableImageTypeByName('Gradient')
+    result = _extractor(classes, **settings).execute(sitk_image(img_vol_box), sitk_image(roi_vol_box))
 
     # Format return value
     rval = {}
@@ -333,4 +664,181 @@ def texture_features(roi_vol, img_vol, roi, img):
                     break
             vals = [float(v), name, 'unit', 'float']
             rval[name] = vals
-    return rval
\ No newline at end of file
+    name = f'{roi}-{img}-texture_resolution'
+    rval[name] = [float(np.amax(voxel)), name, 'mm', 'float']
+    return rval
+
+
+def cohort_features(jobs:list, cachepath, workers=1, max_memory=None, 
+                    desc='Computing features') -> list:
+    """Compute features for a list of ROI x image jobs.
+
+    Results are cached in cachepath under a hash of the mask, image, 
+    voxel size and feature configuration. Jobs that were computed 
+    before are read from the cache, so a re-run after adding data or 
+    options only computes the new jobs.
+
+    Each job is a dictionary with keys:
+
+    - 'roi': name of the region of interest.
+    - 'mask': mask of the ROI, as a vreg.Volume3D, a path to a NIfTI 
+      file or a dbdicom series.
+    - 'features': 'volume', 'shape' or 'texture'. Defaults to 'volume'.
+    - 'img', 'image': name and volume of the image (texture only).
+    - 'options': keyword arguments for the feature function, 
+      e.g. {'glcm': True} or {'max_voxels': 2**21}. Defaults to {}.
+
+    Other keys are ignored, so jobs can carry identifiers such as 
+    the patient ID.
+
+    Args:
+        jobs (list): list of jobs.
+        cachepath (str): folder for the cache.
+        workers (int, optional): number of worker processes. If this 
+          is None, all available cores are used. Defaults to 1.
+        max_memory (int, optional): maximum memory of each worker 
+          process in bytes. A job that needs more usually fails with 
+          a MemoryError. If instead the worker process dies, e.g. 
+          when a C extension aborts, the jobs that were lost are run 
+          again. Only applies on Unix with workers > 1. Defaults 
+          to None.
+        desc (str, optional): description for the progress bar.
+
+    Returns:
+        list: features of each job, in the format of volume_features(), 
+        or None if the job failed.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    os.makedirs(cachepath, exist_ok=True)
+    results = [None] * len(jobs)
+
+    # List the files of dbdicom series here, so the jobs never open a 
+    # database. Opening a database rewrites its index, and jobs that do 
+    # so at the same time overwrite each other's index.
+    resolved = {}
+    for i, job in enumerate(jobs):
+        try:
+            resolved[i] = _resolve(job)
+        except Exception as e:
+            logging.error(f"Error computing {_job_name(job)}: {e}")
+
+    if workers <= 1:
+        for i in tqdm(resolved, desc=desc):
+            try:
+                results[i] = _run_job(resolved[i], cachepath)
+            except Exception as e:
+                logging.error(f"Error computing {_job_name(jobs[i])}: {e}")
+        return results
+
+    # If a worker process dies, the pool stops and all jobs that had 
+    # not finished are lost. These are run again in a new pool. Jobs 
+    # that are lost a second time run on their own, so that a crash 
+    # only affects the job that caused it.
+    lost = _run_pool(resolved, list(resolved), cachepath, workers, max_memory, results, desc)
+    if lost != []:
+        logging.warning(f"A worker process died - running {len(lost)} jobs again.")
+        lost = _run_pool(resolved, lost, cachepath, workers, max_memory, results, desc)
+    for i in lost:
+        if _run_pool(resolved, [i], cachepath, 1, max_memory, results, desc) != []:
+            logging.error(f"Error computing {_job_name(jobs[i])}: the worker process died.")
+    return results
+
+
+def _run_pool(jobs, indices, cachepath, workers, max_memory, results, desc):
+    # Run jobs in a process pool and save the results. Returns the 
+    # indices of the jobs that were lost because the pool broke.
+    lost = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_limit_memory, 
+                             initargs=(max_memory,)) as executor:
+        futures = {executor.submit(_run_job, jobs[i], cachepath): i for i in indices}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                lost.append(i)
+            except Exception as e:
+                logging.error(f"Error computing {_job_name(jobs[i])}: {e}")
+    return sorted(lost)
+
+
+def _limit_memory(max_memory):
+    if max_memory is None:
+        return
+    if resource is None:
+        logging.warning("Memory limits are not supported on this platform - ignored.")
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+
+def _job_name(job):
+    return ' '.join(str(job[k]) for k in ['roi', 'img', 'features'] if k in job)
+
+
+def _resolve(job) -> dict:
+    # Copy of the job with the dbdicom series replaced by their files
+    job = dict(job)
+    for key in ['mask', 'image']:
+        if isinstance(job.get(key), list):
+            job[key] = {'files': db.files(job[key])}
+    return job
+
+
+def _volume(source) -> vreg.Volume3D:
+    # Load the volume of a job from any of the supported sources
+    if isinstance(source, vreg.Volume3D):
+        return source
+    if isinstance(source, str):
+        return vreg.read_nifti(source)
+    if isinstance(source, dict):
+        return dicomzip.volume(dicomzip.read_files(source['files']))
+    return db.volume(source)
+
+
+def _cache_key(mask, image, roi, img, features, options) -> str:
+    # The results are named after the ROI and image, so these are part 
+    # of the key as well as the data
+    sha = hashlib.sha256()
+    for vol in [mask, image]:
+        if vol is None:
+            continue
+        values = np.ascontiguousarray(vol.values)
+        sha.update(f'{values.dtype}{values.shape}'.encode())
+        sha.update(values.tobytes())
+        spacing = np.linalg.norm(np.asarray(vol.affine, dtype=np.float64)[:3, :3], axis=0)
+        sha.update(spacing.tobytes())
+    sha.update(repr((roi, img, features, sorted(options.items()))).encode())
+    return sha.hexdigest()
+
+
+def _run_job(job, cachepath):
+
+    mask = _volume(job['mask'])
+    image = None if job.get('image') is None else _volume(job['image'])
+    features = job.get('features', 'volume')
+    options = job.get('options', {})
+
+    # Return the cached result if the job was computed before
+    key = _cache_key(mask, image, job['roi'], job.get('img'), features, options)
+    cache_file = os.path.join(cachepath, f'{key}.json')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+
+    if features == 'volume':
+        result = volume_features(mask, job['roi'], **options)
+    elif features == 'shape':
+        result = shape_features(mask, job['roi'], **options)
+    elif features == 'texture':
+        result = texture_features(mask, image, job['roi'], job['img'], **options)
+    else:
+        raise ValueError(f"Unknown features {features}. Use 'volume', 'shape' or 'texture'.")
+    result = {k: [float(v[0])] + list(v[1:]) for k, v in result.items()}
+
+    # Write to a temporary file first so a cache entry is never partial
+    tmp = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(result, f, indent=1)
+    os.replace(tmp, cache_file)
+    return result
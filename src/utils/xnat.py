@@ -1,16 +1,33 @@
 import os
+import json
+import time
+import sqlite3
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from tqdm import tqdm
 import numpy as np
 
-# import zipfile
 # import datetime
 # import xnat
 # import io
 # import pydicom
 
+# Connect and read timeouts for requests in seconds
+TIMEOUT = (30, 300)
+
+# Size of the chunks written to disk while downloading
+CHUNK_SIZE = 1024 * 1024
+
+# Serializes access to the catalogue from the worker threads
+CATALOGUE_LOCK = threading.Lock()
+
 
 # def download_series_by_dicom_sequence_name(xnat_url, username, password,
 #                                            project_id, subject_id, sequence_name,
@@ -75,10 +92,24 @@ import numpy as np
 def download_scans(
     xnat_url, username, password, output_dir, project_id,
     subject_label=None, experiment_label=None, attr=None, value=None,
+    workers=8, cache_ttl=24*3600,
 ):
     """
     Downloads all scan series with a given attribute value.
 
+    Scans are found and downloaded by a pool of threads sharing one 
+    session. Each download is written to a .part file first, which is 
+    only renamed to the final zip file when it is complete. An 
+    interrupted download is resumed from where it stopped on the next 
+    call.
+
+    The listings of subjects, experiments and scans are cached in a 
+    catalogue (xnat_catalogue.db in output_dir) and only requested again 
+    when they are older than cache_ttl. Scan attributes do not change 
+    once a scan is archived, so they are requested only for scans that 
+    are not yet in the catalogue, and the attribute filter runs on the 
+    cached values.
+
     Args:
         xnat_url (str): Base URL of the XNAT server.
         username (str): XNAT username.
@@ -91,6 +122,9 @@ def download_scans(
             all experiments are downloaded. Defaults to None.
         attr (str ro tuple of str): Attribute(s) to filter by (e.g. 'sequence').
         value: Desired value(s) for the attribute(s).
+        workers (int): Number of concurrent requests. Defaults to 8.
+        cache_ttl (float): Maximum age of cached listings in seconds. 
+            Set to 0 to refresh all listings. Defaults to one day.
     """
     if np.isscalar(value):
         value = [value]
@@ -103,80 +137,227 @@ def download_scans(
                 value_list.append(v)
         value = tuple(value_list)
 
+    session = _session(username, password, workers)
+    catalogue = _catalogue(output_dir, cache_ttl)
+
+    # Find all subjects in the project
+    subj_url = f"{xnat_url}/data/projects/{project_id}/subjects?format=json"
+    subjects = _results(session, catalogue, subj_url)
+
+    # Continue if this subject was not requested
+    if subject_label is not None:
+        subjects = [subj for subj in subjects if subj['label'] == subject_label]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        # Find the experiments of all subjects
+        futures = [
+            executor.submit(_experiments, session, catalogue, xnat_url, project_id, subj, experiment_label)
+            for subj in subjects
+        ]
+        experiments = []
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Scanning subjects..'):
+            experiments += future.result()
+
+        # Find the scans that need downloading in all experiments
+        futures = [
+            executor.submit(_scans, session, catalogue, xnat_url, output_dir, project_id, subj, exp, attr, value)
+            for subj, exp in experiments
+        ]
+        downloads = []
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Scanning experiments..'):
+            downloads += future.result()
+
+        # Download the scans
+        futures = {
+            executor.submit(_download, session, download_url, out_path): out_path
+            for download_url, out_path in downloads
+        }
+        failed = []
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Downloading scans..'):
+            try:
+                future.result()
+            except Exception as e:
+                # Leave the .part file so the download resumes next time
+                failed.append(f"{futures[future]}: {e}")
+
+    catalogue['connection'].close()
+    if failed != []:
+        raise RuntimeError(
+            f"{len(failed)} of {len(downloads)} downloads failed. "
+            f"Run again to resume them.\n" + "\n".join(failed)
+        )
+
+
+def _session(username, password, workers):
+    # One connection per worker, so the threads do not queue for the pool
     session = requests.Session()
     session.auth = HTTPBasicAuth(username, password)
+    adapter = HTTPAdapter(
+        pool_connections=workers, 
+        pool_maxsize=workers, 
+        max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504]),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _catalogue(output_dir, cache_ttl):
+    os.makedirs(output_dir, exist_ok=True)
+    file = os.path.join(output_dir, 'xnat_catalogue.db')
+    connection = sqlite3.connect(file, timeout=60, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS listings "
+        "(url TEXT PRIMARY KEY, fetched REAL, result TEXT)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS scans "
+        "(url TEXT PRIMARY KEY, data_fields TEXT)"
+    )
+    connection.commit()
+    return {'connection': connection, 'ttl': cache_ttl}
+
+
+def _results(session, catalogue, url):
+
+    # Use the cached listing if it is recent enough
+    with CATALOGUE_LOCK:
+        row = catalogue['connection'].execute(
+            "SELECT fetched, result FROM listings WHERE url=?", (url,)
+        ).fetchone()
+    if row is not None:
+        if time.time() - row[0] < catalogue['ttl']:
+            return json.loads(row[1])
+
+    r = session.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    result = r.json()['ResultSet']['Result']
 
-    # Loop over all subjects in the project
-    subj_url = f"{xnat_url}/data/projects/{project_id}/subjects?format=json"
-    r = session.get(subj_url)
+    with CATALOGUE_LOCK:
+        catalogue['connection'].execute(
+            "INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", 
+            (url, time.time(), json.dumps(result)),
+        )
+        catalogue['connection'].commit()
+    return result
+
+
+def _data_fields(session, catalogue, url):
+
+    # Scan attributes are only requested for new scans
+    with CATALOGUE_LOCK:
+        row = catalogue['connection'].execute(
+            "SELECT data_fields FROM scans WHERE url=?", (url,)
+        ).fetchone()
+    if row is not None:
+        return json.loads(row[0])
+
+    r = session.get(url, timeout=TIMEOUT)
     r.raise_for_status()
-    subjects = r.json()['ResultSet']['Result']
+    data_fields = r.json()['items'][0]['data_fields']
+
+    with CATALOGUE_LOCK:
+        catalogue['connection'].execute(
+            "INSERT OR REPLACE INTO scans VALUES (?, ?)", 
+            (url, json.dumps(data_fields)),
+        )
+        catalogue['connection'].commit()
+    return data_fields
+
 
-    for subj in tqdm(subjects, desc='Scanning subjects..'):
-        subject_id = subj['ID']
+def _experiments(session, catalogue, xnat_url, project_id, subj, experiment_label):
+    exp_url = f"{xnat_url}/data/projects/{project_id}/subjects/{subj['ID']}/experiments?format=json"
+    experiments = []
+    for exp in _results(session, catalogue, exp_url):
 
-        # Continue if this subject was not requested
-        if subject_label is not None:
-            if subj['label'] != subject_label:
+        # Continue if this experiment was not requested
+        if experiment_label is not None:
+            if exp['label'] != experiment_label:
+                continue
+        experiments.append((subj, exp))
+    return experiments
+
+
+def _scans(session, catalogue, xnat_url, output_dir, project_id, subj, exp, attr, value):
+    exp_id = exp['ID']
+    scans_url = f"{xnat_url}/data/experiments/{exp_id}/scans?format=json"
+    downloads = []
+    for scan in _results(session, catalogue, scans_url):
+        scan_id = scan['ID']
+
+        # Define download locations
+        download_url = f"{xnat_url}/data/experiments/{exp_id}/scans/{scan_id}/resources/DICOM/files?format=zip"
+        out_folder = os.path.join(output_dir, project_id, subj['label'], f"{exp['label']}")
+        out_path = os.path.join(out_folder, f"series_{scan_id.zfill(2)}.zip")
+        
+        # Continue if the data have already been downloaded. Only 
+        # complete downloads are renamed to out_path, so this is 
+        # checked before requesting the scan attributes.
+        if os.path.exists(out_path):
+            continue
+
+        # Retrieve scan attributes
+        attr_url = f"{xnat_url}/data/experiments/{exp_id}/scans/{scan_id}?format=json"
+        scan_attrs = _data_fields(session, catalogue, attr_url)
+
+        # Continue if the scan does not have the right attributes
+        if isinstance(attr, str):
+            if scan_attrs.get(attr) not in value:
+                continue
+        if isinstance(attr, tuple):
+            cont = False
+            for i, a in enumerate(attr):
+                if scan_attrs.get(a) not in value[i]:
+                    cont=True
+                    continue
+            if cont:
                 continue
 
-        # Loop over the subject's experiments
-        exp_url = f"{xnat_url}/data/projects/{project_id}/subjects/{subject_id}/experiments?format=json"
-        r = session.get(exp_url)
-        r.raise_for_status()
-        experiments = r.json()['ResultSet']['Result']
+        downloads.append((download_url, out_path))
+    return downloads
 
-        for exp in tqdm(experiments, desc='Scanning experiments..'):
-            exp_id = exp['ID']
 
-            # Continue if this experiment was not requested
-            if experiment_label is not None:
-                if exp['label'] != experiment_label:
-                    continue
+def _download(session, download_url, out_path):
 
-            # Loop over the scans in the experiment
-            scans_url = f"{xnat_url}/data/experiments/{exp_id}/scans?format=json"
-            r = session.get(scans_url)
-            r.raise_for_status()
-            scans = r.json()['ResultSet']['Result']
-
-            for scan in scans:
-                scan_id = scan['ID']
-
-                # Retrieve scan attributes
-                attr_url = f"{xnat_url}/data/experiments/{exp_id}/scans/{scan_id}?format=json"
-                r = session.get(attr_url)
-                r.raise_for_status()
-                scan_attrs = r.json()['items'][0]['data_fields']
-
-                # Continue if the scan does not have the right attributes
-                if isinstance(attr, str):
-                    if scan_attrs.get(attr) not in value:
-                        continue
-                if isinstance(attr, tuple):
-                    cont = False
-                    for i, a in enumerate(attr):
-                        if scan_attrs.get(a) not in value[i]:
-                            cont=True
-                            continue
-                    if cont:
-                        continue
-
-                # Define download locations
-                download_url = f"{xnat_url}/data/experiments/{exp_id}/scans/{scan_id}/resources/DICOM/files?format=zip"
-                out_folder = os.path.join(output_dir, project_id, subj['label'], f"{exp['label']}")
-                out_path = os.path.join(out_folder, f"series_{scan_id.zfill(2)}.zip")
-                
-                # Continue if the data have already been downloaded
-                if os.path.exists(out_path):
-                    continue
+    # Resume from the end of a previous partial download
+    part_path = out_path + '.part'
+    start = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={start}-'} if start > 0 else {}
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with session.get(download_url, stream=True, headers=headers, timeout=TIMEOUT) as r:
+
+        # The partial file does not match the data on the server
+        if r.status_code == 416:
+            os.remove(part_path)
+            return _download(session, download_url, out_path)
+        r.raise_for_status()
 
-                # Download the scan
-                os.makedirs(out_folder, exist_ok=True)
-                r = session.get(download_url, stream=True)
-                with open(out_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
+        # If the server ignores the range it sends the whole file
+        if r.status_code == 206:
+            mode = 'ab'
+            # Content-Range is 'bytes start-end/total', where the total
+            # is '*' if the server does not know it
+            expected = r.headers.get('Content-Range', '*').split('/')[-1]
+            expected = None if expected.strip() == '*' else int(expected)
+        else:
+            mode = 'wb'
+            expected = r.headers.get('Content-Length')
+            expected = None if expected is None else int(expected)
+
+        with open(part_path, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+    # Check the download is complete before moving it in place
+    size = os.path.getsize(part_path)
+    if expected is not None and size != expected:
+        raise IOError(f"Incomplete download: {size} of {expected} bytes.")
+    if not zipfile.is_zipfile(part_path):
+        os.remove(part_path)
+        raise IOError("Downloaded file is not a valid zip file.")
+    os.replace(part_path, out_path)
 
 
 
@@ -0,0 +1,40 @@
+import pandas as pd
+
+from utils import biomarkers
+
+
+def _table(site, patient, value):
+    features = {
+        'kidney_left-volume': [value, 'Kidney volume', 'mL', 'float'],
+        'kidney_right-volume': [value, 'Kidney volume', 'mL', 'float'],
+    }
+    return biomarkers.rows(features, site, patient, 'Baseline')
+
+
+def test_read_missing_folder(tmp_path):
+    table = biomarkers.read(str(tmp_path / 'biomarkers'))
+    assert table.empty
+    assert list(table.columns) == biomarkers.SCHEMA.names
+
+
+def test_read_empty_folder(tmp_path):
+    table = biomarkers.read(str(tmp_path))
+    assert table.empty
+    assert list(table.columns) == biomarkers.SCHEMA.names
+    table = biomarkers.read(str(tmp_path), site='Leeds')
+    assert table.empty
+    table = biomarkers.read(str(tmp_path), columns=['patient', 'value'])
+    assert list(table.columns) == ['patient', 'value']
+
+
+def test_append_read(tmp_path):
+    biomarkers.append(str(tmp_path), _table('Leeds', '1', 100.0))
+    biomarkers.append(str(tmp_path), _table('Bari', '2', 200.0))
+    biomarkers.append(str(tmp_path), _table('Leeds', '3', 300.0))
+    table = biomarkers.read(str(tmp_path))
+    assert list(table.columns) == biomarkers.SCHEMA.names
+    assert len(table) == 6
+    table = biomarkers.read(str(tmp_path), site='Leeds', roi='kidney_left')
+    assert list(table.patient) == ['1', '3']
+    assert list(table.site) == ['Leeds', 'Leeds']
+    assert isinstance(table, pd.DataFrame)
@@ -0,0 +1,47 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+
+
+def _kidney_pc_dixon(input_array, model='unetr', device=None, overlap=0.3, postproc=True, clear_cache=False, verbose=False):
+    # Signature and return value of miblab 0.0.18
+    shape = input_array.shape[:3]
+    left = np.zeros(shape, dtype=np.uint8)
+    right = np.zeros(shape, dtype=np.uint8)
+    left[:shape[0]//2] = 1
+    right[shape[0]//2:, :1] = 1
+    return {'kidney_left': left, 'kidney_right': right}
+
+
+@pytest.fixture
+def kidneyseg(monkeypatch):
+    torch = types.ModuleType('torch')
+    torch.load = lambda f, *args, **kwargs: None
+    torch.set_num_threads = lambda n: None
+    torch.set_num_interop_threads = lambda n: None
+    miblab = types.ModuleType('miblab')
+    miblab.kidney_pc_dixon = _kidney_pc_dixon
+    monkeypatch.setitem(sys.modules, 'torch', torch)
+    monkeypatch.setitem(sys.modules, 'miblab', miblab)
+    monkeypatch.delitem(sys.modules, 'utils.kidneyseg', raising=False)
+    from utils import kidneyseg
+    return kidneyseg
+
+
+@pytest.mark.parametrize('model', ['nnunet', 'unetr'])
+def test_predict_labels(kidneyseg, model):
+    array = np.zeros((4, 3, 2, 4))
+    rois, timing = kidneyseg.predict(array, model)
+    assert rois.dtype == np.int16
+    assert rois.shape == (4, 3, 2)
+    assert (rois[:2] == 1).all()
+    assert (rois[2:, :1] == 2).all()
+    assert (rois[2:, 1:] == 0).all()
+    assert set(timing) == {'load', 'inference'}
+
+
+def test_predict_unknown_model(kidneyseg):
+    with pytest.raises(ValueError):
+        kidneyseg.predict(np.zeros((2, 2, 2, 4)), 'totseg')